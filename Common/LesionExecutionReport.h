@@ -0,0 +1,84 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef LesionExecutionReport_h
+#define LesionExecutionReport_h
+
+#include <fstream>
+#include <string>
+
+#if defined(_WIN32)
+#ifndef NOMINMAX
+#define NOMINMAX
+#endif
+#include <windows.h>
+#include <psapi.h>
+#pragma comment(lib, "psapi.lib")
+#else
+#include <sys/resource.h>
+#endif
+
+namespace LesionReport
+{
+
+//Peak resident memory of the process, in MB. When the CLI is run in process,
+//this is the peak of the whole application.
+inline double PeakMemoryUsage()
+{
+#if defined(_WIN32)
+    PROCESS_MEMORY_COUNTERS counters;
+    if (GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters)))
+        return counters.PeakWorkingSetSize / (1024.0*1024.0);
+    return 0;
+#else
+    struct rusage usage;
+    if (getrusage(RUSAGE_SELF, &usage) != 0)
+        return 0;
+#if defined(__APPLE__)
+    return usage.ru_maxrss / (1024.0*1024.0);
+#else
+    return usage.ru_maxrss / 1024.0;
+#endif
+#endif
+}
+
+/**
+ * Writes the output parameters of a CLI to its return parameter file, from
+ * where Slicer copies them to the CLI node. Nothing is written when the CLI
+ * is run without --returnparameterfile.
+ */
+class ReturnParameters
+{
+public:
+    explicit ReturnParameters(const std::string& fileName)
+    {
+        if (!fileName.empty())
+            m_File.open(fileName.c_str());
+    }
+
+    template <class T>
+    void Set(const std::string& name, const T& value)
+    {
+        if (m_File.is_open())
+            m_File<<name<<" = "<<value<<std::endl;
+    }
+
+private:
+    std::ofstream m_File;
+};
+
+} // end namespace LesionReport
+
+#endif
@@ -0,0 +1,316 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef LesionImageWriter_h
+#define LesionImageWriter_h
+
+#include "itkImageFileWriter.h"
+#include "itkImageIOFactory.h"
+#include "itk_zlib.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstring>
+#include <fstream>
+#include <ostream>
+#include <string>
+#include <thread>
+#include <vector>
+
+namespace LesionIO
+{
+
+//Size of the blocks compressed by each thread
+const size_t GzipChunkSize = 4*1024*1024;
+
+inline bool HasGzipExtension(const std::string& fileName)
+{
+    return fileName.size() > 3 && fileName.compare(fileName.size() - 3, 3, ".gz") == 0;
+}
+
+//Checks if an image file is written by parts when its writer has stream divisions. Otherwise,
+//e.g. for gzip files or volumes exchanged in memory with Slicer, the whole image is buffered.
+inline bool CanStreamWrite(const std::string& fileName)
+{
+    if (HasGzipExtension(fileName))
+        return false;
+#if ITK_VERSION_MAJOR > 5 || (ITK_VERSION_MAJOR == 5 && ITK_VERSION_MINOR >= 1)
+    itk::ImageIOBase::Pointer imageIO = itk::ImageIOFactory::CreateImageIO(fileName.c_str(), itk::ImageIOFactory::IOFileModeEnum::WriteMode);
+#else
+    itk::ImageIOBase::Pointer imageIO = itk::ImageIOFactory::CreateImageIO(fileName.c_str(), itk::ImageIOFactory::WriteMode);
+#endif
+    return imageIO && imageIO->CanStreamWrite();
+}
+
+//Compression level 0 writes the output without compression
+template <class TWriter>
+void SetWriterCompression(TWriter* writer, int compressionLevel)
+{
+    writer->SetUseCompression(compressionLevel > 0);
+#if ITK_VERSION_MAJOR > 5 || (ITK_VERSION_MAJOR == 5 && ITK_VERSION_MINOR >= 1)
+    if (compressionLevel > 0)
+        writer->SetCompressionLevel(compressionLevel);
+#endif
+}
+
+//Compresses a block of data as a complete gzip member
+inline bool GzipMember(const char* data, size_t size, int compressionLevel, std::vector<unsigned char>& member)
+{
+    z_stream stream;
+    stream.zalloc = Z_NULL;
+    stream.zfree = Z_NULL;
+    stream.opaque = Z_NULL;
+    //15 + 16 window bits: deflate with a gzip header and trailer
+    if (deflateInit2(&stream, compressionLevel, Z_DEFLATED, 15 + 16, 8, Z_DEFAULT_STRATEGY) != Z_OK)
+        return false;
+    member.resize(deflateBound(&stream, static_cast<uLong>(size)) + 32);
+    stream.next_in = reinterpret_cast<Bytef*>(size > 0 ? const_cast<char*>(data) : Z_NULL);
+    stream.avail_in = static_cast<uInt>(size);
+    stream.next_out = &member[0];
+    stream.avail_out = static_cast<uInt>(member.size());
+    const bool compressed = deflate(&stream, Z_FINISH) == Z_STREAM_END;
+    member.resize(stream.total_out);
+    deflateEnd(&stream);
+    return compressed;
+}
+
+/**
+ * Compresses a buffer as gzip members, in the same way as pigz.
+ *
+ * The buffer is split in blocks, one per thread, that are compressed at the
+ * same time, each one as a complete gzip member, and written before the next
+ * blocks are compressed, so only these members are kept in memory. Members
+ * written one after the other are still a valid gzip file, read back by zlib
+ * as a single stream.
+ */
+inline bool GzipBuffer(const char* data, size_t size, std::ostream& destination,
+                       int compressionLevel, unsigned int numberOfThreads = 0)
+{
+    if (numberOfThreads == 0)
+        numberOfThreads = std::max(1u, std::thread::hardware_concurrency());
+    std::vector< std::vector<unsigned char> > members(numberOfThreads);
+    std::vector<char> compressed(numberOfThreads);
+
+    size_t offset = 0;
+    do {
+        const size_t numberOfChunks = std::max<size_t>(1, std::min<size_t>(numberOfThreads,
+                                                                          (size - offset + GzipChunkSize - 1) / GzipChunkSize));
+        auto compressChunk = [&, offset](size_t chunk) {
+            const size_t begin = std::min(size, offset + chunk * GzipChunkSize);
+            const size_t end = std::min(size, begin + GzipChunkSize);
+            compressed[chunk] = GzipMember(data + begin, end - begin, compressionLevel, members[chunk]);
+        };
+        std::vector<std::thread> threads;
+        for (size_t chunk = 1; chunk < numberOfChunks; chunk++)
+            threads.push_back(std::thread(compressChunk, chunk));
+        compressChunk(0);
+        for (size_t i = 0; i < threads.size(); i++)
+            threads[i].join();
+
+        for (size_t chunk = 0; chunk < numberOfChunks; chunk++) {
+            if (!compressed[chunk])
+                return false;
+            destination.write(reinterpret_cast<const char*>(&members[chunk][0]), members[chunk].size());
+        }
+        offset = std::min(size, offset + numberOfChunks * GzipChunkSize);
+    } while (offset < size);
+    return static_cast<bool>(destination);
+}
+
+//NIfTI-1 datatype code of the pixel types written by the CLIs, 0 if unsupported
+template <class TPixel> struct NiftiPixel { static const short DataType = 0; };
+template <> struct NiftiPixel<unsigned char> { static const short DataType = 2; };
+template <> struct NiftiPixel<short> { static const short DataType = 4; };
+template <> struct NiftiPixel<int> { static const short DataType = 8; };
+template <> struct NiftiPixel<float> { static const short DataType = 16; };
+template <> struct NiftiPixel<double> { static const short DataType = 64; };
+template <> struct NiftiPixel<char> { static const short DataType = 256; };
+template <> struct NiftiPixel<signed char> { static const short DataType = 256; };
+template <> struct NiftiPixel<unsigned short> { static const short DataType = 512; };
+template <> struct NiftiPixel<unsigned int> { static const short DataType = 768; };
+template <> struct NiftiPixel<long long> { static const short DataType = 1024; };
+template <> struct NiftiPixel<unsigned long long> { static const short DataType = 1280; };
+template <> struct NiftiPixel<long> { static const short DataType = sizeof(long) == 8 ? 1024 : 8; };
+template <> struct NiftiPixel<unsigned long> { static const short DataType = sizeof(unsigned long) == 8 ? 1280 : 768; };
+
+//Size of the NIfTI-1 header followed by the empty extension flag, where the voxels of a .nii file start
+const size_t NiftiVoxelOffset = 352;
+
+template <class T>
+void SetNiftiField(char* header, size_t offset, T value)
+{
+    std::memcpy(header + offset, &value, sizeof(T));
+}
+
+/**
+ * Header of a single file NIfTI-1 image, with the same geometry as the one
+ * written by itk::NiftiImageIO: the ITK (LPS) geometry converted to RAS, stored
+ * both as the quaternion (qform) and as the affine matrix (sform) of the scanner
+ * space.
+ */
+inline void NiftiHeader(const size_t size[3], const double spacing[3], const double origin[3],
+                        const double direction[9], short dataType, short bitsPerPixel,
+                        char header[NiftiVoxelOffset])
+{
+    std::memset(header, 0, NiftiVoxelOffset);
+    SetNiftiField<int>(header, 0, 348);
+    header[38] = 'r';
+    SetNiftiField<short>(header, 40, 3);
+    for (int i = 0; i < 3; i++)
+        SetNiftiField<short>(header, 42 + 2*i, static_cast<short>(size[i]));
+    for (int i = 3; i < 7; i++)
+        SetNiftiField<short>(header, 42 + 2*i, 1);
+    SetNiftiField<short>(header, 70, dataType);
+    SetNiftiField<short>(header, 72, bitsPerPixel);
+    for (int i = 0; i < 3; i++)
+        SetNiftiField<float>(header, 80 + 4*i, static_cast<float>(spacing[i]));
+    for (int i = 3; i < 7; i++)
+        SetNiftiField<float>(header, 80 + 4*i, 1.0f);
+    SetNiftiField<float>(header, 108, static_cast<float>(NiftiVoxelOffset));
+    SetNiftiField<float>(header, 112, 1.0f);
+    //Millimeters and seconds
+    header[123] = 2 | 8;
+    //Scanner anatomical space for both the qform and the sform
+    SetNiftiField<short>(header, 252, 1);
+    SetNiftiField<short>(header, 254, 1);
+
+    //LPS to RAS: the first two rows of the direction and of the origin change sign
+    double rotation[3][3];
+    double offset[3];
+    for (int row = 0; row < 3; row++) {
+        const double sign = row < 2 ? -1.0 : 1.0;
+        offset[row] = sign*origin[row];
+        for (int column = 0; column < 3; column++)
+            rotation[row][column] = sign*direction[3*row + column];
+    }
+    for (int row = 0; row < 3; row++) {
+        for (int column = 0; column < 3; column++)
+            SetNiftiField<float>(header, 280 + 16*row + 4*column, static_cast<float>(rotation[row][column]*spacing[column]));
+        SetNiftiField<float>(header, 280 + 16*row + 12, static_cast<float>(offset[row]));
+    }
+
+    //Quaternion of the rotation, as nifti_mat44_to_quatern, the reflection being stored in pixdim[0]
+    const double determinant = rotation[0][0]*(rotation[1][1]*rotation[2][2] - rotation[1][2]*rotation[2][1])
+                             - rotation[0][1]*(rotation[1][0]*rotation[2][2] - rotation[1][2]*rotation[2][0])
+                             + rotation[0][2]*(rotation[1][0]*rotation[2][1] - rotation[1][1]*rotation[2][0]);
+    const float qfac = determinant < 0 ? -1.0f : 1.0f;
+    if (determinant < 0) {
+        for (int row = 0; row < 3; row++)
+            rotation[row][2] = -rotation[row][2];
+    }
+    double a = rotation[0][0] + rotation[1][1] + rotation[2][2] + 1.0;
+    double b, c, d;
+    if (a > 0.5) {
+        a = 0.5*std::sqrt(a);
+        b = 0.25*(rotation[2][1] - rotation[1][2])/a;
+        c = 0.25*(rotation[0][2] - rotation[2][0])/a;
+        d = 0.25*(rotation[1][0] - rotation[0][1])/a;
+    }else {
+        const double xd = 1.0 + rotation[0][0] - (rotation[1][1] + rotation[2][2]);
+        const double yd = 1.0 + rotation[1][1] - (rotation[0][0] + rotation[2][2]);
+        const double zd = 1.0 + rotation[2][2] - (rotation[0][0] + rotation[1][1]);
+        if (xd > 1.0) {
+            b = 0.5*std::sqrt(xd);
+            c = 0.25*(rotation[0][1] + rotation[1][0])/b;
+            d = 0.25*(rotation[0][2] + rotation[2][0])/b;
+            a = 0.25*(rotation[2][1] - rotation[1][2])/b;
+        }else if (yd > 1.0) {
+            c = 0.5*std::sqrt(yd);
+            b = 0.25*(rotation[0][1] + rotation[1][0])/c;
+            d = 0.25*(rotation[1][2] + rotation[2][1])/c;
+            a = 0.25*(rotation[0][2] - rotation[2][0])/c;
+        }else {
+            d = 0.5*std::sqrt(zd);
+            b = 0.25*(rotation[0][2] + rotation[2][0])/d;
+            c = 0.25*(rotation[1][2] + rotation[2][1])/d;
+            a = 0.25*(rotation[1][0] - rotation[0][1])/d;
+        }
+        if (a < 0.0) {
+            b = -b;
+            c = -c;
+            d = -d;
+        }
+    }
+    SetNiftiField<float>(header, 76, qfac);
+    SetNiftiField<float>(header, 256, static_cast<float>(b));
+    SetNiftiField<float>(header, 260, static_cast<float>(c));
+    SetNiftiField<float>(header, 264, static_cast<float>(d));
+    for (int i = 0; i < 3; i++)
+        SetNiftiField<float>(header, 268 + 4*i, static_cast<float>(offset[i]));
+    std::memcpy(header + 344, "n+1", 4);
+}
+
+/**
+ * Writes an image with the given compression level, from 0 (no compression,
+ * for intermediate files) to 9. NIfTI gzip files (.nii.gz) of 3D scalar images
+ * are compressed from the image buffer by several threads, after their header;
+ * other gzip files are compressed by their ImageIO.
+ */
+template <class TImage>
+void WriteImage(const TImage* image, const std::string& fileName, int compressionLevel,
+                unsigned int numberOfThreads = 0)
+{
+    typedef typename TImage::PixelType PixelType;
+    const short dataType = NiftiPixel<PixelType>::DataType;
+    const bool niftiGzip = fileName.size() > 7 && fileName.compare(fileName.size() - 7, 7, ".nii.gz") == 0;
+
+    if (compressionLevel <= 0 || !niftiGzip || dataType == 0 || TImage::ImageDimension != 3) {
+        typedef itk::ImageFileWriter<TImage> WriterType;
+        typename WriterType::Pointer writer = WriterType::New();
+        writer->SetInput(image);
+        writer->SetFileName(fileName.c_str());
+        SetWriterCompression(writer.GetPointer(), compressionLevel);
+        writer->Update();
+        return;
+    }
+
+    //The whole image is needed in memory, as the ImageFileWriter would request it
+    TImage* input = const_cast<TImage*>(image);
+    input->UpdateOutputInformation();
+    input->SetRequestedRegionToLargestPossibleRegion();
+    input->PropagateRequestedRegion();
+    input->UpdateOutputData();
+    if (input->GetBufferedRegion() != input->GetLargestPossibleRegion())
+        itkGenericExceptionMacro(<< "The whole image is not buffered to write " << fileName);
+
+    size_t size[3];
+    double spacing[3];
+    double origin[3];
+    double direction[9];
+    for (unsigned int i = 0; i < 3; i++) {
+        size[i] = input->GetLargestPossibleRegion().GetSize()[i];
+        if (size[i] > 32767)
+            itkGenericExceptionMacro(<< "Image too large for a NIfTI-1 file: " << fileName);
+        spacing[i] = input->GetSpacing()[i];
+        origin[i] = input->GetOrigin()[i];
+        for (unsigned int j = 0; j < 3; j++)
+            direction[3*i + j] = input->GetDirection()[i][j];
+    }
+    char header[NiftiVoxelOffset];
+    NiftiHeader(size, spacing, origin, direction, dataType, static_cast<short>(8*sizeof(PixelType)), header);
+
+    std::ofstream destination(fileName.c_str(), std::ios::binary);
+    if (!destination)
+        itkGenericExceptionMacro(<< "Could not write " << fileName);
+    const size_t dataSize = input->GetLargestPossibleRegion().GetNumberOfPixels()*sizeof(PixelType);
+    if (!GzipBuffer(header, NiftiVoxelOffset, destination, compressionLevel, 1)
+        || !GzipBuffer(reinterpret_cast<const char*>(input->GetBufferPointer()), dataSize, destination,
+                       compressionLevel, numberOfThreads))
+        itkGenericExceptionMacro(<< "Could not write " << fileName);
+}
+
+} // end namespace LesionIO
+
+#endif
@@ -0,0 +1,102 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef LesionProgress_h
+#define LesionProgress_h
+
+#include "itkPluginFilterWatcher.h"
+#include "itkTimeProbe.h"
+
+#include <cstring>
+#include <iostream>
+#include <mutex>
+#include <string>
+
+namespace LesionReport
+{
+
+/**
+ * Reports the overall progress of a CLI, from 0 to 1, in the same way as
+ * itk::PluginFilterWatcher does for a single filter: through the process
+ * information given by Slicer when the CLI is run in process, or as
+ * <filter-progress> tags on the standard output otherwise. Filters are
+ * watched with itk::PluginFilterWatcher over their share of the progress.
+ *
+ * Progress can be reported from any thread. When Slicer cancels a CLI run
+ * in process, it sets the Abort flag that CheckAbort turns into an
+ * itk::ProcessAborted exception; a CLI run out of process is killed instead.
+ */
+class ProgressReporter
+{
+public:
+    ProgressReporter(const std::string& name, const std::string& comment, ModuleProcessInformation* processInformation)
+        : m_Name(name), m_ProcessInformation(processInformation)
+    {
+        m_TimeProbe.Start();
+        if (!m_ProcessInformation)
+            std::cout<<"<filter-start><filter-name>"<<m_Name<<"</filter-name><filter-comment> \""<<comment
+                     <<"\" </filter-comment></filter-start>"<<std::endl;
+        SetProgress(0, comment);
+    }
+
+    ~ProgressReporter()
+    {
+        m_TimeProbe.Stop();
+        if (!m_ProcessInformation)
+            std::cout<<"<filter-end><filter-name>"<<m_Name<<"</filter-name><filter-time>"<<m_TimeProbe.GetTotal()
+                     <<"</filter-time></filter-end>"<<std::endl;
+    }
+
+    void SetProgress(double progress, const std::string& message)
+    {
+        std::lock_guard<std::mutex> lock(m_Mutex);
+        if (m_ProcessInformation) {
+            strncpy(m_ProcessInformation->ProgressMessage, message.c_str(), 1023);
+            m_ProcessInformation->ProgressMessage[1023] = '\0';
+            m_ProcessInformation->Progress = static_cast<float>(progress);
+            if (m_ProcessInformation->ProgressCallbackFunction && m_ProcessInformation->ProgressCallbackClientData)
+                (*(m_ProcessInformation->ProgressCallbackFunction))(m_ProcessInformation->ProgressCallbackClientData);
+        }else{
+            std::cout<<"<filter-progress>"<<progress<<"</filter-progress>"<<std::endl;
+        }
+    }
+
+    bool IsAborted() const
+    {
+        return m_ProcessInformation && m_ProcessInformation->Abort;
+    }
+
+    //Stops the CLI if it was cancelled. Only called from the main thread.
+    void CheckAbort() const
+    {
+        if (IsAborted())
+            throw itk::ProcessAborted(__FILE__, __LINE__);
+    }
+
+    ModuleProcessInformation* GetProcessInformation() const
+    {
+        return m_ProcessInformation;
+    }
+
+private:
+    std::string m_Name;
+    ModuleProcessInformation* m_ProcessInformation;
+    itk::TimeProbe m_TimeProbe;
+    std::mutex m_Mutex;
+};
+
+} // end namespace LesionReport
+
+#endif
@@ -0,0 +1,149 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef PhiloxRandom_h
+#define PhiloxRandom_h
+
+#include <stdint.h>
+
+#include <cmath>
+#include <string>
+
+namespace LesionRandom
+{
+
+/**
+ * Philox4x32-10 counter-based random number generator (Salmon et al.,
+ * "Parallel random numbers: as easy as 1, 2, 3", SC 2011).
+ *
+ * Every 128 bit counter is mapped to four independent 32 bit random numbers
+ * under a 64 bit key, without any state. The random numbers of a voxel only
+ * depend on the seed and on the voxel position, so a noise field can be
+ * generated by any number of threads, in any order, with the same result.
+ */
+struct PhiloxCounter
+{
+    uint32_t v[4];
+};
+
+inline void PhiloxMultiply(uint32_t a, uint32_t b, uint32_t& hi, uint32_t& lo)
+{
+    const uint64_t product = static_cast<uint64_t>(a) * b;
+    hi = static_cast<uint32_t>(product >> 32);
+    lo = static_cast<uint32_t>(product);
+}
+
+inline PhiloxCounter Philox4x32(PhiloxCounter counter, uint64_t seed)
+{
+    uint32_t key0 = static_cast<uint32_t>(seed);
+    uint32_t key1 = static_cast<uint32_t>(seed >> 32);
+    for (int round = 0; round < 10; round++) {
+        uint32_t hi0, lo0, hi1, lo1;
+        PhiloxMultiply(0xD2511F53u, counter.v[0], hi0, lo0);
+        PhiloxMultiply(0xCD9E8D57u, counter.v[2], hi1, lo1);
+        PhiloxCounter next;
+        next.v[0] = hi1 ^ counter.v[1] ^ key0;
+        next.v[1] = lo1;
+        next.v[2] = hi0 ^ counter.v[3] ^ key1;
+        next.v[3] = lo0;
+        counter = next;
+        key0 += 0x9E3779B9u;
+        key1 += 0xBB67AE85u;
+    }
+    return counter;
+}
+
+//Four standard normal variates of one counter, through the Box-Muller transform
+inline void NormalVariates(uint64_t seed, uint32_t stream, uint32_t substream, uint64_t block, double normals[4])
+{
+    PhiloxCounter counter;
+    counter.v[0] = static_cast<uint32_t>(block);
+    counter.v[1] = static_cast<uint32_t>(block >> 32);
+    counter.v[2] = stream;
+    counter.v[3] = substream;
+    const PhiloxCounter random = Philox4x32(counter, seed);
+
+    const double twoPi = 6.283185307179586;
+    const double scale = 1.0 / 4294967296.0;
+    for (int i = 0; i < 4; i += 2) {
+        //u1 is in (0, 1], so its logarithm is finite
+        const double u1 = (random.v[i] + 1.0) * scale;
+        const double u2 = random.v[i+1] * scale;
+        const double radius = std::sqrt(-2.0 * std::log(u1));
+        normals[i] = radius * std::cos(twoPi * u2);
+        normals[i+1] = radius * std::sin(twoPi * u2);
+    }
+}
+
+//Stream of an image modality, so that each modality gets its own random numbers for the same seed
+inline uint32_t ModalityStream(const std::string& modality)
+{
+    uint32_t hash = 2166136261u;
+    for (size_t i = 0; i < modality.size(); i++) {
+        hash ^= static_cast<unsigned char>(modality[i]);
+        hash *= 16777619u;
+    }
+    return hash;
+}
+
+//Substreams of a modality stream
+enum Substream
+{
+    NoiseFieldSubstream = 0,
+    LesionLevelSubstream = 1
+};
+
+/**
+ * Sequential normal variates of one stream, used where the random numbers are
+ * drawn in a fixed order, such as the intensity levels of the lesions.
+ */
+class NormalGenerator
+{
+public:
+    NormalGenerator(uint64_t seed = 0, uint32_t stream = 0, uint32_t substream = 0)
+    {
+        Initialize(seed, stream, substream);
+    }
+
+    void Initialize(uint64_t seed, uint32_t stream, uint32_t substream)
+    {
+        m_Seed = seed;
+        m_Stream = stream;
+        m_Substream = substream;
+        m_Block = 0;
+        m_Position = 4;
+    }
+
+    double GetVariate()
+    {
+        if (m_Position == 4) {
+            NormalVariates(m_Seed, m_Stream, m_Substream, m_Block++, m_Normals);
+            m_Position = 0;
+        }
+        return m_Normals[m_Position++];
+    }
+
+private:
+    uint64_t m_Seed;
+    uint32_t m_Stream;
+    uint32_t m_Substream;
+    uint64_t m_Block;
+    int m_Position;
+    double m_Normals[4];
+};
+
+} // end namespace LesionRandom
+
+#endif
@@ -0,0 +1,145 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef itkPhiloxGaussianImageSource_h
+#define itkPhiloxGaussianImageSource_h
+
+#include "itkImageSource.h"
+#include "itkImageRegionIteratorWithIndex.h"
+
+#include "PhiloxRandom.h"
+
+namespace itk
+{
+
+/**
+ * Image of independent Gaussian voxels, generated by the multithreaded ITK
+ * image source pipeline.
+ *
+ * The value of each voxel is drawn from the Philox counter of its linear
+ * index in the output region, for the given seed and stream, so the image
+ * is the same whatever the number of threads and the region splitting.
+ */
+template <class TOutputImage>
+class PhiloxGaussianImageSource : public ImageSource<TOutputImage>
+{
+public:
+    typedef PhiloxGaussianImageSource   Self;
+    typedef ImageSource<TOutputImage>   Superclass;
+    typedef SmartPointer<Self>          Pointer;
+    typedef SmartPointer<const Self>    ConstPointer;
+
+    typedef TOutputImage                                OutputImageType;
+    typedef typename OutputImageType::PixelType         OutputPixelType;
+    typedef typename OutputImageType::RegionType        OutputImageRegionType;
+    typedef typename OutputImageType::SpacingType       SpacingType;
+    typedef typename OutputImageType::PointType         PointType;
+    typedef typename OutputImageType::DirectionType     DirectionType;
+
+    itkNewMacro(Self);
+    itkTypeMacro(PhiloxGaussianImageSource, ImageSource);
+
+    itkSetMacro(Seed, uint64_t);
+    itkGetConstMacro(Seed, uint64_t);
+    itkSetMacro(Stream, uint32_t);
+    itkGetConstMacro(Stream, uint32_t);
+    itkSetMacro(Substream, uint32_t);
+    itkGetConstMacro(Substream, uint32_t);
+    itkSetMacro(Mean, double);
+    itkGetConstMacro(Mean, double);
+    itkSetMacro(StandardDeviation, double);
+    itkGetConstMacro(StandardDeviation, double);
+
+    itkSetMacro(Region, OutputImageRegionType);
+    itkGetConstReferenceMacro(Region, OutputImageRegionType);
+    itkSetMacro(Spacing, SpacingType);
+    itkSetMacro(Origin, PointType);
+    itkSetMacro(Direction, DirectionType);
+
+    //Copies the spacing, origin and direction of the given image
+    void SetReferenceImage(const ImageBase<TOutputImage::ImageDimension>* image)
+    {
+        this->SetSpacing(image->GetSpacing());
+        this->SetOrigin(image->GetOrigin());
+        this->SetDirection(image->GetDirection());
+    }
+
+protected:
+    PhiloxGaussianImageSource()
+        : m_Seed(0), m_Stream(0), m_Substream(0), m_Mean(0.0), m_StandardDeviation(1.0)
+    {
+        m_Spacing.Fill(1.0);
+        m_Origin.Fill(0.0);
+        m_Direction.SetIdentity();
+#if ITK_VERSION_MAJOR >= 5
+        this->DynamicMultiThreadingOff();
+#endif
+    }
+
+    void GenerateOutputInformation() override
+    {
+        OutputImageType* output = this->GetOutput();
+        output->SetLargestPossibleRegion(m_Region);
+        output->SetSpacing(m_Spacing);
+        output->SetOrigin(m_Origin);
+        output->SetDirection(m_Direction);
+    }
+
+    void ThreadedGenerateData(const OutputImageRegionType& outputRegionForThread, ThreadIdType) override
+    {
+        OutputImageType* output = this->GetOutput();
+        const typename OutputImageType::IndexType& start = m_Region.GetIndex();
+        const typename OutputImageType::SizeType& size = m_Region.GetSize();
+
+        //Philox returns four normal variates per counter: consecutive voxels of a row share a counter
+        uint64_t cachedBlock = 0;
+        bool hasCachedBlock = false;
+        double normals[4];
+
+        ImageRegionIteratorWithIndex<OutputImageType> outputIt(output, outputRegionForThread);
+        for (outputIt.GoToBegin(); !outputIt.IsAtEnd(); ++outputIt) {
+            const typename OutputImageType::IndexType& index = outputIt.GetIndex();
+            uint64_t linearIndex = 0;
+            for (int i = TOutputImage::ImageDimension - 1; i >= 0; i--)
+                linearIndex = linearIndex * size[i] + static_cast<uint64_t>(index[i] - start[i]);
+
+            const uint64_t block = linearIndex >> 2;
+            if (!hasCachedBlock || block != cachedBlock) {
+                LesionRandom::NormalVariates(m_Seed, m_Stream, m_Substream, block, normals);
+                cachedBlock = block;
+                hasCachedBlock = true;
+            }
+            outputIt.Set(static_cast<OutputPixelType>(normals[linearIndex & 3] * m_StandardDeviation + m_Mean));
+        }
+    }
+
+private:
+    PhiloxGaussianImageSource(const Self&);
+    void operator=(const Self&);
+
+    uint64_t m_Seed;
+    uint32_t m_Stream;
+    uint32_t m_Substream;
+    double m_Mean;
+    double m_StandardDeviation;
+    OutputImageRegionType m_Region;
+    SpacingType m_Spacing;
+    PointType m_Origin;
+    DirectionType m_Direction;
+};
+
+} // end namespace itk
+
+#endif
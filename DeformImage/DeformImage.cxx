@@ -16,19 +16,30 @@
 
 #include "itkImageFileWriter.h"
 
-#include "itkCastImageFilter.h"
-#include "itkGaussianDistribution.h"
 #include "itkImageRegionIterator.h"
-#include "itkMaskNegatedImageFilter.h"
+#include "itkImageRegionConstIteratorWithIndex.h"
 #include "itkSmoothingRecursiveGaussianImageFilter.h"
-#include "itkMultiplyImageFilter.h"
 #include "itkConnectedComponentImageFilter.h"
 #include "itkRelabelComponentImageFilter.h"
-#include "itkNormalVariateGenerator.h"
-#include "itkImageRegionIterator.h"
+#include "itkPasteImageFilter.h"
 
 #include "itkPluginUtilities.h"
 
+#include "itkPhiloxGaussianImageSource.h"
+#include "LesionImageWriter.h"
+#include "LesionExecutionReport.h"
+#include "LesionProgress.h"
+
+#include <algorithm>
+#include <atomic>
+#include <cmath>
+#include <ctime>
+#include <memory>
+#include <sstream>
+#include <thread>
+#include <utility>
+#include <vector>
+
 #include "DeformImageCLP.h"
 
 using namespace std;
@@ -41,242 +52,576 @@ using namespace std;
 namespace
 {
 
-template <class T>
-int DoIt( int argc, char * argv[], T )
+//Bounding box of the nonzero voxels of a label image, padded by the given
+//distance (in mm) and cropped to the image. Empty if there is no label.
+template <class TLabelImage>
+typename TLabelImage::RegionType LesionRegion(const TLabelImage* labels, double padding)
 {
-    PARSE_ARGS;
-
-    typedef    T              InputPixelType;
-    typedef    T              OutputPixelType;
-    typedef    unsigned short  LabelPixelType;
+    typedef typename TLabelImage::RegionType RegionType;
+    typedef typename TLabelImage::IndexType  IndexType;
+    typedef typename TLabelImage::SizeType   SizeType;
+
+    const RegionType& region = labels->GetBufferedRegion();
+    IndexType minIndex, maxIndex;
+    for (unsigned int i=0; i<3; i++) {
+        minIndex[i] = region.GetIndex()[i] + region.GetSize()[i];
+        maxIndex[i] = region.GetIndex()[i] - 1;
+    }
 
-    typedef itk::Image<InputPixelType,  3>    InputImageType;
-    typedef itk::Image<OutputPixelType, 3>    OutputImageType;
-    typedef itk::Image<LabelPixelType, 3>     LabelInputType;
+    itk::ImageRegionConstIteratorWithIndex<TLabelImage> labelIt(labels, region);
+    for (labelIt.GoToBegin(); !labelIt.IsAtEnd(); ++labelIt) {
+        if (labelIt.Get() > 0) {
+            const IndexType& index = labelIt.GetIndex();
+            for (unsigned int i=0; i<3; i++) {
+                minIndex[i] = std::min(minIndex[i], index[i]);
+                maxIndex[i] = std::max(maxIndex[i], index[i]);
+            }
+        }
+    }
 
-    typedef itk::Image<float, 3>    CastImageType;
+    RegionType lesionRegion;
+    if (maxIndex[0] < minIndex[0]) {
+        SizeType size;
+        size.Fill(0);
+        lesionRegion.SetIndex(region.GetIndex());
+        lesionRegion.SetSize(size);
+        return lesionRegion;
+    }
 
-    typedef itk::ImageFileReader<InputImageType>    ReaderType;
-    typedef itk::ImageFileReader<LabelInputType>    LabelReaderType;
-    typedef itk::ImageFileWriter<OutputImageType>   WriterType;
-    typedef itk::ImageFileWriter<CastImageType>     DebugWriterType;
+    SizeType size;
+    for (unsigned int i=0; i<3; i++) {
+        const long pad = static_cast<long>(ceil(padding / labels->GetSpacing()[i]));
+        minIndex[i] = std::max<long>(minIndex[i] - pad, region.GetIndex()[i]);
+        maxIndex[i] = std::min<long>(maxIndex[i] + pad, region.GetIndex()[i] + region.GetSize()[i] - 1);
+        size[i] = maxIndex[i] - minIndex[i] + 1;
+    }
+    lesionRegion.SetIndex(minIndex);
+    lesionRegion.SetSize(size);
+    return lesionRegion;
+}
 
-    typedef itk::CastImageFilter<InputImageType, CastImageType>    CastInputType;
-    typedef itk::CastImageFilter<CastImageType, OutputImageType>   CastOutputType;
+typedef unsigned short                          LabelPixelType;
+typedef itk::Image<LabelPixelType, 3>           LabelInputType;
+typedef itk::Image<float, 3>                    CastImageType;
 
-    typedef itk::MaskImageFilter<CastImageType, LabelInputType>                         MaskType;
-    typedef itk::MaskNegatedImageFilter<CastImageType, LabelInputType>                  MaskNegateType;
+//Size, spacing, origin and direction of an image, the direction row by row
+struct ImageGrid
+{
+    size_t size[3];
+    double spacing[3];
+    double origin[3];
+    double direction[9];
+};
 
-    typedef itk::ImageRegionIterator<CastImageType>                                     ImageIterator;
-    typedef itk::SmoothingRecursiveGaussianImageFilter<CastImageType, CastImageType>    SmoothType;
-    typedef itk::MultiplyImageFilter<CastImageType, CastImageType>                      MultiplyImageType;
-    typedef itk::ConnectedComponentImageFilter<LabelInputType, LabelInputType>          ConnectedType;
-    typedef itk::RelabelComponentImageFilter<LabelInputType, LabelInputType>            RelabelerType;
-    typedef itk::Statistics::NormalVariateGenerator                                     GeneratorType;
-    typedef itk::ImageRegionIterator<CastImageType>                                     IteratorType;
+ImageGrid LabelGrid(const LabelInputType* image)
+{
+    ImageGrid grid;
+    for (unsigned int i=0; i<3; i++) {
+        grid.size[i] = image->GetLargestPossibleRegion().GetSize()[i];
+        grid.spacing[i] = image->GetSpacing()[i];
+        grid.origin[i] = image->GetOrigin()[i];
+        for (unsigned int j=0; j<3; j++)
+            grid.direction[3*i + j] = image->GetDirection()[i][j];
+    }
+    return grid;
+}
 
-    typename ReaderType::Pointer reader = ReaderType::New();
-    typename LabelReaderType::Pointer lesionMask = LabelReaderType::New();
+//Reads the grid of an image file without reading its voxels
+bool ReadImageGrid(const std::string& fileName, ImageGrid& grid)
+{
+#if ITK_VERSION_MAJOR > 5 || (ITK_VERSION_MAJOR == 5 && ITK_VERSION_MINOR >= 1)
+    itk::ImageIOBase::Pointer imageIO = itk::ImageIOFactory::CreateImageIO(fileName.c_str(), itk::ImageIOFactory::IOFileModeEnum::ReadMode);
+#else
+    itk::ImageIOBase::Pointer imageIO = itk::ImageIOFactory::CreateImageIO(fileName.c_str(), itk::ImageIOFactory::ReadMode);
+#endif
+    if (!imageIO)
+        return false;
+    imageIO->SetFileName(fileName);
+    imageIO->ReadImageInformation();
+    if (imageIO->GetNumberOfDimensions() != 3)
+        return false;
+    for (unsigned int i=0; i<3; i++) {
+        grid.size[i] = imageIO->GetDimensions(i);
+        grid.spacing[i] = imageIO->GetSpacing(i);
+        grid.origin[i] = imageIO->GetOrigin(i);
+        //GetDirection(i) is the direction of the i-th axis, a column of the direction matrix
+        for (unsigned int j=0; j<3; j++)
+            grid.direction[3*j + i] = imageIO->GetDirection(i)[j];
+    }
+    return true;
+}
 
-    //    Reading volume
-    reader->SetFileName( inputVolume.c_str() );
-    reader->Update();
-
-    typename CastInputType::Pointer castInput = CastInputType::New();
-    castInput->SetInput(reader->GetOutput());
-    castInput->Update();
-    lesionMask->SetFileName( lesionLabel.c_str() );
-    lesionMask->Update();
-
-    itk::Statistics::GaussianDistribution::Pointer gaussian = itk::Statistics::GaussianDistribution::New();
-
-    //Adjusting the Gaussian Lesion Distribution
-    if (imageModality=="T1") {
-        //Apply deformation: T1 Volume
-        gaussian->SetMean(t1Contrast);
-        gaussian->SetVariance(t1Std*t1Std);
-    }else if (imageModality=="T2") {
-        //Apply deformation: T2 Volume
-        gaussian->SetMean(t2Contrast);
-        gaussian->SetVariance(t2Std*t2Std);
-    }else if (imageModality=="T2-FLAIR") {
-        //Apply deformation: T2-FLAIR Volume
-        gaussian->SetMean(flairContrast);
-        gaussian->SetVariance(flairStd*flairStd);
-    }else if (imageModality=="PD") {
-        //Apply deformation: PD Volume
-        gaussian->SetMean(pdContrast);
-        gaussian->SetVariance(pdStd*pdStd);
-    }else if (imageModality=="DTI-FA") {
-        //Apply deformation: FA Volume
-        gaussian->SetMean(faContrast);
-        gaussian->SetVariance(faStd*faStd);
-    }else if (imageModality=="DTI-ADC") {
-        //Apply deformation: ADC Volume
-        gaussian->SetMean(adcContrast);
-        gaussian->SetVariance(adcStd*adcStd);
+//The lesion voxels of the modalities are matched by their offset, so their grids must be the same
+bool SameGrid(const ImageGrid& grid, const ImageGrid& reference)
+{
+    const double tolerance = 1e-4;
+    for (unsigned int i=0; i<3; i++) {
+        if (grid.size[i] != reference.size[i]
+            || std::abs(grid.spacing[i] - reference.spacing[i]) > tolerance*reference.spacing[i]
+            || std::abs(grid.origin[i] - reference.origin[i]) > tolerance*reference.spacing[i])
+            return false;
     }
-    cout<<"Lesion intensity distribution ("<<imageModality<<") - Mean: "<<gaussian->GetMean()<<" and Variance: "<<gaussian->GetVariance()<<endl;
-    typename GeneratorType::Pointer normalGenerator = GeneratorType::New();
-    normalGenerator->Initialize(rand());
-
-    //Creating deformation map
-    typename CastImageType::Pointer deformationMap = CastImageType::New();
-    deformationMap->CopyInformation(reader->GetOutput());
-    deformationMap->SetRegions(reader->GetOutput()->GetBufferedRegion());
-    deformationMap->Allocate();
-
-    ImageIterator defMapIt(deformationMap, deformationMap->GetBufferedRegion());
-    defMapIt.GoToBegin();
-    while (!defMapIt.IsAtEnd()) {
-        defMapIt.Set(normalGenerator->GetVariate()*sqrt(gaussian->GetVariance()) + gaussian->GetMean());
-        ++defMapIt;
+    for (unsigned int i=0; i<9; i++) {
+        if (std::abs(grid.direction[i] - reference.direction[i]) > tolerance)
+            return false;
     }
+    return true;
+}
 
-    //Mask deformation map, adding independent intensity levels, and smooth lesion borders
-    CastImageType::Pointer lesionMaskDeformationMapDCLevel = CastImageType::New();
-    lesionMaskDeformationMapDCLevel->CopyInformation(lesionMask->GetOutput());
-    lesionMaskDeformationMapDCLevel->SetRegions(lesionMask->GetOutput()->GetBufferedRegion());
-    lesionMaskDeformationMapDCLevel->SetSpacing(lesionMask->GetOutput()->GetSpacing());
-    lesionMaskDeformationMapDCLevel->SetOrigin(lesionMask->GetOutput()->GetOrigin());
-    lesionMaskDeformationMapDCLevel->Allocate();
+//Parameters shared by all modalities
+struct SimulationSettings
+{
+    double variability;
+    uint64_t seed;
+    bool deformationMapVolume;
+    bool lowMemory;
+    unsigned int streamDivisions;
+    int compressionLevel;
+    unsigned int compressionThreads;
+    //Progress from 0.3 to 1 is shared by the modalities, advanced as each one is written
+    LesionReport::ProgressReporter* progress;
+    size_t numberOfModalities;
+    mutable std::atomic<size_t> finishedModalities;
+};
+
+//One (inputVolume, imageModality, lesionLabel, sigma) tuple of the command line
+struct ModalitySimulation
+{
+    ModalitySimulation() : sigma(1.0), mean(1.0), variance(0.0), status(EXIT_SUCCESS) {}
+
+    std::string inputVolume;
+    std::string imageModality;
+    std::string lesionLabel;
+    std::string outputVolume;
+    double sigma;
+    double mean;
+    double variance;
+    LabelInputType::Pointer lesionMask;
+    std::ostringstream log;
+    int status;
+};
 
-    typename MaskNegateType::Pointer lesionMaskDeformationMap = MaskNegateType::New();
-    lesionMaskDeformationMap->SetInput(deformationMap);
-    lesionMaskDeformationMap->SetOutsideValue(0.0);
+template <class T>
+void SimulateLesions(ModalitySimulation* simulation, const LabelInputType* lesionIds, int nLesion,
+                     const SimulationSettings* settings)
+{
+    typedef    T              InputPixelType;
+    typedef    T              OutputPixelType;
 
-    typename ConnectedType::Pointer connectedLesions = ConnectedType::New();
-    connectedLesions->SetInput(lesionMask->GetOutput());
-    connectedLesions->Update();
+    typedef itk::Image<InputPixelType,  3>    InputImageType;
+    typedef itk::Image<OutputPixelType, 3>    OutputImageType;
 
-    typename RelabelerType::Pointer sortLesions = RelabelerType::New();
-    sortLesions->SetInput(connectedLesions->GetOutput());
-    sortLesions->SetSortByObjectSize(true);
-    sortLesions->Update();
-    int nLesion = sortLesions->GetNumberOfObjects();
-    cout<<"Number of considered lesions: "<<nLesion<<endl;
+    typedef itk::ImageFileReader<InputImageType>    ReaderType;
+    typedef itk::ImageFileWriter<OutputImageType>   WriterType;
 
-    float DClevel=0.0;
-    cout<<"Generating lesion ("<<variability<<" standard deviations from the "<<imageModality<<" lesion database): "<<endl;
-    for (unsigned int lesion = 1; lesion <= nLesion; ++lesion) {
-        cout<<lesion<<" - Mean intensity: "<<gaussian->GetMean()+DClevel<<endl;
-        lesionMaskDeformationMap->SetMaskImage(sortLesions->GetOutput());
-        lesionMaskDeformationMap->SetMaskingValue(lesion);
-        lesionMaskDeformationMap->Update();
-
-        IteratorType addLesion(lesionMaskDeformationMapDCLevel,lesionMaskDeformationMapDCLevel->GetBufferedRegion());
-        IteratorType lesionIt(lesionMaskDeformationMap->GetOutput(),lesionMaskDeformationMap->GetOutput()->GetBufferedRegion());
-        addLesion.GoToBegin();
-        lesionIt.GoToBegin();
-        DClevel = static_cast<float>(normalGenerator->GetVariate());
-        while(abs(DClevel)>variability*sqrt(gaussian->GetVariance())){
-            DClevel = static_cast<float>(normalGenerator->GetVariate());
-        }
+    typedef itk::ImageRegionIterator<CastImageType>                                     ImageIterator;
+    typedef itk::ImageRegionConstIterator<LabelInputType>                               LabelIterator;
+    typedef itk::ImageRegionConstIterator<InputImageType>                               InputIterator;
+    typedef itk::ImageRegionIterator<OutputImageType>                                   OutputIterator;
+    typedef itk::SmoothingRecursiveGaussianImageFilter<CastImageType, CastImageType>    SmoothType;
+    typedef itk::PasteImageFilter<OutputImageType>                                      PasteType;
+    typedef itk::PhiloxGaussianImageSource<CastImageType>                               NoiseSourceType;
 
-        while (!addLesion.IsAtEnd()) {
-            if (lesionIt.Get()!=static_cast<float>(0)) {
-                addLesion.Set(lesionIt.Get()+DClevel);
-                ++addLesion;
-                ++lesionIt;
-            }else{
-                ++addLesion;
-                ++lesionIt;
-            }
+    ostringstream& log = simulation->log;
+    const double variability = settings->variability;
+    const double sigma = simulation->sigma;
+    const double stdev = sqrt(simulation->variance);
+
+    //    Reading volume
+    typename ReaderType::Pointer reader = ReaderType::New();
+    reader->SetFileName( simulation->inputVolume.c_str() );
+    if (settings->lowMemory && !settings->deformationMapVolume)
+        reader->UpdateOutputInformation();
+    else
+        reader->Update();
+
+    //The deformation map is only computed inside the bounding box of the lesions, padded by
+    //4 sigma so that the smoothed lesion borders fit in it. Out of it, the map is equal to 1.
+    CastImageType::RegionType lesionRegion = LesionRegion<LabelInputType>(simulation->lesionMask, 4*sigma);
+    log<<"Lesion region: "<<lesionRegion.GetNumberOfPixels()<<" of "<<reader->GetOutput()->GetLargestPossibleRegion().GetNumberOfPixels()<<" voxels"<<endl;
+
+    //Creating deformation map: the noise is drawn in parallel from the modality stream of the seed
+    const uint32_t stream = LesionRandom::ModalityStream(simulation->imageModality);
+    NoiseSourceType::Pointer noiseSource = NoiseSourceType::New();
+    noiseSource->SetReferenceImage(reader->GetOutput());
+    noiseSource->SetRegion(lesionRegion);
+    noiseSource->SetSeed(settings->seed);
+    noiseSource->SetStream(stream);
+    noiseSource->SetSubstream(LesionRandom::NoiseFieldSubstream);
+    noiseSource->SetMean(simulation->mean);
+    noiseSource->SetStandardDeviation(stdev);
+    if (lesionRegion.GetNumberOfPixels() > 0)
+        noiseSource->Update();
+    CastImageType::Pointer deformationMap = noiseSource->GetOutput();
+    deformationMap->DisconnectPipeline();
+    noiseSource = nullptr;
+    if (lesionRegion.GetNumberOfPixels() == 0) {
+        deformationMap->CopyInformation(reader->GetOutput());
+        deformationMap->SetRegions(lesionRegion);
+        deformationMap->Allocate();
+    }
+    ImageIterator defMapIt(deformationMap, lesionRegion);
+
+    //Independent intensity level (DC level) of every lesion, indexed by its label
+    LesionRandom::NormalGenerator normalGenerator(settings->seed, stream, LesionRandom::LesionLevelSubstream);
+    vector<float> DClevel(nLesion+1, 0.0);
+    log<<"Generating lesion ("<<variability<<" standard deviations from the "<<simulation->imageModality<<" lesion database): "<<endl;
+    for (int lesion = 1; lesion <= nLesion; ++lesion) {
+        DClevel[lesion] = static_cast<float>(normalGenerator.GetVariate());
+        while(abs(DClevel[lesion])>variability*stdev){
+            DClevel[lesion] = static_cast<float>(normalGenerator.GetVariate());
         }
+        log<<lesion<<" - Mean intensity: "<<simulation->mean+DClevel[lesion]<<endl;
     }
 
-    typename MaskType::Pointer finalDeformationMap = MaskType::New();
-    finalDeformationMap->SetInput(lesionMaskDeformationMapDCLevel);
-    finalDeformationMap->SetMaskImage(lesionMask->GetOutput());
-    finalDeformationMap->SetOutsideValue(1.0);
+    //Mask deformation map, adding the DC level of each lesion in a single pass: voxels out of
+    //the lesions of this modality are set to 1 so the map does not change them
+    LabelIterator lesionIt(lesionIds, lesionRegion);
+    LabelIterator maskIt(simulation->lesionMask, lesionRegion);
+    for (defMapIt.GoToBegin(), lesionIt.GoToBegin(), maskIt.GoToBegin(); !defMapIt.IsAtEnd(); ++defMapIt, ++lesionIt, ++maskIt) {
+        if (maskIt.Get() > 0 && lesionIt.Get() > 0)
+            defMapIt.Set(defMapIt.Get() + DClevel[lesionIt.Get()]);
+        else
+            defMapIt.Set(1.0);
+    }
 
+    //Smooth lesion borders
     typename SmoothType::Pointer smoothLesions = SmoothType::New();
-    smoothLesions->SetInput(finalDeformationMap->GetOutput());
+    smoothLesions->SetInput(deformationMap);
     smoothLesions->SetSigma(sigma);
-    smoothLesions->Update();
-
+    if (lesionRegion.GetNumberOfPixels() > 0)
+        smoothLesions->Update();
+
+    //Nothing is written if the CLI was cancelled meanwhile
+    if (settings->progress->IsAborted())
+        throw itk::ProcessAborted(__FILE__, __LINE__);
+
+
+    if (settings->deformationMapVolume) {
+        log<<"Output lesion deformation map was requested"<<endl;
+        CastImageType::Pointer fullDeformationMap = CastImageType::New();
+        fullDeformationMap->CopyInformation(reader->GetOutput());
+        fullDeformationMap->SetRegions(reader->GetOutput()->GetLargestPossibleRegion());
+        fullDeformationMap->Allocate();
+        fullDeformationMap->FillBuffer(1.0);
+
+        if (lesionRegion.GetNumberOfPixels() > 0) {
+            ImageIterator fullMapIt(fullDeformationMap, lesionRegion);
+            ImageIterator smoothIt(smoothLesions->GetOutput(), lesionRegion);
+            for (fullMapIt.GoToBegin(), smoothIt.GoToBegin(); !fullMapIt.IsAtEnd(); ++fullMapIt, ++smoothIt)
+                fullMapIt.Set(smoothIt.Get());
+        }
 
-    if (deformationMapVolume) {
-        cout<<"Output lesion deformation map was requested"<<endl;
-        typename DebugWriterType::Pointer deformationMapWriter = DebugWriterType::New();
-        deformationMapWriter->SetFileName( outputVolume.c_str() );
-        deformationMapWriter->SetInput( smoothLesions->GetOutput() );
-        deformationMapWriter->SetUseCompression(1);
-        deformationMapWriter->Update();
+        LesionIO::WriteImage<CastImageType>(fullDeformationMap, simulation->outputVolume, settings->compressionLevel, settings->compressionThreads);
 
-        return EXIT_SUCCESS;
+        return;
     }
 
-    //Effectivelly apply the deformation map over the input image
-    typename MultiplyImageType::Pointer multiply = MultiplyImageType::New();
-    multiply->SetInput1(smoothLesions->GetOutput());
-    multiply->SetInput2(castInput->GetOutput());
-
-    typename CastOutputType::Pointer castOutput = CastOutputType::New();
-    castOutput->SetInput(multiply->GetOutput());
+    if (settings->lowMemory) {
+        //Only the lesion region of the input volume is kept in memory: it is deformed, then pasted
+        //while the input is copied to the output in stream divisions
+        typename OutputImageType::Pointer deformedRegion = OutputImageType::New();
+        deformedRegion->CopyInformation(reader->GetOutput());
+        deformedRegion->SetRegions(lesionRegion);
+        deformedRegion->Allocate();
+
+        if (lesionRegion.GetNumberOfPixels() > 0) {
+            reader->GetOutput()->SetRequestedRegion(lesionRegion);
+            reader->Update();
+
+            InputIterator inputIt(reader->GetOutput(), lesionRegion);
+            OutputIterator outputIt(deformedRegion, lesionRegion);
+            ImageIterator smoothIt(smoothLesions->GetOutput(), lesionRegion);
+            for (inputIt.GoToBegin(), outputIt.GoToBegin(), smoothIt.GoToBegin(); !outputIt.IsAtEnd(); ++inputIt, ++outputIt, ++smoothIt)
+                outputIt.Set(static_cast<OutputPixelType>(smoothIt.Get() * static_cast<float>(inputIt.Get())));
+        }
+        reader = nullptr;
+        smoothLesions = nullptr;
+        deformationMap = nullptr;
+
+        typename ReaderType::Pointer streamReader = ReaderType::New();
+        streamReader->SetFileName( simulation->inputVolume.c_str() );
+
+        typename PasteType::Pointer pasteLesions = PasteType::New();
+        pasteLesions->SetDestinationImage(streamReader->GetOutput());
+        pasteLesions->SetSourceImage(deformedRegion);
+        pasteLesions->SetSourceRegion(lesionRegion);
+        pasteLesions->SetDestinationIndex(lesionRegion.GetIndex());
+
+        //Compressed files cannot be written by parts, so the output is not compressed
+        typename WriterType::Pointer writer = WriterType::New();
+        writer->SetFileName( simulation->outputVolume.c_str() );
+        if (lesionRegion.GetNumberOfPixels() > 0)
+            writer->SetInput( pasteLesions->GetOutput() );
+        else
+            writer->SetInput( streamReader->GetOutput() );
+        writer->SetNumberOfStreamDivisions( settings->streamDivisions );
+        writer->SetUseCompression(0);
+        writer->Update();
+        return;
+    }
 
-    typename WriterType::Pointer writer = WriterType::New();
-    writer->SetFileName( outputVolume.c_str() );
-    writer->SetInput( castOutput->GetOutput() );
-    writer->SetUseCompression(1);
-    writer->Update();
+    //Effectivelly apply the deformation map over the input image, only inside the lesion region
+    typename OutputImageType::Pointer outputImage = reader->GetOutput();
+    outputImage->DisconnectPipeline();
+    if (lesionRegion.GetNumberOfPixels() > 0) {
+        OutputIterator outputIt(outputImage, lesionRegion);
+        ImageIterator smoothIt(smoothLesions->GetOutput(), lesionRegion);
+        for (outputIt.GoToBegin(), smoothIt.GoToBegin(); !outputIt.IsAtEnd(); ++outputIt, ++smoothIt)
+            outputIt.Set(static_cast<OutputPixelType>(smoothIt.Get() * static_cast<float>(outputIt.Get())));
+    }
 
-    return EXIT_SUCCESS;
+    LesionIO::WriteImage<OutputImageType>(outputImage, simulation->outputVolume, settings->compressionLevel, settings->compressionThreads);
 }
 
-} // end of anonymous namespace
-
-int main( int argc, char * argv[] )
+//Simulates the lesions of one modality, dispatching on the pixel type of its input volume.
+//Runs in its own thread, so the messages are kept in the simulation log.
+void RunSimulation(ModalitySimulation* simulation, const LabelInputType* lesionIds, int nLesion,
+                   const SimulationSettings* settings)
 {
-    PARSE_ARGS;
-
     itk::ImageIOBase::IOPixelType     pixelType;
     itk::ImageIOBase::IOComponentType componentType;
 
+    simulation->status = EXIT_SUCCESS;
     try
     {
-        itk::GetImageType(inputVolume, pixelType, componentType);
+        if (settings->progress->IsAborted())
+            throw itk::ProcessAborted(__FILE__, __LINE__);
+        itk::GetImageType(simulation->inputVolume, pixelType, componentType);
 
-        // This filter handles all types on input, but only produces
-        // signed types
         switch( componentType )
         {
         case itk::ImageIOBase::UCHAR:
-            return DoIt( argc, argv, static_cast<unsigned char>(0) );
+            SimulateLesions<unsigned char>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::CHAR:
-            return DoIt( argc, argv, static_cast<char>(0) );
+            SimulateLesions<char>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::USHORT:
-            return DoIt( argc, argv, static_cast<unsigned short>(0) );
+            SimulateLesions<unsigned short>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::SHORT:
-            return DoIt( argc, argv, static_cast<short>(0) );
+            SimulateLesions<short>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::UINT:
-            return DoIt( argc, argv, static_cast<unsigned int>(0) );
+            SimulateLesions<unsigned int>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::INT:
-            return DoIt( argc, argv, static_cast<int>(0) );
+            SimulateLesions<int>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::ULONG:
-            return DoIt( argc, argv, static_cast<unsigned long>(0) );
+            SimulateLesions<unsigned long>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::LONG:
-            return DoIt( argc, argv, static_cast<long>(0) );
+            SimulateLesions<long>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::FLOAT:
-            return DoIt( argc, argv, static_cast<float>(0) );
+            SimulateLesions<float>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::DOUBLE:
-            return DoIt( argc, argv, static_cast<double>(0) );
+            SimulateLesions<double>(simulation, lesionIds, nLesion, settings);
             break;
         case itk::ImageIOBase::UNKNOWNCOMPONENTTYPE:
         default:
-            std::cout << "unknown component type" << std::endl;
+            simulation->log << "unknown component type" << std::endl;
             break;
         }
     }
+    catch( std::exception & excep )
+    {
+        simulation->log << simulation->inputVolume << ": exception caught !" << std::endl;
+        simulation->log << excep.what() << std::endl;
+        simulation->status = EXIT_FAILURE;
+    }
+
+    const size_t finished = ++settings->finishedModalities;
+    settings->progress->SetProgress(0.3 + 0.7*finished/settings->numberOfModalities,
+                                    simulation->imageModality + " lesions simulated");
+}
+
+//Lesions of every modality are simulated in the same run: the connected lesions
+//are labelled once and the modalities are processed in parallel threads
+int DoIt( int argc, char * argv[] )
+{
+    PARSE_ARGS;
+
+    LesionReport::ProgressReporter progress("DeformImage", "Simulating lesions", CLPProcessInformation);
+
+    typedef itk::ImageFileReader<LabelInputType>    LabelReaderType;
+    typedef itk::ImageRegionIterator<LabelInputType>                                    LabelIterator;
+    typedef itk::ConnectedComponentImageFilter<LabelInputType, LabelInputType>          ConnectedType;
+    typedef itk::RelabelComponentImageFilter<LabelInputType, LabelInputType>            RelabelerType;
+
+    const std::string inputVolumes[] = {inputVolume, inputVolume2, inputVolume3, inputVolume4, inputVolume5, inputVolume6};
+    const std::string imageModalities[] = {imageModality, imageModality2, imageModality3, imageModality4, imageModality5, imageModality6};
+    const std::string lesionLabels[] = {lesionLabel, lesionLabel2, lesionLabel3, lesionLabel4, lesionLabel5, lesionLabel6};
+    const std::string outputVolumes[] = {outputVolume, outputVolume2, outputVolume3, outputVolume4, outputVolume5, outputVolume6};
+    const double sigmas[] = {sigma, sigma2, sigma3, sigma4, sigma5, sigma6};
+
+    std::vector< std::unique_ptr<ModalitySimulation> > simulations;
+    for (int i=0; i<6; i++) {
+        if (inputVolumes[i].empty() || lesionLabels[i].empty() || outputVolumes[i].empty())
+            continue;
+        std::unique_ptr<ModalitySimulation> simulation(new ModalitySimulation);
+        simulation->inputVolume = inputVolumes[i];
+        simulation->imageModality = imageModalities[i];
+        simulation->lesionLabel = lesionLabels[i];
+        simulation->outputVolume = outputVolumes[i];
+        simulation->sigma = sigmas[i];
+
+        //Adjusting the Gaussian Lesion Distribution
+        if (imageModalities[i]=="T1") {
+            //Apply deformation: T1 Volume
+            simulation->mean = t1Contrast;
+            simulation->variance = t1Std*t1Std;
+        }else if (imageModalities[i]=="T2") {
+            //Apply deformation: T2 Volume
+            simulation->mean = t2Contrast;
+            simulation->variance = t2Std*t2Std;
+        }else if (imageModalities[i]=="T2-FLAIR") {
+            //Apply deformation: T2-FLAIR Volume
+            simulation->mean = flairContrast;
+            simulation->variance = flairStd*flairStd;
+        }else if (imageModalities[i]=="PD") {
+            //Apply deformation: PD Volume
+            simulation->mean = pdContrast;
+            simulation->variance = pdStd*pdStd;
+        }else if (imageModalities[i]=="DTI-FA") {
+            //Apply deformation: FA Volume
+            simulation->mean = faContrast;
+            simulation->variance = faStd*faStd;
+        }else if (imageModalities[i]=="DTI-ADC") {
+            //Apply deformation: ADC Volume
+            simulation->mean = adcContrast;
+            simulation->variance = adcStd*adcStd;
+        }
+        cout<<"Lesion intensity distribution ("<<simulation->imageModality<<") - Mean: "<<simulation->mean<<" and Variance: "<<simulation->variance<<endl;
+
+        LabelReaderType::Pointer lesionMask = LabelReaderType::New();
+        lesionMask->SetFileName( simulation->lesionLabel.c_str() );
+        lesionMask->Update();
+        simulation->lesionMask = lesionMask->GetOutput();
+
+        simulations.push_back(std::move(simulation));
+    }
+    if (simulations.empty())
+        return EXIT_FAILURE;
+    //The lesion masks are combined voxel by voxel and every input volume is deformed by its own mask
+    const ImageGrid referenceGrid = LabelGrid(simulations[0]->lesionMask);
+    for (size_t s=0; s<simulations.size(); s++) {
+        if (!SameGrid(LabelGrid(simulations[s]->lesionMask), referenceGrid)) {
+            cerr<<"Lesion label "<<simulations[s]->lesionLabel<<" does not match the grid of "<<simulations[0]->lesionLabel<<"."<<endl;
+            return EXIT_FAILURE;
+        }
+        ImageGrid inputGrid;
+        if (!ReadImageGrid(simulations[s]->inputVolume, inputGrid) || !SameGrid(inputGrid, referenceGrid)) {
+            cerr<<"Input volume "<<simulations[s]->inputVolume<<" does not match the lesion label grid."<<endl;
+            return EXIT_FAILURE;
+        }
+    }
+    //Writing by parts is what keeps the memory low, so other formats are rejected instead of buffered
+    if (lowMemory && !deformationMapVolume) {
+        for (size_t s=0; s<simulations.size(); s++) {
+            if (!LesionIO::CanStreamWrite(simulations[s]->outputVolume)) {
+                cerr<<"Low memory mode requires output volumes written by parts, such as .mha files: "
+                    <<simulations[s]->outputVolume<<endl;
+                return EXIT_FAILURE;
+            }
+        }
+    }
+    progress.SetProgress(0.1, "Lesion labels read");
+
+    //The lesion labels of the modalities are filtered versions of the same lesion map, so the
+    //connected lesions are found once on their union and shared by all modalities
+    LabelInputType::Pointer lesionUnion = simulations[0]->lesionMask;
+    if (simulations.size() > 1) {
+        lesionUnion = LabelInputType::New();
+        lesionUnion->CopyInformation(simulations[0]->lesionMask);
+        lesionUnion->SetRegions(simulations[0]->lesionMask->GetBufferedRegion());
+        lesionUnion->Allocate();
+        lesionUnion->FillBuffer(0);
+        for (size_t s=0; s<simulations.size(); s++) {
+            LabelIterator unionIt(lesionUnion, lesionUnion->GetBufferedRegion());
+            LabelIterator maskIt(simulations[s]->lesionMask, lesionUnion->GetBufferedRegion());
+            for (unionIt.GoToBegin(), maskIt.GoToBegin(); !unionIt.IsAtEnd(); ++unionIt, ++maskIt) {
+                if (maskIt.Get() > 0)
+                    unionIt.Set(1);
+            }
+        }
+    }
+
+    //Label every connected lesion, sorted by size
+    ConnectedType::Pointer connectedLesions = ConnectedType::New();
+    connectedLesions->SetInput(lesionUnion);
+    RelabelerType::Pointer sortLesions = RelabelerType::New();
+    sortLesions->SetInput(connectedLesions->GetOutput());
+    sortLesions->SetSortByObjectSize(true);
+    {
+    itk::PluginFilterWatcher watchConnected(connectedLesions, "Labelling connected lesions", CLPProcessInformation, 0.1, 0.1);
+    itk::PluginFilterWatcher watchRelabel(sortLesions, "Sorting lesions by size", CLPProcessInformation, 0.1, 0.2);
+    sortLesions->Update();
+    }
+    int nLesion = sortLesions->GetNumberOfObjects();
+    cout<<"Number of considered lesions: "<<nLesion<<endl;
+
+    LabelInputType::Pointer lesionIds = sortLesions->GetOutput();
+    if (lowMemory) {
+        //Intermediate label images are released before the modalities are processed
+        lesionIds->DisconnectPipeline();
+        sortLesions = nullptr;
+        connectedLesions = nullptr;
+        lesionUnion = nullptr;
+    }
+
+    SimulationSettings settings;
+    settings.variability = variability;
+    settings.seed = static_cast<uint64_t>(seed != 0 ? seed : time(0));
+    cout<<"Random seed: "<<settings.seed<<endl;
+    settings.deformationMapVolume = deformationMapVolume;
+    settings.lowMemory = lowMemory;
+    settings.streamDivisions = std::max(1, streamDivisions);
+    settings.compressionLevel = compressionLevel;
+    //The modalities are compressed at the same time, so they share the processors
+    settings.compressionThreads = lowMemory ? 0 : std::max<unsigned int>(1, std::thread::hardware_concurrency() / simulations.size());
+    settings.progress = &progress;
+    settings.numberOfModalities = simulations.size();
+    settings.finishedModalities = 0;
+
+    //In low memory mode the modalities are processed one at a time
+    int status = EXIT_SUCCESS;
+    std::vector<std::thread> threads;
+    for (size_t s=0; s<simulations.size(); s++) {
+        threads.push_back(std::thread(RunSimulation, simulations[s].get(), lesionIds.GetPointer(), nLesion, &settings));
+        if (lowMemory)
+            threads[s].join();
+    }
+    for (size_t s=0; s<simulations.size(); s++) {
+        if (threads[s].joinable())
+            threads[s].join();
+        cout<<simulations[s]->log.str();
+        if (simulations[s]->status != EXIT_SUCCESS)
+            status = EXIT_FAILURE;
+    }
+
+    double peakMemory = LesionReport::PeakMemoryUsage();
+    cout<<"Peak memory usage: "<<peakMemory<<" MB"<<endl;
+
+    LesionReport::ReturnParameters returnParameters(returnParameterFile);
+    returnParameters.Set("numberOfLesions", nLesion);
+    returnParameters.Set("peakMemoryUsage", peakMemory);
+    return status;
+}
+
+} // end of anonymous namespace
+
+int main( int argc, char * argv[] )
+{
+    PARSE_ARGS;
+
+    try
+    {
+        return DoIt( argc, argv );
+    }
 
     catch( itk::ExceptionObject & excep )
     {
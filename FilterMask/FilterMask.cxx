@@ -17,9 +17,13 @@
 
 #include "itkPluginUtilities.h"
 
-#include <itkStatisticsImageFilter.h>
-#include <itkLabelStatisticsImageFilter.h>
-#include <itkImageRegionIterator.h>
+#include "LesionImageWriter.h"
+#include "LesionExecutionReport.h"
+#include "LesionProgress.h"
+
+#include <memory>
+#include <utility>
+#include <vector>
 
 #include "FilterMaskCLP.h"
 
@@ -31,105 +35,217 @@
 namespace
 {
 
-template <class T>
-int DoIt( int argc, char * argv[], T )
-{
-    PARSE_ARGS;
+typedef unsigned char LabelPixelType;
+typedef itk::Image<LabelPixelType, 3> LabelImageType;
 
-    typedef    T InputPixelType;
-    typedef    unsigned char  LabelPixelType;
+//Input volume filtered by the lesion mask. Voxels are accessed by their
+//offset in the image buffer, so volumes of any pixel type share the same
+//traversal of the mask.
+class FilterInput
+{
+public:
+    FilterInput() : count(0), sum(0), sumOfSquares(0) {}
+    virtual ~FilterInput() {}
 
-    typedef itk::Image<InputPixelType,  3> ImageType;
-    typedef itk::Image<LabelPixelType, 3> LabelImageType;
+    virtual double GetValue(size_t offset) const = 0;
+    virtual itk::ImageRegion<3>::SizeType GetSize() const = 0;
 
-    typedef itk::ImageFileReader<ImageType>  ReaderType;
-    typedef itk::ImageFileReader<LabelImageType>  LabelReaderType;
-    typedef itk::ImageFileWriter<LabelImageType> WriterType;
+    std::string inputVolume;
+    std::string outputVolume;
+    unsigned long count;
+    double sum;
+    double sumOfSquares;
+};
 
-    typename ReaderType::Pointer readerImage = ReaderType::New();
-    typename LabelReaderType::Pointer readerMask = LabelReaderType::New();
+template <class T>
+class TypedFilterInput : public FilterInput
+{
+public:
+    typedef itk::Image<T, 3> ImageType;
 
-    readerImage->SetFileName( inputVolume.c_str() );
+    TypedFilterInput(const std::string& fileName)
+    {
+        typedef itk::ImageFileReader<ImageType> ReaderType;
+        typename ReaderType::Pointer reader = ReaderType::New();
+        reader->SetFileName( fileName.c_str() );
+        reader->Update();
+        m_Image = reader->GetOutput();
+        m_Buffer = m_Image->GetBufferPointer();
+    }
 
-    readerMask->SetFileName( inputMask.c_str() );
+    double GetValue(size_t offset) const
+    {
+        return static_cast<double>(m_Buffer[offset]);
+    }
 
-    typedef itk::StatisticsImageFilter<LabelImageType> StatisticsFilterType;
-    typename StatisticsFilterType::Pointer statistics = StatisticsFilterType::New();
+    itk::ImageRegion<3>::SizeType GetSize() const
+    {
+        return m_Image->GetBufferedRegion().GetSize();
+    }
 
-    //Get initial mask volume
-    statistics->SetInput(readerMask->GetOutput());
-    statistics->Update();
+private:
+    typename ImageType::Pointer m_Image;
+    const T* m_Buffer;
+};
 
-    //Get voxel dimensions for volume calculation
-    const typename LabelImageType::SpacingType& spacing = readerMask->GetOutput()->GetSpacing();
+std::unique_ptr<FilterInput> ReadFilterInput(const std::string& fileName)
+{
+    itk::ImageIOBase::IOPixelType     pixelType;
+    itk::ImageIOBase::IOComponentType componentType;
 
-    double voxelVolume = 1;
-    for (int i=0; i<spacing.GetNumberOfComponents(); i++)
-        voxelVolume *= spacing[i];
+    itk::GetImageType(fileName, pixelType, componentType);
 
-    double initialVolume = statistics->GetSum() * voxelVolume;
-    std::cout<<"Initial volume = "<< initialVolume << std::endl;
+    switch( componentType )
+    {
+        case itk::ImageIOBase::UCHAR:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<unsigned char>(fileName));
+        case itk::ImageIOBase::CHAR:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<char>(fileName));
+        case itk::ImageIOBase::USHORT:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<unsigned short>(fileName));
+        case itk::ImageIOBase::SHORT:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<short>(fileName));
+        case itk::ImageIOBase::UINT:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<unsigned int>(fileName));
+        case itk::ImageIOBase::INT:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<int>(fileName));
+        case itk::ImageIOBase::ULONG:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<unsigned long>(fileName));
+        case itk::ImageIOBase::LONG:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<long>(fileName));
+        case itk::ImageIOBase::FLOAT:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<float>(fileName));
+        case itk::ImageIOBase::DOUBLE:
+        return std::unique_ptr<FilterInput>(new TypedFilterInput<double>(fileName));
+        case itk::ImageIOBase::UNKNOWNCOMPONENTTYPE:
+        default:
+        std::cout << "unknown component type" << std::endl;
+        break;
+    }
+    return std::unique_ptr<FilterInput>();
+}
 
-    //Get distribution descriptive values
-    typedef itk::LabelStatisticsImageFilter<ImageType, LabelImageType> LabelStatisticsFilterType;
-    typename LabelStatisticsFilterType::Pointer labelStatistics = LabelStatisticsFilterType::New();
+//Every input volume is filtered in the same run: the lesion mask is read
+//once and the statistics of all inputs are computed in a single traversal
+//of its lesion voxels
+int DoIt( int argc, char * argv[] )
+{
+    PARSE_ARGS;
 
-    labelStatistics->SetLabelInput(readerMask->GetOutput());
-    labelStatistics->SetInput(readerImage->GetOutput());
-    labelStatistics->Update();
+    LesionReport::ProgressReporter progress("FilterMask", "Filtering lesion mask", CLPProcessInformation);
 
-    int n = labelStatistics->GetNumberOfLabels();
-    float mean = labelStatistics->GetMean(1);
-    float stdev = sqrt(labelStatistics->GetVariance(1));
+    typedef itk::ImageFileReader<LabelImageType>  LabelReaderType;
 
-    std::cout<<"n= "<<n<<"   mean= "<<mean<<"   stdev= "<<stdev<<std::endl;
+    const std::string inputVolumes[] = {inputVolume, inputVolume2, inputVolume3, inputVolume4, inputVolume5, inputVolume6};
+    const std::string outputVolumes[] = {outputVolume, outputVolume2, outputVolume3, outputVolume4, outputVolume5, outputVolume6};
 
-    //Creates new mask image
-    typename LabelImageType::Pointer maskImage = LabelImageType::New();
-    maskImage->CopyInformation(readerMask->GetOutput());
-    maskImage->SetRegions(readerMask->GetOutput()->GetRequestedRegion());
-    maskImage->Allocate();
-    maskImage->FillBuffer(0);
+    LabelReaderType::Pointer readerMask = LabelReaderType::New();
+    readerMask->SetFileName( inputMask.c_str() );
+    {
+    itk::PluginFilterWatcher watchReader(readerMask, "Reading lesion mask", CLPProcessInformation, 0.1, 0);
+    readerMask->Update();
+    }
+    LabelImageType::Pointer mask = readerMask->GetOutput();
+
+    std::vector< std::unique_ptr<FilterInput> > inputs;
+    int status = EXIT_SUCCESS;
+    for (int i=0; i<6; i++) {
+        if (inputVolumes[i].empty() || outputVolumes[i].empty())
+            continue;
+        std::unique_ptr<FilterInput> input = ReadFilterInput(inputVolumes[i]);
+        if (!input || input->GetSize() != mask->GetBufferedRegion().GetSize()) {
+            std::cerr<<"Input volume "<<inputVolumes[i]<<" does not match the lesion mask grid."<<std::endl;
+            status = EXIT_FAILURE;
+            continue;
+        }
+        input->inputVolume = inputVolumes[i];
+        input->outputVolume = outputVolumes[i];
+        inputs.push_back(std::move(input));
+        progress.SetProgress(0.1 + 0.3*(i+1)/6, "Reading input volumes");
+    }
 
-    //Iterates through label map, removing voxels out of the specified range
-    typedef itk::ImageRegionIterator<ImageType> ImageIteratorType;
-    typedef itk::ImageRegionIterator<LabelImageType> LabelIteratorType;
+    //Lesion voxels are listed once by their offset in the image buffer, so
+    //the statistics, thresholds and volumes below only visit the lesion
+    const LabelPixelType* maskBuffer = mask->GetBufferPointer();
+    const size_t numberOfVoxels = mask->GetBufferedRegion().GetNumberOfPixels();
+    std::vector<size_t> lesionVoxels;
+    double maskSum = 0;
+    for (size_t offset=0; offset<numberOfVoxels; offset++) {
+        if (maskBuffer[offset] > 0) {
+            lesionVoxels.push_back(offset);
+            maskSum += maskBuffer[offset];
+        }
+    }
 
-    ImageIteratorType imgIt(readerImage->GetOutput(), readerImage->GetOutput()->GetRequestedRegion());
-    LabelIteratorType lblIt(readerMask->GetOutput(), readerMask->GetOutput()->GetRequestedRegion());
-    LabelIteratorType newIt(maskImage, maskImage->GetRequestedRegion());
+    //Get voxel dimensions for volume calculation
+    const LabelImageType::SpacingType& spacing = mask->GetSpacing();
 
-    lblIt.GoToBegin();
-    float minLimit = mean - cutFactor*stdev;
-    float maxLimit = mean + cutFactor*stdev;
+    double voxelVolume = 1;
+    for (int i=0; i<spacing.GetNumberOfComponents(); i++)
+        voxelVolume *= spacing[i];
 
+    double initialVolume = maskSum * voxelVolume;
+    std::cout<<"Initial volume = "<< initialVolume << std::endl;
 
-    while(!lblIt.IsAtEnd()){
-        if(lblIt.Get()>0){
-            imgIt.SetIndex( lblIt.GetIndex() );
-            if(imgIt.Get() < maxLimit && imgIt.Get() > minLimit){
-                newIt.SetIndex( lblIt.GetIndex() );
-                newIt.Set(1);
+    //Get distribution descriptive values of every input inside the lesion label
+    for (size_t v=0; v<lesionVoxels.size(); v++) {
+        if (maskBuffer[lesionVoxels[v]] == 1) {
+            for (size_t i=0; i<inputs.size(); i++) {
+                const double value = inputs[i]->GetValue(lesionVoxels[v]);
+                inputs[i]->count++;
+                inputs[i]->sum += value;
+                inputs[i]->sumOfSquares += value*value;
             }
         }
-        ++lblIt;
     }
 
-    //Get final mask volume
-    statistics->SetInput(maskImage);
-    statistics->Update();
+    for (size_t i=0; i<inputs.size(); i++) {
+        if (progress.IsAborted()) {
+            status = EXIT_FAILURE;
+            break;
+        }
+        progress.SetProgress(0.4 + 0.6*i/inputs.size(), "Filtering " + inputs[i]->inputVolume);
+        const FilterInput* input = inputs[i].get();
+        const double n = input->count;
+        float mean = n > 0 ? input->sum / n : 0;
+        float stdev = n > 1 ? sqrt((input->sumOfSquares - input->sum*input->sum/n) / (n - 1)) : 0;
+
+        std::cout<<input->inputVolume<<": n= "<<input->count<<"   mean= "<<mean<<"   stdev= "<<stdev<<std::endl;
+
+        //Creates new mask image
+        LabelImageType::Pointer maskImage = LabelImageType::New();
+        maskImage->CopyInformation(mask);
+        maskImage->SetRegions(mask->GetBufferedRegion());
+        maskImage->Allocate();
+        maskImage->FillBuffer(0);
+        LabelPixelType* filteredBuffer = maskImage->GetBufferPointer();
+
+        //Removes lesion voxels out of the specified range
+        float minLimit = mean - cutFactor*stdev;
+        float maxLimit = mean + cutFactor*stdev;
+
+        unsigned long keptVoxels = 0;
+        for (size_t v=0; v<lesionVoxels.size(); v++) {
+            const double value = input->GetValue(lesionVoxels[v]);
+            if (value < maxLimit && value > minLimit) {
+                filteredBuffer[lesionVoxels[v]] = 1;
+                keptVoxels++;
+            }
+        }
+
+        //Get final mask volume
+        double finalVolume = keptVoxels * voxelVolume;
 
-    double finalVolume = statistics->GetSum() * voxelVolume;
+        std::cout<<"Final volume = "<< finalVolume << "  Difference = "<< initialVolume-finalVolume <<std::endl;
 
-    std::cout<<"Final volume = "<< finalVolume << "  Difference = "<< initialVolume-finalVolume <<std::endl;
+        LesionIO::WriteImage<LabelImageType>(maskImage, input->outputVolume, compressionLevel);
+    }
 
-    typename WriterType::Pointer writer = WriterType::New();
-    writer->SetFileName( outputVolume.c_str() );
-    writer->SetInput( maskImage );
-    writer->SetUseCompression(1);
-    writer->Update();
+    progress.SetProgress(1, "Lesion masks written");
 
-    return EXIT_SUCCESS;
+    LesionReport::ReturnParameters returnParameters(returnParameterFile);
+    returnParameters.Set("peakMemoryUsage", LesionReport::PeakMemoryUsage());
+    return status;
 }
 
 } // end of anonymous namespace
@@ -138,52 +254,9 @@ int main( int argc, char * argv[] )
 {
     PARSE_ARGS;
 
-    itk::ImageIOBase::IOPixelType     pixelType;
-    itk::ImageIOBase::IOComponentType componentType;
-
     try
     {
-        itk::GetImageType(inputVolume, pixelType, componentType);
-
-        // This filter handles all types on input, but only produces
-        // signed types
-        switch( componentType )
-        {
-            case itk::ImageIOBase::UCHAR:
-            return DoIt( argc, argv, static_cast<unsigned char>(0) );
-            break;
-            case itk::ImageIOBase::CHAR:
-            return DoIt( argc, argv, static_cast<char>(0) );
-            break;
-            case itk::ImageIOBase::USHORT:
-            return DoIt( argc, argv, static_cast<unsigned short>(0) );
-            break;
-            case itk::ImageIOBase::SHORT:
-            return DoIt( argc, argv, static_cast<short>(0) );
-            break;
-            case itk::ImageIOBase::UINT:
-            return DoIt( argc, argv, static_cast<unsigned int>(0) );
-            break;
-            case itk::ImageIOBase::INT:
-            return DoIt( argc, argv, static_cast<int>(0) );
-            break;
-            case itk::ImageIOBase::ULONG:
-            return DoIt( argc, argv, static_cast<unsigned long>(0) );
-            break;
-            case itk::ImageIOBase::LONG:
-            return DoIt( argc, argv, static_cast<long>(0) );
-            break;
-            case itk::ImageIOBase::FLOAT:
-            return DoIt( argc, argv, static_cast<float>(0) );
-            break;
-            case itk::ImageIOBase::DOUBLE:
-            return DoIt( argc, argv, static_cast<double>(0) );
-            break;
-            case itk::ImageIOBase::UNKNOWNCOMPONENTTYPE:
-            default:
-            std::cout << "unknown component type" << std::endl;
-            break;
-        }
+        return DoIt( argc, argv );
     }
 
     catch( itk::ExceptionObject & excep )
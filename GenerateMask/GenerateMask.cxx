@@ -23,6 +23,16 @@
 
 #include <itkAddImageFilter.h>
 #include <itkStatisticsImageFilter.h>
+#include <itkTimeProbe.h>
+
+#include <itksys/SystemTools.hxx>
+
+#include "LesionAtlasIndex.h"
+#include "LesionLoadSolver.h"
+#include "LesionOccupancyGrid.h"
+#include "LesionImageWriter.h"
+#include "LesionExecutionReport.h"
+#include "LesionProgress.h"
 
 #include <time.h>
 #include <math.h>
@@ -30,6 +40,11 @@
 
 #include <string.h>
 
+#include <algorithm>
+#include <memory>
+#include <mutex>
+#include <random>
+
 // Use an anonymous namespace to keep class types and function names
 // from colliding when module is used as shared object module.  Every
 // thing should be in an anonymous namespace except for the module
@@ -38,11 +53,326 @@
 namespace
 {
 
+//When GenerateMask runs as a shared object module, it stays loaded in the Slicer process between
+//executions, so the lesion atlas index is kept in memory and only read again if its file changes
+struct AtlasIndexCache
+{
+    std::mutex mutex;
+    std::string fileName;
+    long modifiedTime;
+    std::shared_ptr<LesionAtlas::Index> index;
+};
+
+AtlasIndexCache& GetAtlasIndexCache()
+{
+    static AtlasIndexCache cache;
+    return cache;
+}
+
+std::shared_ptr<LesionAtlas::Index> GetCachedAtlasIndex(const std::string& fileName)
+{
+    AtlasIndexCache& cache = GetAtlasIndexCache();
+    std::lock_guard<std::mutex> lock(cache.mutex);
+    if (cache.index && cache.fileName == fileName && itksys::SystemTools::FileExists(fileName.c_str(), true)
+        && cache.modifiedTime == itksys::SystemTools::ModifiedTime(fileName.c_str()))
+        return cache.index;
+    return std::shared_ptr<LesionAtlas::Index>();
+}
+
+void SetCachedAtlasIndex(const std::string& fileName, const std::shared_ptr<LesionAtlas::Index>& index)
+{
+    AtlasIndexCache& cache = GetAtlasIndexCache();
+    std::lock_guard<std::mutex> lock(cache.mutex);
+    cache.fileName = fileName;
+    cache.modifiedTime = itksys::SystemTools::ModifiedTime(fileName.c_str());
+    cache.index = index;
+}
+
+//Grid geometry of an image, as stored in the lesion atlas index
+template <class TImage>
+void GetImageGeometry(const TImage* image, double spacing[3], double origin[3], double direction[9])
+{
+    for (int i=0; i<3; i++) {
+        spacing[i] = image->GetSpacing()[i];
+        origin[i] = image->GetOrigin()[i];
+        for (int j=0; j<3; j++)
+            direction[i*3+j] = image->GetDirection()[i][j];
+    }
+}
+
+//Collects the linear indices of the non-zero voxels of a label volume
+template <class TLabelImage>
+void ExtractLesionVoxels(const TLabelImage* label, std::vector<uint32_t>& voxels)
+{
+    const typename TLabelImage::PixelType* labelBuffer = label->GetBufferPointer();
+    const size_t numberOfPixels = label->GetBufferedRegion().GetNumberOfPixels();
+    voxels.clear();
+    for (size_t i = 0; i < numberOfPixels; ++i) {
+        if (labelBuffer[i] > 0)
+            voxels.push_back(static_cast<uint32_t>(i));
+    }
+}
+
+//Reads every lesion label of the database directory once and packs its voxels
+//into the lesion atlas index
+template <class TLabelReader>
+void BuildLesionAtlasIndex(const std::string& path, const std::string nameArray[], const int infoArray[],
+                           int numberOfSizes, LesionAtlas::Index& atlasIndex,
+                           LesionReport::ProgressReporter& progress, double start, double fraction)
+{
+    typedef typename TLabelReader::OutputImageType LabelImageType;
+
+    typename TLabelReader::Pointer readerLabel = TLabelReader::New();
+    std::vector<uint32_t> voxels;
+    atlasIndex.Clear();
+    int numberOfLesions = 0;
+    for (int size = 0; size < numberOfSizes; ++size)
+        numberOfLesions += infoArray[size];
+    int indexedLesions = 0;
+    for (int size = 0; size < numberOfSizes; ++size) {
+        for (int lesion = 0; lesion < infoArray[size]; ++lesion) {
+            std::stringstream lesionSS;
+            lesionSS << lesion;
+            std::string labelFilePath = path+"/"+nameArray[size]+"/"+lesionSS.str()+".nii.gz";
+            readerLabel->SetFileName(labelFilePath.c_str());
+            readerLabel->Update();
+
+            const typename LabelImageType::SizeType& labelSize = readerLabel->GetOutput()->GetBufferedRegion().GetSize();
+            if (size == 0 && lesion == 0) {
+                uint32_t gridSize[3] = {static_cast<uint32_t>(labelSize[0]), static_cast<uint32_t>(labelSize[1]),
+                                        static_cast<uint32_t>(labelSize[2])};
+                atlasIndex.SetSize(gridSize);
+                double spacing[3], origin[3], direction[9];
+                GetImageGeometry(readerLabel->GetOutput(), spacing, origin, direction);
+                atlasIndex.SetGeometry(spacing, origin, direction);
+            }
+
+            ExtractLesionVoxels(readerLabel->GetOutput(), voxels);
+            atlasIndex.AddLesion(size, voxels);
+
+            if (++indexedLesions % 50 == 0) {
+                progress.CheckAbort();
+                progress.SetProgress(start + fraction*indexedLesions/numberOfLesions, "Building lesion atlas index");
+            }
+        }
+        std::cout<<"Indexed "<<infoArray[size]<<" lesions of size "<<nameArray[size]<<std::endl;
+    }
+
+    std::cout<<"Building lesion conflict graph..."<<std::endl;
+    atlasIndex.BuildConflictGraph();
+}
+
+//Checks that the lesion atlas index holds the lesions of every size of the database
+inline bool IndexesDatabase(const LesionAtlas::Index& atlasIndex, const int infoArray[], int numberOfSizes)
+{
+    if (atlasIndex.GetNumberOfBins() != static_cast<unsigned int>(numberOfSizes))
+        return false;
+    for (int size = 0; size < numberOfSizes; ++size) {
+        if (atlasIndex.GetNumberOfLesions(size) != static_cast<unsigned int>(infoArray[size]))
+            return false;
+    }
+    return true;
+}
+
+//Database lesion handled as a sparse list of voxels
+struct LesionCandidate
+{
+    const uint32_t* voxels;
+    uint32_t voxelCount;
+    uint32_t bboxMin[3];
+    uint32_t bboxMax[3];
+};
+
+//Gives access to the database lesions, either from the packed lesion atlas index
+//or by reading the label volumes of the database directory
+template <class TLabelReader>
+class LesionDatabase
+{
+public:
+    LesionDatabase(const std::string& path, const std::string nameArray[], const LesionAtlas::Index* atlasIndex,
+                   const uint32_t size[3])
+        : m_Path(path), m_NameArray(nameArray), m_AtlasIndex(atlasIndex), m_Reader(TLabelReader::New())
+    {
+        for (int i=0; i<3; i++)
+            m_Size[i] = size[i];
+    }
+
+    //Lesion volumes are only known in advance when the atlas index is used
+    bool HasVolumes() const
+    {
+        return m_AtlasIndex != 0;
+    }
+
+    uint32_t GetLesionVolume(int size, int lesion) const
+    {
+        return m_AtlasIndex->GetLesion(size, lesion).voxelCount;
+    }
+
+    void GetLesion(int size, int lesion, LesionCandidate& candidate)
+    {
+        if (m_AtlasIndex) {
+            const LesionAtlas::LesionRecord& record = m_AtlasIndex->GetLesion(size, lesion);
+            candidate.voxels = m_AtlasIndex->GetVoxels(record);
+            candidate.voxelCount = record.voxelCount;
+            for (int i=0; i<3; i++) {
+                candidate.bboxMin[i] = record.bboxMin[i];
+                candidate.bboxMax[i] = record.bboxMax[i];
+            }
+            return;
+        }
+
+        std::stringstream lesionSS;
+        lesionSS << lesion;
+        //Reads selected lesion label
+        std::string labelFilePath = m_Path+"/"+m_NameArray[size]+"/"+lesionSS.str()+".nii.gz";
+        m_Reader->SetFileName(labelFilePath.c_str());
+        m_Reader->Update();
+
+        ExtractLesionVoxels(m_Reader->GetOutput(), m_Voxels);
+        candidate.voxels = m_Voxels.empty() ? 0 : &m_Voxels[0];
+        candidate.voxelCount = static_cast<uint32_t>(m_Voxels.size());
+        LesionAtlas::ComputeBoundingBox(candidate.voxels, candidate.voxelCount, m_Size, candidate.bboxMin, candidate.bboxMax);
+    }
+
+private:
+    std::string m_Path;
+    const std::string* m_NameArray;
+    const LesionAtlas::Index* m_AtlasIndex;
+    typename TLabelReader::Pointer m_Reader;
+    std::vector<uint32_t> m_Voxels;
+    uint32_t m_Size[3];
+};
+
+template <class TLabelReader>
+struct LesionVolumeLess
+{
+    LesionVolumeLess(const LesionDatabase<TLabelReader>& database, int size) : m_Database(database), m_Size(size) {}
+
+    bool operator()(int a, int b) const
+    {
+        return m_Database.GetLesionVolume(m_Size, a) < m_Database.GetLesionVolume(m_Size, b);
+    }
+
+    const LesionDatabase<TLabelReader>& m_Database;
+    int m_Size;
+};
+
+struct SelectionStatistics
+{
+    unsigned long tried;
+    unsigned long accepted;
+    float load;
+};
+
+//Drawing state of one lesion size. Lesions are drawn following a shuffled order, so each one
+//is drawn at most once. When the lesion volumes are known, the lesions are also sorted by volume
+//to find the smallest lesion that was not drawn yet.
+struct LesionBin
+{
+    std::vector<int> drawOrder;
+    size_t nextDraw;
+    std::vector<int> byVolume;
+    size_t smallestRemaining;
+    std::vector<bool> drawn;
+};
+
+//Randomly adds database lesions to the occupancy grid, from the biggest to the smallest
+//lesion sizes, until the desired lesion load is reached. If a mask buffer is given, the
+//selected lesions are also drawn on it.
+template <class TLabelReader>
+SelectionStatistics FillLesionLoad(float desiredLoad, LesionDatabase<TLabelReader>& database, const int infoArray[],
+                                   const int maxSizeArray[], int numberOfSizes, LesionAtlas::OccupancyGrid& occupancy,
+                                   unsigned char* maskBuffer, std::mt19937& generator, bool verbose)
+{
+    SelectionStatistics statistics = {0, 0, 0.0};
+    LesionCandidate candidate;
+
+    std::vector<LesionBin> bins(numberOfSizes);
+    for (int size = 0; size < numberOfSizes; ++size) {
+        LesionBin& bin = bins[size];
+        bin.drawOrder.resize(infoArray[size]);
+        for (int lesion = 0; lesion < infoArray[size]; ++lesion)
+            bin.drawOrder[lesion] = lesion;
+        std::shuffle(bin.drawOrder.begin(), bin.drawOrder.end(), generator);
+        bin.nextDraw = 0;
+        bin.drawn.assign(infoArray[size], false);
+
+        bin.smallestRemaining = 0;
+        if (database.HasVolumes()) {
+            bin.byVolume = bin.drawOrder;
+            std::stable_sort(bin.byVolume.begin(), bin.byVolume.end(), LesionVolumeLess<TLabelReader>(database, size));
+        }
+    }
+
+    while(statistics.load<desiredLoad){
+        int size = numberOfSizes-1;
+        LesionBin& bin = bins[size];
+        float residualLoad = desiredLoad-statistics.load;
+
+        while(bin.smallestRemaining<bin.byVolume.size() && bin.drawn[bin.byVolume[bin.smallestRemaining]])
+            ++bin.smallestRemaining;
+        bool exhausted = bin.nextDraw>=bin.drawOrder.size();
+        bool nothingFits = database.HasVolumes() &&
+                (bin.smallestRemaining>=bin.byVolume.size() ||
+                 database.GetLesionVolume(size, bin.byVolume[bin.smallestRemaining])>residualLoad);
+
+        //Moves to a smaller lesion size if this one is bigger than needed, if all of its lesions
+        //were already drawn or if none of the remaining ones fits in the residual lesion load
+        if(residualLoad<=maxSizeArray[size] || exhausted || nothingFits){
+            --numberOfSizes;
+            if(numberOfSizes == 0)
+                break;
+            continue;
+        }
+
+        //Choose the next lesion not drawn yet
+        int lesion = bin.drawOrder[bin.nextDraw++];
+        bin.drawn[lesion] = true;
+        database.GetLesion(size, lesion, candidate);
+        ++statistics.tried;
+
+        //Checks if desired lesion load wond be surpassed by too much
+        if(candidate.voxelCount > residualLoad){
+            if(verbose)
+                std::cout<<"can't add selected lesion. Size = "<<size<<" volume = "<< candidate.voxelCount<<std::endl;
+
+            //Without the lesion volumes, stops at the first smallest lesion that does not fit
+            if( size == 0 && !database.HasVolumes() ){
+                if(verbose)
+                    std::cout<<"breaking"<<std::endl;
+                break;
+            }
+            continue;
+        }
+
+        //Checks if lesion is going to overlap another already selected lesion
+        if(size<4 && occupancy.Overlaps(candidate.voxels, candidate.voxelCount, candidate.bboxMin, candidate.bboxMax))
+            continue;
+
+        //Adds label to mask
+        statistics.load += occupancy.Insert(candidate.voxels, candidate.voxelCount);
+        if(maskBuffer){
+            for(uint32_t v=0; v<candidate.voxelCount; ++v)
+                maskBuffer[candidate.voxels[v]] = 1;
+        }
+        ++statistics.accepted;
+
+        if(verbose){
+            std::cout<<"size = "<<size<<"    lesion = "<<lesion<<std::endl;
+            std::cout<<"current lesion load = "<<statistics.load<<"  desired lesion load = "<<desiredLoad<<std::endl;
+        }
+    }
+
+    return statistics;
+}
+
 template <class T>
 int DoIt( int argc, char * argv[], T )
 {
     PARSE_ARGS;
 
+    LesionReport::ProgressReporter progress("GenerateMask", "Generating lesion mask", CLPProcessInformation);
+
     typedef    T InputPixelType;
     typedef    unsigned char  LabelPixelType;
 
@@ -51,15 +381,15 @@ int DoIt( int argc, char * argv[], T )
 
     typedef itk::ImageFileReader<ImageType>  ReaderType;
     typedef itk::ImageFileReader<LabelImageType>  LabelReaderType;
-    typedef itk::ImageFileWriter<LabelImageType> WriterType;
 
     typename ReaderType::Pointer readerProb = ReaderType::New();
-    typename LabelReaderType::Pointer readerLabel = LabelReaderType::New();
 
     readerProb->SetFileName( inputVolume.c_str() );
     readerProb->ReleaseDataFlagOn();
-
+    {
+    itk::PluginFilterWatcher watchReader(readerProb, "Reading input volume", CLPProcessInformation, 0.05, 0);
     readerProb->Update();
+    }
 
     //Prepare information constants and arrays
     std::string path = databasePath;
@@ -68,10 +398,92 @@ int DoIt( int argc, char * argv[], T )
     int maxSizeArray [5] = {100, 500, 1000, 5000, 15000};
     std::string nameArray [5] = {"50-100", "100-500", "500-1000", "1000-5000", "5000-more"};
 
+    const typename ImageType::SizeType& inputSize = readerProb->GetOutput()->GetBufferedRegion().GetSize();
+    uint32_t gridSize[3] = {static_cast<uint32_t>(inputSize[0]), static_cast<uint32_t>(inputSize[1]),
+                            static_cast<uint32_t>(inputSize[2])};
+
+    //Loads the packed lesion atlas index, building it from the database directory if needed.
+    //When no index is given, or it does not match the input grid, lesions are read from the directory.
+    std::shared_ptr<LesionAtlas::Index> atlasIndexPointer;
+    if (!lesionIndex.empty())
+        atlasIndexPointer = GetCachedAtlasIndex(lesionIndex);
+    const bool cachedAtlasIndex = static_cast<bool>(atlasIndexPointer);
+    if (!cachedAtlasIndex)
+        atlasIndexPointer = std::make_shared<LesionAtlas::Index>();
+    LesionAtlas::Index& atlasIndex = *atlasIndexPointer;
+
+    bool useAtlasIndex = false;
+    if (!lesionIndex.empty()) {
+        if (cachedAtlasIndex) {
+            std::cout<<"Using the lesion atlas index kept in memory: "<<lesionIndex<<std::endl;
+            useAtlasIndex = true;
+        }else if (itksys::SystemTools::FileExists(lesionIndex.c_str(), true) && atlasIndex.Read(lesionIndex)
+                  && IndexesDatabase(atlasIndex, infoArray, numberOfSizes)) {
+            SetCachedAtlasIndex(lesionIndex, atlasIndexPointer);
+            useAtlasIndex = true;
+        }else{
+            std::cout<<"Building lesion atlas index: "<<lesionIndex<<std::endl;
+            BuildLesionAtlasIndex<LabelReaderType>(path, nameArray, infoArray, numberOfSizes, atlasIndex, progress, 0.05, 0.55);
+            if (atlasIndex.Write(lesionIndex))
+                SetCachedAtlasIndex(lesionIndex, atlasIndexPointer);
+            else
+                std::cout<<"Could not write lesion atlas index. It will be rebuilt on the next run."<<std::endl;
+            useAtlasIndex = true;
+        }
+
+        //The index must be built on the grid of the input volume, not only of the same size
+        double gridSpacing[3], gridOrigin[3], gridDirection[9];
+        GetImageGeometry(readerProb->GetOutput(), gridSpacing, gridOrigin, gridDirection);
+        if (!atlasIndex.HasGrid(gridSize, gridSpacing, gridOrigin, gridDirection))
+            useAtlasIndex = false;
+        if (!useAtlasIndex)
+            std::cout<<"Lesion atlas index does not match the input volume grid. Reading lesions from "<<path<<std::endl;
+    }
+    LesionDatabase<LabelReaderType> database(path, nameArray, useAtlasIndex ? &atlasIndex : 0, gridSize);
+    progress.CheckAbort();
+    progress.SetProgress(0.6, "Selecting lesions");
+
     //Prepare constants to use in calculation
     float desiredLoad = lesionLoad*1000; //Converts from ml to mm^3
-    srand(time(0)); //Initializes random seed
-    float currentLoad=0.0; //Initializes load counter
+    const unsigned int generatorSeed = static_cast<unsigned int>(seed != 0 ? seed : time(0));
+    std::mt19937 generator(generatorSeed); //Initializes random seed
+
+    LesionAtlas::OccupancyGrid occupancy;
+    occupancy.Initialize(gridSize);
+
+    uint64_t tolerance = static_cast<uint64_t>(loadTolerance*1000); //Converts from ml to mm^3
+    LesionAtlas::LesionLoadSolver solver(atlasIndex, maxSizeArray);
+
+    //Reports how many candidate lesions per second are evaluated for reference lesion loads
+    if (benchmark) {
+        //The benchmark draws its own random numbers, so that it does not change the lesion map of the seed
+        std::mt19937 benchmarkGenerator(generatorSeed ^ 0x9e3779b9u);
+        const float benchmarkLoads[3] = {5, 10, 50};
+        for (int b = 0; b < 3; ++b) {
+            occupancy.Clear();
+            itk::TimeProbe clock;
+            clock.Start();
+            SelectionStatistics benchmarkStatistics = FillLesionLoad(benchmarkLoads[b]*1000, database, infoArray, maxSizeArray,
+                                                                     numberOfSizes, occupancy, 0, benchmarkGenerator, false);
+            clock.Stop();
+            double elapsed = clock.GetTotal();
+            std::cout<<"Benchmark (random draws) - lesion load: "<<benchmarkLoads[b]<<" mL   candidates tried: "<<benchmarkStatistics.tried
+                     <<"   accepted: "<<benchmarkStatistics.accepted<<"   time: "<<elapsed<<" s   candidates per second: "
+                     <<(elapsed > 0 ? benchmarkStatistics.tried/elapsed : 0)<<std::endl;
+
+            if (useAtlasIndex) {
+                itk::TimeProbe solverClock;
+                solverClock.Start();
+                LesionAtlas::Selection benchmarkSelection = solver.Solve(static_cast<uint64_t>(benchmarkLoads[b]*1000), tolerance, benchmarkGenerator);
+                solverClock.Stop();
+                elapsed = solverClock.GetTotal();
+                std::cout<<"Benchmark (load solver) - lesion load: "<<benchmarkLoads[b]<<" mL   candidates tried: "<<benchmarkSelection.tried
+                         <<"   accepted: "<<benchmarkSelection.lesions.size()<<"   volume: "<<benchmarkSelection.volume<<"   time: "
+                         <<elapsed<<" s   candidates per second: "<<(elapsed > 0 ? benchmarkSelection.tried/elapsed : 0)<<std::endl;
+            }
+        }
+        occupancy.Clear();
+    }
 
     //Creates mask image
     typename LabelImageType::Pointer maskImage = LabelImageType::New();
@@ -80,108 +492,51 @@ int DoIt( int argc, char * argv[], T )
     maskImage->Allocate();
     maskImage->FillBuffer(0);
 
-    typedef itk::ImageRegionIterator<LabelImageType> LabelIteratorType;
-    LabelIteratorType maskIt(maskImage, maskImage->GetRequestedRegion());
+    unsigned long candidatesTried = 0;
+    unsigned long numberOfLesions = 0;
+    if (useAtlasIndex) {
+        //Selects non-overlapping lesions matching the desired lesion load within the tolerance
+        uint64_t desiredVolume = static_cast<uint64_t>(desiredLoad);
+        LesionAtlas::Selection selection = solver.Solve(desiredVolume, tolerance, generator);
+        LabelPixelType* maskBuffer = maskImage->GetBufferPointer();
+        for (size_t l = 0; l < selection.lesions.size(); ++l) {
+            const LesionAtlas::LesionRecord& record = atlasIndex.GetLesion(selection.lesions[l]);
+            const uint32_t* voxels = atlasIndex.GetVoxels(record);
+            for (uint32_t v = 0; v < record.voxelCount; ++v)
+                maskBuffer[voxels[v]] = 1;
+            std::cout<<"size = "<<record.bin<<"    lesion = "<<record.id<<"    volume = "<<record.voxelCount<<std::endl;
+        }
+        std::cout<<"Selected "<<selection.lesions.size()<<" lesions out of "<<selection.tried<<" candidates"<<std::endl;
+        candidatesTried = selection.tried;
+        numberOfLesions = static_cast<unsigned long>(selection.lesions.size());
+
+        uint64_t difference = selection.volume > desiredVolume ? selection.volume - desiredVolume : desiredVolume - selection.volume;
+        if (difference > tolerance)
+            std::cout<<"Desired lesion load could not be reached within the tolerance. Difference = "<<difference<<std::endl;
+    }else{
+        SelectionStatistics selectionStatistics = FillLesionLoad(desiredLoad, database, infoArray, maxSizeArray, numberOfSizes,
+                                                                 occupancy, maskImage->GetBufferPointer(), generator, true);
+        candidatesTried = selectionStatistics.tried;
+        numberOfLesions = selectionStatistics.accepted;
+    }
+    progress.CheckAbort();
+    progress.SetProgress(0.9, "Writing lesion mask");
 
     typedef itk::StatisticsImageFilter<LabelImageType> LabelStatisticsFilterType;
     typename LabelStatisticsFilterType::Pointer statistics = LabelStatisticsFilterType::New();
-
-    /**TODO
-     * - Seems to be taking a little to long to do. Try to optmize it
-     * - Change it so same lesion cannot be selected more than once
-     * - Interrupts the search of that size if all lesios were searched and no match was found
-    **/
-    int count = 0;//If this counter reaches a specific number, reduces the size of the search
-    while(currentLoad<desiredLoad){
-        int size = numberOfSizes-1;
-        bool okToSearch = true;
-        //Checks if it is trying to get a lesion from a bigger category than it should
-
-        if((desiredLoad-currentLoad)<=maxSizeArray[size] || count>=infoArray[size]){
-            --numberOfSizes;
-            count=0;
-            if(numberOfSizes == 0)
-                break;
-            okToSearch = false;
-        }
-        if(okToSearch){
-            //Choose one of the available lesions
-            int lesion = rand() % infoArray[size];
-            std::stringstream lesionSS;
-            lesionSS << lesion;
-            //Reads selected lesion label
-            std::string labelFilePath = path+"/"+nameArray[size]+"/"+lesionSS.str()+".nii.gz";
-            readerLabel->SetFileName(labelFilePath.c_str());
-            readerLabel->Update();
-
-            LabelIteratorType labelIt(readerLabel->GetOutput(), readerLabel->GetOutput()->GetRequestedRegion());
-
-            //Checks if desired lesion load wond be surpassed by too much
-            bool satisfyLesionLoad = true;
-            int loadToAdd = 0;
-
-            statistics->SetInput(readerLabel->GetOutput());
-            statistics->Update();
-            loadToAdd = statistics->GetSum();
-
-            if(currentLoad + loadToAdd > desiredLoad){
-                satisfyLesionLoad = false;
-                std::cout<<"can't add selected lesion. Size = "<<size<<" volume = "<< loadToAdd<<std::endl;
-
-                if( size == 0 ){
-                    currentLoad=desiredLoad+1;
-                    std::cout<<"breaking"<<std::endl;
-                    break;
-                }
-            }
-
-            //Checks if lesion is going to overlap another already selected lesion
-            bool wontOverlap = true;
-
-            if(size<4){
-                labelIt.GoToBegin();
-                while(!labelIt.IsAtEnd()){
-                    if(labelIt.Get()>0){
-                        maskIt.SetIndex(labelIt.GetIndex());
-                        if(maskIt.Get()>0){
-                            wontOverlap = false;
-                            break;
-                        }
-                    }
-                    ++labelIt;
-                }
-            }
-
-            if(wontOverlap && satisfyLesionLoad){
-                //Adds label to mask
-                labelIt.GoToBegin();
-                while(!labelIt.IsAtEnd()){
-                    maskIt.SetIndex(labelIt.GetIndex());
-                    if(labelIt.Get()>0 && maskIt.Get()==0){
-                        maskIt.Set(labelIt.Get());
-                        ++currentLoad;
-                    }
-                    ++labelIt;
-                }
-
-                std::cout<<"size = "<<size<<"    lesion = "<<lesion<<std::endl;
-                std::cout<<"current lesion load = "<<currentLoad<<"  desired lesion load = "<<desiredLoad<<std::endl;
-            }else
-                ++count;
-
-        }
-    }
     statistics->SetInput(maskImage);
     statistics->Update();
 
     std::cout<<"Final volume = "<< statistics->GetSum() << std::endl;
 
-    typename WriterType::Pointer writer = WriterType::New();
+    LesionIO::WriteImage<LabelImageType>(maskImage, outputVolume, compressionLevel);
+    progress.SetProgress(1, "Lesion mask written");
 
-    writer->SetFileName( outputVolume.c_str() );
-    writer->SetInput( maskImage );
-    writer->SetUseCompression(1);
-    writer->Update();
+    LesionReport::ReturnParameters returnParameters(returnParameterFile);
+    returnParameters.Set("candidatesTried", candidatesTried);
+    returnParameters.Set("candidatesRejected", candidatesTried - numberOfLesions);
+    returnParameters.Set("numberOfLesions", numberOfLesions);
+    returnParameters.Set("peakMemoryUsage", LesionReport::PeakMemoryUsage());
 
     return EXIT_SUCCESS;
 }
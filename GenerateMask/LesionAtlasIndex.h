@@ -0,0 +1,441 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef LesionAtlasIndex_h
+#define LesionAtlasIndex_h
+
+#include <stdint.h>
+
+#include <cmath>
+#include <fstream>
+#include <string>
+#include <vector>
+
+/**
+ * Packed representation of the MS lesion label database.
+ *
+ * Every lesion of the labels-database directory is stored as the sorted list
+ * of the linear indices of its voxels in the MNI152 grid, together with its
+ * bounding box and voxel count. The geometry of the grid (size, spacing,
+ * origin and direction) is kept in the header. The whole database is kept in a single file,
+ * which is read once by GenerateMask instead of decompressing one full
+ * volume per candidate lesion.
+ *
+ * The index also holds the conflict graph of the database, i.e. for every
+ * lesion, the list of the other lesions sharing at least one voxel with it.
+ */
+namespace LesionAtlas
+{
+
+struct LesionRecord
+{
+    uint32_t bin;
+    uint32_t id;
+    uint32_t voxelCount;
+    uint32_t bboxMin[3];
+    uint32_t bboxMax[3];
+    uint64_t offset;
+    uint32_t conflictCount;
+    uint64_t conflictOffset;
+};
+
+//Computes the bounding box, in grid indices, of a list of linear voxel indices
+inline void ComputeBoundingBox(const uint32_t* voxels, uint32_t voxelCount, const uint32_t size[3],
+                               uint32_t bboxMin[3], uint32_t bboxMax[3])
+{
+    for (int i=0; i<3; i++) {
+        bboxMin[i] = voxelCount == 0 ? 0 : size[i];
+        bboxMax[i] = 0;
+    }
+    for (uint32_t v=0; v<voxelCount; v++) {
+        uint32_t index[3];
+        index[0] = voxels[v] % size[0];
+        index[1] = (voxels[v] / size[0]) % size[1];
+        index[2] = voxels[v] / (size[0]*size[1]);
+        for (int i=0; i<3; i++) {
+            if (index[i] < bboxMin[i])
+                bboxMin[i] = index[i];
+            if (index[i] > bboxMax[i])
+                bboxMax[i] = index[i];
+        }
+    }
+}
+
+class Index
+{
+public:
+    Index()
+    {
+        m_Size[0] = m_Size[1] = m_Size[2] = 0;
+        for (int i=0; i<3; i++) {
+            m_Spacing[i] = 1;
+            m_Origin[i] = 0;
+            for (int j=0; j<3; j++)
+                m_Direction[i*3+j] = i == j ? 1 : 0;
+        }
+    }
+
+    void Clear()
+    {
+        m_BinFirst.clear();
+        m_BinCount.clear();
+        m_Lesions.clear();
+        m_Voxels.clear();
+        m_Conflicts.clear();
+    }
+
+    void SetSize(const uint32_t size[3])
+    {
+        for (int i=0; i<3; i++)
+            m_Size[i] = size[i];
+    }
+
+    const uint32_t* GetSize() const
+    {
+        return m_Size;
+    }
+
+    //Direction is given row by row
+    void SetGeometry(const double spacing[3], const double origin[3], const double direction[9])
+    {
+        for (int i=0; i<3; i++) {
+            m_Spacing[i] = spacing[i];
+            m_Origin[i] = origin[i];
+        }
+        for (int i=0; i<9; i++)
+            m_Direction[i] = direction[i];
+    }
+
+    //Checks if the index was built on the given grid. Spacing and origin are compared
+    //up to a fraction of the voxel size, as ITK does for the physical space of images.
+    bool HasGrid(const uint32_t size[3], const double spacing[3], const double origin[3], const double direction[9]) const
+    {
+        const double tolerance = 1e-4;
+        for (int i=0; i<3; i++) {
+            if (m_Size[i] != size[i])
+                return false;
+            if (std::fabs(m_Spacing[i] - spacing[i]) > tolerance*std::fabs(m_Spacing[i]))
+                return false;
+            if (std::fabs(m_Origin[i] - origin[i]) > tolerance*std::fabs(m_Spacing[i]))
+                return false;
+        }
+        for (int i=0; i<9; i++) {
+            if (std::fabs(m_Direction[i] - direction[i]) > tolerance)
+                return false;
+        }
+        return true;
+    }
+
+    unsigned int GetNumberOfBins() const
+    {
+        return static_cast<unsigned int>(m_BinCount.size());
+    }
+
+    unsigned int GetNumberOfLesions(unsigned int bin) const
+    {
+        return bin < m_BinCount.size() ? m_BinCount[bin] : 0;
+    }
+
+    const LesionRecord& GetLesion(unsigned int bin, unsigned int id) const
+    {
+        return m_Lesions[m_BinFirst[bin] + id];
+    }
+
+    //Lesions are also addressed by a global id, running over all bins
+    unsigned int GetNumberOfLesions() const
+    {
+        return static_cast<unsigned int>(m_Lesions.size());
+    }
+
+    unsigned int GetGlobalId(unsigned int bin, unsigned int id) const
+    {
+        return m_BinFirst[bin] + id;
+    }
+
+    const LesionRecord& GetLesion(unsigned int globalId) const
+    {
+        return m_Lesions[globalId];
+    }
+
+    const uint32_t* GetVoxels(const LesionRecord& lesion) const
+    {
+        return m_Voxels.empty() ? 0 : &m_Voxels[0] + lesion.offset;
+    }
+
+    //Global ids of the lesions overlapping the given one
+    const uint32_t* GetConflicts(const LesionRecord& lesion) const
+    {
+        return m_Conflicts.empty() ? 0 : &m_Conflicts[0] + lesion.conflictOffset;
+    }
+
+    //Appends a lesion given the sorted linear indices of its voxels. Lesions
+    //must be added bin by bin, with consecutive ids starting at zero.
+    void AddLesion(unsigned int bin, const std::vector<uint32_t>& voxels)
+    {
+        while (m_BinCount.size() <= bin) {
+            m_BinFirst.push_back(static_cast<uint32_t>(m_Lesions.size()));
+            m_BinCount.push_back(0);
+        }
+
+        LesionRecord lesion;
+        lesion.bin = bin;
+        lesion.id = m_BinCount[bin];
+        lesion.voxelCount = static_cast<uint32_t>(voxels.size());
+        lesion.offset = m_Voxels.size();
+        lesion.conflictCount = 0;
+        lesion.conflictOffset = 0;
+        ComputeBoundingBox(voxels.empty() ? 0 : &voxels[0], lesion.voxelCount, m_Size, lesion.bboxMin, lesion.bboxMax);
+
+        m_Voxels.insert(m_Voxels.end(), voxels.begin(), voxels.end());
+        m_Lesions.push_back(lesion);
+        ++m_BinCount[bin];
+    }
+
+    //Finds every pair of overlapping lesions. Must be called after all lesions were added.
+    void BuildConflictGraph()
+    {
+        std::vector< std::vector<uint32_t> > conflicts(m_Lesions.size());
+        for (size_t a=0; a<m_Lesions.size(); a++) {
+            for (size_t b=a+1; b<m_Lesions.size(); b++) {
+                if (Overlap(m_Lesions[a], m_Lesions[b])) {
+                    conflicts[a].push_back(static_cast<uint32_t>(b));
+                    conflicts[b].push_back(static_cast<uint32_t>(a));
+                }
+            }
+        }
+
+        m_Conflicts.clear();
+        for (size_t l=0; l<m_Lesions.size(); l++) {
+            m_Lesions[l].conflictCount = static_cast<uint32_t>(conflicts[l].size());
+            m_Lesions[l].conflictOffset = m_Conflicts.size();
+            m_Conflicts.insert(m_Conflicts.end(), conflicts[l].begin(), conflicts[l].end());
+        }
+    }
+
+    bool Write(const std::string& fileName) const
+    {
+        std::ofstream file(fileName.c_str(), std::ios::out | std::ios::binary);
+        if (!file)
+            return false;
+
+        file.write(Magic(), 8);
+        WriteValue(file, Version());
+        for (int i=0; i<3; i++)
+            WriteValue(file, m_Size[i]);
+        for (int i=0; i<3; i++)
+            WriteValue(file, m_Spacing[i]);
+        for (int i=0; i<3; i++)
+            WriteValue(file, m_Origin[i]);
+        for (int i=0; i<9; i++)
+            WriteValue(file, m_Direction[i]);
+
+        WriteValue(file, static_cast<uint32_t>(m_BinCount.size()));
+        for (size_t b=0; b<m_BinCount.size(); b++)
+            WriteValue(file, m_BinCount[b]);
+
+        for (size_t l=0; l<m_Lesions.size(); l++) {
+            const LesionRecord& lesion = m_Lesions[l];
+            WriteValue(file, lesion.voxelCount);
+            for (int i=0; i<3; i++)
+                WriteValue(file, lesion.bboxMin[i]);
+            for (int i=0; i<3; i++)
+                WriteValue(file, lesion.bboxMax[i]);
+        }
+
+        if (!m_Voxels.empty())
+            file.write(reinterpret_cast<const char*>(&m_Voxels[0]), m_Voxels.size()*sizeof(uint32_t));
+
+        for (size_t l=0; l<m_Lesions.size(); l++)
+            WriteValue(file, m_Lesions[l].conflictCount);
+        if (!m_Conflicts.empty())
+            file.write(reinterpret_cast<const char*>(&m_Conflicts[0]), m_Conflicts.size()*sizeof(uint32_t));
+
+        return file.good();
+    }
+
+    //Reads an index written by Write. Returns false, leaving the index empty, if
+    //the file is truncated or holds values out of range, e.g. voxels outside of
+    //the grid or conflicts with unknown lesions.
+    bool Read(const std::string& fileName)
+    {
+        Clear();
+        std::ifstream file(fileName.c_str(), std::ios::in | std::ios::binary);
+        if (!file)
+            return false;
+        file.seekg(0, std::ios::end);
+        const uint64_t fileSize = static_cast<uint64_t>(file.tellg());
+        file.seekg(0, std::ios::beg);
+
+        char magic[8];
+        uint32_t version = 0;
+        file.read(magic, 8);
+        ReadValue(file, version);
+        if (!file || std::string(magic, 8) != std::string(Magic(), 8) || version != Version())
+            return false;
+
+        uint64_t numberOfGridVoxels = 1;
+        for (int i=0; i<3; i++) {
+            ReadValue(file, m_Size[i]);
+            numberOfGridVoxels *= m_Size[i];
+        }
+        //Voxels are stored as 32 bit linear indices
+        if (!file || numberOfGridVoxels == 0 || numberOfGridVoxels > (uint64_t(1) << 32))
+            return Fail();
+        for (int i=0; i<3; i++)
+            ReadValue(file, m_Spacing[i]);
+        for (int i=0; i<3; i++)
+            ReadValue(file, m_Origin[i]);
+        for (int i=0; i<9; i++)
+            ReadValue(file, m_Direction[i]);
+
+        uint32_t numberOfBins = 0;
+        ReadValue(file, numberOfBins);
+        if (!file || numberOfBins == 0 || numberOfBins > MaximumNumberOfBins())
+            return Fail();
+        m_BinCount.resize(numberOfBins);
+        m_BinFirst.resize(numberOfBins);
+        uint64_t numberOfLesions = 0;
+        for (uint32_t b=0; b<numberOfBins; b++) {
+            ReadValue(file, m_BinCount[b]);
+            m_BinFirst[b] = static_cast<uint32_t>(numberOfLesions);
+            numberOfLesions += m_BinCount[b];
+        }
+        //Every lesion record takes 7 values, which bounds the number of lesions by the file size
+        if (!file || numberOfLesions*7*sizeof(uint32_t) > fileSize - static_cast<uint64_t>(file.tellg()))
+            return Fail();
+
+        m_Lesions.resize(numberOfLesions);
+        uint64_t numberOfVoxels = 0;
+        for (uint32_t b=0; b<numberOfBins; b++) {
+            for (uint32_t id=0; id<m_BinCount[b]; id++) {
+                LesionRecord& lesion = m_Lesions[m_BinFirst[b] + id];
+                lesion.bin = b;
+                lesion.id = id;
+                ReadValue(file, lesion.voxelCount);
+                for (int i=0; i<3; i++)
+                    ReadValue(file, lesion.bboxMin[i]);
+                for (int i=0; i<3; i++)
+                    ReadValue(file, lesion.bboxMax[i]);
+                for (int i=0; i<3; i++) {
+                    if (lesion.bboxMax[i] >= m_Size[i])
+                        return Fail();
+                }
+                lesion.offset = numberOfVoxels;
+                numberOfVoxels += lesion.voxelCount;
+            }
+        }
+        if (!file || numberOfVoxels*sizeof(uint32_t) > fileSize - static_cast<uint64_t>(file.tellg()))
+            return Fail();
+
+        m_Voxels.resize(numberOfVoxels);
+        if (numberOfVoxels > 0)
+            file.read(reinterpret_cast<char*>(&m_Voxels[0]), numberOfVoxels*sizeof(uint32_t));
+        for (uint64_t v=0; v<numberOfVoxels; v++) {
+            if (m_Voxels[v] >= numberOfGridVoxels)
+                return Fail();
+        }
+
+        uint64_t numberOfConflicts = 0;
+        for (size_t l=0; l<m_Lesions.size(); l++) {
+            ReadValue(file, m_Lesions[l].conflictCount);
+            m_Lesions[l].conflictOffset = numberOfConflicts;
+            numberOfConflicts += m_Lesions[l].conflictCount;
+        }
+        if (!file || numberOfConflicts*sizeof(uint32_t) != fileSize - static_cast<uint64_t>(file.tellg()))
+            return Fail();
+        m_Conflicts.resize(numberOfConflicts);
+        if (numberOfConflicts > 0)
+            file.read(reinterpret_cast<char*>(&m_Conflicts[0]), numberOfConflicts*sizeof(uint32_t));
+        for (uint64_t c=0; c<numberOfConflicts; c++) {
+            if (m_Conflicts[c] >= numberOfLesions)
+                return Fail();
+        }
+
+        if (!file)
+            return Fail();
+        return true;
+    }
+
+private:
+    static const char* Magic()
+    {
+        return "LSIMIDX";
+    }
+
+    static uint32_t Version()
+    {
+        return 3;
+    }
+
+    //Bound of the number of lesion sizes of a valid index file
+    static uint32_t MaximumNumberOfBins()
+    {
+        return 256;
+    }
+
+    bool Fail()
+    {
+        Clear();
+        return false;
+    }
+
+    //Checks if two lesions share any voxel, merging their sorted voxel lists
+    bool Overlap(const LesionRecord& a, const LesionRecord& b) const
+    {
+        for (int i=0; i<3; i++) {
+            if (a.bboxMax[i] < b.bboxMin[i] || b.bboxMax[i] < a.bboxMin[i])
+                return false;
+        }
+
+        const uint32_t* voxelsA = GetVoxels(a);
+        const uint32_t* voxelsB = GetVoxels(b);
+        uint32_t i = 0, j = 0;
+        while (i < a.voxelCount && j < b.voxelCount) {
+            if (voxelsA[i] == voxelsB[j])
+                return true;
+            if (voxelsA[i] < voxelsB[j])
+                ++i;
+            else
+                ++j;
+        }
+        return false;
+    }
+
+    template <class TValue>
+    static void WriteValue(std::ofstream& file, const TValue& value)
+    {
+        file.write(reinterpret_cast<const char*>(&value), sizeof(TValue));
+    }
+
+    template <class TValue>
+    static void ReadValue(std::ifstream& file, TValue& value)
+    {
+        file.read(reinterpret_cast<char*>(&value), sizeof(TValue));
+    }
+
+    uint32_t m_Size[3];
+    double m_Spacing[3];
+    double m_Origin[3];
+    double m_Direction[9];
+    std::vector<uint32_t> m_BinFirst;
+    std::vector<uint32_t> m_BinCount;
+    std::vector<LesionRecord> m_Lesions;
+    std::vector<uint32_t> m_Voxels;
+    std::vector<uint32_t> m_Conflicts;
+};
+
+} // end of namespace LesionAtlas
+
+#endif
@@ -0,0 +1,206 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef LesionLoadSolver_h
+#define LesionLoadSolver_h
+
+#include "LesionAtlasIndex.h"
+
+#include <algorithm>
+#include <random>
+#include <unordered_set>
+#include <vector>
+
+namespace LesionAtlas
+{
+
+struct Selection
+{
+    std::vector<uint32_t> lesions;
+    uint64_t volume;
+    unsigned long tried;
+};
+
+/**
+ * Selects a set of non-overlapping lesions of the atlas index whose total
+ * volume matches the desired lesion load within the given tolerance (both in
+ * voxels).
+ *
+ * Lesions are first drawn at random from the biggest to the smallest sizes,
+ * moving to a smaller size once the residual load is not bigger than the
+ * maximum volume of the current one (maxSizeArray). As in the lesion draws
+ * without index, the lesions of the biggest size may overlap each other: the
+ * load only grows by their voxels not selected yet. The residual load left is
+ * then closed with a randomized subset-sum over the remaining lesions that
+ * do not conflict with the ones already selected nor with each other. The
+ * subset-sum table is bounded by MaximumTableSize: a bigger residual load,
+ * e.g. when the lesions of the bigger sizes are exhausted, is first filled
+ * with random compatible lesions. Lesion volumes and conflicts come from the index, so only the
+ * voxels of the overlapping biggest lesions are visited during the search.
+ */
+class LesionLoadSolver
+{
+public:
+    LesionLoadSolver(const Index& index, const int maxSizeArray[])
+        : m_Index(index), m_MaxSizeArray(maxSizeArray)
+    {
+    }
+
+    Selection Solve(uint64_t desiredLoad, uint64_t tolerance, std::mt19937& generator)
+    {
+        Selection selection;
+        selection.volume = 0;
+        selection.tried = 0;
+        m_Blocked.assign(m_Index.GetNumberOfLesions(), 0);
+        m_OverlappingVoxels.clear();
+
+        //Random draws, from the biggest to the smallest lesion sizes
+        const int overlappingBin = static_cast<int>(m_Index.GetNumberOfBins())-1;
+        for (int bin = overlappingBin; bin >= 0; --bin) {
+            std::vector<uint32_t> drawOrder(m_Index.GetNumberOfLesions(bin));
+            for (uint32_t id = 0; id < drawOrder.size(); ++id)
+                drawOrder[id] = m_Index.GetGlobalId(bin, id);
+            std::shuffle(drawOrder.begin(), drawOrder.end(), generator);
+
+            for (size_t d = 0; d < drawOrder.size(); ++d) {
+                const uint64_t residualLoad = desiredLoad - selection.volume;
+                if (residualLoad <= static_cast<uint64_t>(m_MaxSizeArray[bin]))
+                    break;
+                if (m_Blocked[drawOrder[d]] && bin != overlappingBin)
+                    continue;
+                ++selection.tried;
+                if (m_Index.GetLesion(drawOrder[d]).voxelCount <= residualLoad) {
+                    if (bin == overlappingBin)
+                        AcceptOverlapping(drawOrder[d], selection);
+                    else
+                        Accept(drawOrder[d], selection);
+                }
+            }
+        }
+
+        //Closes the residual load with a subset of the remaining compatible lesions. The candidates
+        //are drawn in random order, skipping the ones conflicting with a candidate drawn before, so
+        //any subset of them is compatible and a single subset-sum search is enough.
+        uint64_t residualLoad = desiredLoad - selection.volume;
+        if (residualLoad == 0)
+            return selection;
+        std::vector<uint32_t> drawOrder(m_Index.GetNumberOfLesions());
+        for (uint32_t lesion = 0; lesion < drawOrder.size(); ++lesion)
+            drawOrder[lesion] = lesion;
+        std::shuffle(drawOrder.begin(), drawOrder.end(), generator);
+
+        std::vector<unsigned char> skipped(m_Blocked);
+        std::vector<uint32_t> candidates;
+        uint64_t candidatesVolume = 0;
+        for (size_t d = 0; d < drawOrder.size(); ++d) {
+            const LesionRecord& lesion = m_Index.GetLesion(drawOrder[d]);
+            if (skipped[drawOrder[d]] || lesion.voxelCount > residualLoad + tolerance)
+                continue;
+            candidates.push_back(drawOrder[d]);
+            candidatesVolume += lesion.voxelCount;
+            const uint32_t* conflicts = m_Index.GetConflicts(lesion);
+            for (uint32_t c = 0; c < lesion.conflictCount; ++c)
+                skipped[conflicts[c]] = 1;
+        }
+        selection.tried += candidates.size();
+
+        //Greedy filling until the residual load fits in the subset-sum table
+        if (std::min(residualLoad + tolerance, candidatesVolume) > MaximumTableSize) {
+            const uint64_t greedyLoad = desiredLoad + tolerance - MaximumTableSize;
+            std::vector<uint32_t> remaining;
+            for (size_t c = 0; c < candidates.size(); ++c) {
+                const uint64_t volume = m_Index.GetLesion(candidates[c]).voxelCount;
+                if (selection.volume < greedyLoad && volume <= desiredLoad - selection.volume) {
+                    Accept(candidates[c], selection);
+                    candidatesVolume -= volume;
+                }else {
+                    remaining.push_back(candidates[c]);
+                }
+            }
+            candidates.swap(remaining);
+            residualLoad = desiredLoad - selection.volume;
+        }
+
+        //No subset of the candidates is bigger than all of them together
+        const uint64_t capacity = std::min<uint64_t>(std::min(residualLoad + tolerance, candidatesVolume), MaximumTableSize);
+
+        //reachedBy[s] is the candidate that first reached the volume s, -1 if not reachable
+        std::vector<int32_t> reachedBy(capacity+1, -1);
+        reachedBy[0] = static_cast<int32_t>(candidates.size());
+        for (size_t c = 0; c < candidates.size(); ++c) {
+            const uint64_t volume = m_Index.GetLesion(candidates[c]).voxelCount;
+            for (uint64_t s = capacity; s >= volume && s > 0; --s) {
+                if (reachedBy[s] < 0 && reachedBy[s-volume] >= 0)
+                    reachedBy[s] = static_cast<int32_t>(c);
+            }
+        }
+
+        uint64_t best = 0;
+        for (uint64_t s = 0; s <= capacity; ++s) {
+            if (reachedBy[s] >= 0 && Distance(s, residualLoad) < Distance(best, residualLoad))
+                best = s;
+        }
+        while (best > 0) {
+            const uint32_t lesion = candidates[reachedBy[best]];
+            best -= m_Index.GetLesion(lesion).voxelCount;
+            Accept(lesion, selection);
+        }
+
+        return selection;
+    }
+
+private:
+    //Maximum volume, in voxels, searched by the subset-sum (64 kB table)
+    enum { MaximumTableSize = 16384 };
+
+    static uint64_t Distance(uint64_t a, uint64_t b)
+    {
+        return a > b ? a - b : b - a;
+    }
+
+    void Accept(uint32_t globalId, Selection& selection)
+    {
+        const LesionRecord& lesion = m_Index.GetLesion(globalId);
+        selection.lesions.push_back(globalId);
+        selection.volume += lesion.voxelCount;
+
+        m_Blocked[globalId] = 1;
+        const uint32_t* conflicts = m_Index.GetConflicts(lesion);
+        for (uint32_t c = 0; c < lesion.conflictCount; ++c)
+            m_Blocked[conflicts[c]] = 1;
+    }
+
+    //Accepts a lesion of the biggest size, which may overlap the ones already
+    //selected: only its voxels not selected yet are added to the load
+    void AcceptOverlapping(uint32_t globalId, Selection& selection)
+    {
+        const LesionRecord& lesion = m_Index.GetLesion(globalId);
+        const uint32_t* voxels = m_Index.GetVoxels(lesion);
+        uint64_t newVoxels = 0;
+        for (uint32_t v = 0; v < lesion.voxelCount; ++v)
+            newVoxels += m_OverlappingVoxels.insert(voxels[v]).second ? 1 : 0;
+        Accept(globalId, selection);
+        selection.volume -= lesion.voxelCount - newVoxels;
+    }
+
+    const Index& m_Index;
+    const int* m_MaxSizeArray;
+    std::vector<unsigned char> m_Blocked;
+    std::unordered_set<uint32_t> m_OverlappingVoxels;
+};
+
+} // end of namespace LesionAtlas
+
+#endif
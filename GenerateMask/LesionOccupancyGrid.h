@@ -0,0 +1,126 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+#ifndef LesionOccupancyGrid_h
+#define LesionOccupancyGrid_h
+
+#include <stdint.h>
+
+#include <algorithm>
+#include <vector>
+
+namespace LesionAtlas
+{
+
+/**
+ * Occupancy of the lesion mask being generated.
+ *
+ * Keeps one bit per voxel and, on top of it, a coarse grid counting the
+ * occupied voxels of each block. A candidate lesion whose bounding box only
+ * touches empty blocks is accepted without probing its voxels, otherwise
+ * only its own voxels are tested, so the cost of an overlap test depends on
+ * the lesion size and not on the image size.
+ */
+class OccupancyGrid
+{
+public:
+    OccupancyGrid()
+    {
+        for (int i=0; i<3; i++)
+            m_Size[i] = m_BlockGridSize[i] = 0;
+    }
+
+    void Initialize(const uint32_t size[3])
+    {
+        uint64_t numberOfVoxels = 1;
+        uint64_t numberOfBlocks = 1;
+        for (int i=0; i<3; i++) {
+            m_Size[i] = size[i];
+            m_BlockGridSize[i] = (size[i] + BlockSize - 1) / BlockSize;
+            numberOfVoxels *= size[i];
+            numberOfBlocks *= m_BlockGridSize[i];
+        }
+        m_Bits.assign((numberOfVoxels + 63) / 64, 0);
+        m_BlockCount.assign(numberOfBlocks, 0);
+    }
+
+    void Clear()
+    {
+        std::fill(m_Bits.begin(), m_Bits.end(), 0);
+        std::fill(m_BlockCount.begin(), m_BlockCount.end(), 0);
+    }
+
+    bool IsOccupied(uint32_t voxel) const
+    {
+        return (m_Bits[voxel >> 6] >> (voxel & 63)) & 1;
+    }
+
+    //Checks if any of the given voxels, bounded by bboxMin and bboxMax, is already occupied
+    bool Overlaps(const uint32_t* voxels, uint32_t voxelCount, const uint32_t bboxMin[3], const uint32_t bboxMax[3]) const
+    {
+        bool touchesOccupiedBlock = false;
+        for (uint32_t z = bboxMin[2]/BlockSize; z <= bboxMax[2]/BlockSize && !touchesOccupiedBlock; ++z)
+            for (uint32_t y = bboxMin[1]/BlockSize; y <= bboxMax[1]/BlockSize && !touchesOccupiedBlock; ++y)
+                for (uint32_t x = bboxMin[0]/BlockSize; x <= bboxMax[0]/BlockSize; ++x)
+                    if (m_BlockCount[BlockIndex(x, y, z)] > 0) {
+                        touchesOccupiedBlock = true;
+                        break;
+                    }
+
+        if (!touchesOccupiedBlock)
+            return false;
+
+        for (uint32_t v = 0; v < voxelCount; ++v)
+            if (IsOccupied(voxels[v]))
+                return true;
+        return false;
+    }
+
+    //Marks the given voxels as occupied and returns how many of them were free
+    uint32_t Insert(const uint32_t* voxels, uint32_t voxelCount)
+    {
+        uint32_t inserted = 0;
+        for (uint32_t v = 0; v < voxelCount; ++v) {
+            const uint32_t voxel = voxels[v];
+            if (IsOccupied(voxel))
+                continue;
+            m_Bits[voxel >> 6] |= (static_cast<uint64_t>(1) << (voxel & 63));
+
+            const uint32_t x = voxel % m_Size[0];
+            const uint32_t y = (voxel / m_Size[0]) % m_Size[1];
+            const uint32_t z = voxel / (m_Size[0]*m_Size[1]);
+            ++m_BlockCount[BlockIndex(x/BlockSize, y/BlockSize, z/BlockSize)];
+            ++inserted;
+        }
+        return inserted;
+    }
+
+private:
+    enum { BlockSize = 8 };
+
+    uint64_t BlockIndex(uint32_t x, uint32_t y, uint32_t z) const
+    {
+        return (static_cast<uint64_t>(z)*m_BlockGridSize[1] + y)*m_BlockGridSize[0] + x;
+    }
+
+    uint32_t m_Size[3];
+    uint32_t m_BlockGridSize[3];
+    std::vector<uint64_t> m_Bits;
+    std::vector<uint32_t> m_BlockCount;
+};
+
+} // end of namespace LesionAtlas
+
+#endif
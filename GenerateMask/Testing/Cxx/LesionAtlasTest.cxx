@@ -0,0 +1,246 @@
+/*
+   Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+ */
+
+//Tests of the header only lesion atlas classes of GenerateMask: the lesion
+//load solver, the occupancy grid and the lesion atlas index file.
+
+#include "LesionAtlasIndex.h"
+#include "LesionLoadSolver.h"
+#include "LesionOccupancyGrid.h"
+
+#include <cmath>
+#include <cstdio>
+#include <cstdlib>
+#include <fstream>
+#include <iostream>
+#include <random>
+#include <string>
+#include <vector>
+
+namespace
+{
+
+int failures = 0;
+
+void Check(bool condition, const std::string& message)
+{
+    if (!condition) {
+        std::cerr << "FAILED: " << message << std::endl;
+        ++failures;
+    }
+}
+
+const uint32_t GridSize[3] = {100, 100, 100};
+const int NumberOfBins = 5;
+const int MaxSizeArray[NumberOfBins] = {100, 500, 1000, 5000, 15000};
+
+//Random box shaped lesions of the sizes of every bin, many of them overlapping
+void BuildIndex(LesionAtlas::Index& index, std::mt19937& generator)
+{
+    const int lesionCounts[NumberOfBins] = {400, 100, 20, 10, 6};
+    const int minimumSizes[NumberOfBins] = {50, 100, 500, 1000, 5000};
+    index.SetSize(GridSize);
+    for (int bin = 0; bin < NumberOfBins; bin++) {
+        for (int l = 0; l < lesionCounts[bin]; l++) {
+            const uint32_t side = static_cast<uint32_t>(std::ceil(std::cbrt(static_cast<double>(minimumSizes[bin]))));
+            uint32_t extent[3];
+            uint32_t start[3];
+            for (int i = 0; i < 3; i++) {
+                extent[i] = side + generator() % side;
+                start[i] = generator() % (GridSize[i] - extent[i]);
+            }
+            std::vector<uint32_t> voxels;
+            for (uint32_t z = start[2]; z < start[2] + extent[2]; z++)
+                for (uint32_t y = start[1]; y < start[1] + extent[1]; y++)
+                    for (uint32_t x = start[0]; x < start[0] + extent[0]; x++)
+                        voxels.push_back((z*GridSize[1] + y)*GridSize[0] + x);
+            index.AddLesion(bin, voxels);
+        }
+    }
+    index.BuildConflictGraph();
+}
+
+//Checks that the selected lesions are compatible and that the volume of the
+//selection is the number of distinct voxels of its lesions
+void CheckSelection(const LesionAtlas::Index& index, const LesionAtlas::Selection& selection, const std::string& name)
+{
+    std::vector<unsigned char> selected(index.GetNumberOfLesions(), 0);
+    for (size_t l = 0; l < selection.lesions.size(); l++)
+        selected[selection.lesions[l]] = 1;
+
+    std::vector<unsigned char> mask(GridSize[0]*GridSize[1]*GridSize[2], 0);
+    uint64_t volume = 0;
+    for (size_t l = 0; l < selection.lesions.size(); l++) {
+        const LesionAtlas::LesionRecord& lesion = index.GetLesion(selection.lesions[l]);
+        const uint32_t* voxels = index.GetVoxels(lesion);
+        for (uint32_t v = 0; v < lesion.voxelCount; v++) {
+            if (!mask[voxels[v]]++)
+                ++volume;
+        }
+        //Only the lesions of the biggest size may overlap each other
+        const uint32_t* conflicts = index.GetConflicts(lesion);
+        for (uint32_t c = 0; c < lesion.conflictCount; c++) {
+            const bool bothBiggest = lesion.bin == NumberOfBins-1 && index.GetLesion(conflicts[c]).bin == NumberOfBins-1;
+            Check(!selected[conflicts[c]] || bothBiggest, name + ": conflicting lesions selected");
+        }
+    }
+    Check(volume == selection.volume, name + ": selection volume differs from its number of voxels");
+}
+
+void TestSolver()
+{
+    std::mt19937 generator(1);
+    LesionAtlas::Index index;
+    BuildIndex(index, generator);
+
+    const uint64_t tolerance = 50;
+    const uint64_t loads[] = {200, 3000, 10000, 25000, 40000};
+    LesionAtlas::LesionLoadSolver solver(index, MaxSizeArray);
+    for (int seed = 0; seed < 5; seed++) {
+        std::mt19937 solverGenerator(seed);
+        for (size_t l = 0; l < sizeof(loads)/sizeof(loads[0]); l++) {
+            const std::string name = "load " + std::to_string(loads[l]) + " seed " + std::to_string(seed);
+            const LesionAtlas::Selection selection = solver.Solve(loads[l], tolerance, solverGenerator);
+            CheckSelection(index, selection, name);
+            const uint64_t error = selection.volume > loads[l] ? selection.volume - loads[l] : loads[l] - selection.volume;
+            Check(error <= tolerance, name + ": volume " + std::to_string(selection.volume) + " out of the tolerance");
+        }
+    }
+
+    //Without random draws of the bigger sizes, the whole load goes through the greedy
+    //filling and the bounded subset-sum
+    const int unboundedSizes[NumberOfBins] = {1000000, 1000000, 1000000, 1000000, 1000000};
+    LesionAtlas::LesionLoadSolver subsetSolver(index, unboundedSizes);
+    for (int seed = 0; seed < 5; seed++) {
+        std::mt19937 solverGenerator(seed);
+        const std::string name = "subset-sum seed " + std::to_string(seed);
+        const LesionAtlas::Selection selection = subsetSolver.Solve(30000, tolerance, solverGenerator);
+        CheckSelection(index, selection, name);
+        Check(selection.volume + tolerance >= 30000 && selection.volume <= 30000 + tolerance,
+              name + ": volume " + std::to_string(selection.volume) + " out of the tolerance");
+    }
+
+    //A load bigger than the whole atlas is left short, but still compatible
+    std::mt19937 solverGenerator(0);
+    const LesionAtlas::Selection selection = solver.Solve(5000000, tolerance, solverGenerator);
+    CheckSelection(index, selection, "unreachable load");
+    Check(selection.volume < 5000000, "unreachable load: volume above the load");
+}
+
+void TestOccupancyGrid()
+{
+    const uint32_t size[3] = {20, 20, 20};
+    LesionAtlas::OccupancyGrid occupancy;
+    occupancy.Initialize(size);
+
+    //Voxels (1,1,1), (2,1,1) and (1,2,1)
+    const uint32_t lesion[] = {421, 422, 441};
+    const uint32_t lesionMin[3] = {1, 1, 1};
+    const uint32_t lesionMax[3] = {2, 2, 1};
+    Check(!occupancy.Overlaps(lesion, 3, lesionMin, lesionMax), "empty grid overlaps");
+    Check(occupancy.Insert(lesion, 3) == 3, "all voxels of the first lesion inserted");
+    Check(occupancy.IsOccupied(421) && occupancy.IsOccupied(441) && !occupancy.IsOccupied(420), "occupied voxels");
+    Check(occupancy.Overlaps(lesion, 3, lesionMin, lesionMax), "lesion overlaps itself");
+
+    //Voxel (3,3,3), in the same block but free
+    const uint32_t sameBlock[] = {1263};
+    const uint32_t sameBlockBox[3] = {3, 3, 3};
+    Check(!occupancy.Overlaps(sameBlock, 1, sameBlockBox, sameBlockBox), "free voxel of an occupied block overlaps");
+
+    //Voxel (15,15,15), in an empty block
+    const uint32_t farAway[] = {6315};
+    const uint32_t farAwayBox[3] = {15, 15, 15};
+    Check(!occupancy.Overlaps(farAway, 1, farAwayBox, farAwayBox), "voxel of an empty block overlaps");
+
+    //Voxels (2,1,1) and (3,1,1): only the second one is new
+    const uint32_t partial[] = {422, 423};
+    const uint32_t partialMin[3] = {2, 1, 1};
+    const uint32_t partialMax[3] = {3, 1, 1};
+    Check(occupancy.Overlaps(partial, 2, partialMin, partialMax), "partially occupied lesion does not overlap");
+    Check(occupancy.Insert(partial, 2) == 1, "only the free voxels are inserted");
+
+    occupancy.Clear();
+    Check(!occupancy.IsOccupied(421) && !occupancy.Overlaps(lesion, 3, lesionMin, lesionMax), "cleared grid overlaps");
+}
+
+void TestIndexFile(const std::string& folder)
+{
+    std::mt19937 generator(2);
+    LesionAtlas::Index index;
+    BuildIndex(index, generator);
+    const double spacing[3] = {1.0, 1.0, 1.5};
+    const double origin[3] = {-90.0, 126.0, -72.0};
+    const double direction[9] = {-1, 0, 0, 0, -1, 0, 0, 0, 1};
+    index.SetGeometry(spacing, origin, direction);
+
+    const std::string fileName = folder + "/LesionAtlasTest.idx";
+    Check(index.Write(fileName), "index written");
+
+    LesionAtlas::Index readIndex;
+    Check(readIndex.Read(fileName), "index read");
+    Check(readIndex.HasGrid(GridSize, spacing, origin, direction), "grid of the read index");
+    const double otherOrigin[3] = {-90.0, 126.0, -71.0};
+    Check(!readIndex.HasGrid(GridSize, spacing, otherOrigin, direction), "grid with another origin");
+    Check(readIndex.GetNumberOfBins() == index.GetNumberOfBins(), "number of bins of the read index");
+    Check(readIndex.GetNumberOfLesions() == index.GetNumberOfLesions(), "number of lesions of the read index");
+    for (unsigned int bin = 0; bin < index.GetNumberOfBins() && bin < readIndex.GetNumberOfBins(); bin++)
+        Check(readIndex.GetNumberOfLesions(bin) == index.GetNumberOfLesions(bin), "number of lesions of a bin");
+
+    for (uint32_t l = 0; l < index.GetNumberOfLesions() && l < readIndex.GetNumberOfLesions(); l++) {
+        const LesionAtlas::LesionRecord& lesion = index.GetLesion(l);
+        const LesionAtlas::LesionRecord& readLesion = readIndex.GetLesion(l);
+        bool same = lesion.bin == readLesion.bin && lesion.id == readLesion.id
+                 && lesion.voxelCount == readLesion.voxelCount && lesion.conflictCount == readLesion.conflictCount;
+        for (int i = 0; i < 3 && same; i++)
+            same = lesion.bboxMin[i] == readLesion.bboxMin[i] && lesion.bboxMax[i] == readLesion.bboxMax[i];
+        for (uint32_t v = 0; v < lesion.voxelCount && same; v++)
+            same = index.GetVoxels(lesion)[v] == readIndex.GetVoxels(readLesion)[v];
+        for (uint32_t c = 0; c < lesion.conflictCount && same; c++)
+            same = index.GetConflicts(lesion)[c] == readIndex.GetConflicts(readLesion)[c];
+        Check(same, "lesion " + std::to_string(l) + " of the read index");
+    }
+
+    //A truncated file is rejected
+    std::ifstream file(fileName.c_str(), std::ios::binary);
+    std::vector<char> content((std::istreambuf_iterator<char>(file)), std::istreambuf_iterator<char>());
+    file.close();
+    const std::string truncatedFileName = folder + "/LesionAtlasTestTruncated.idx";
+    std::ofstream truncated(truncatedFileName.c_str(), std::ios::binary);
+    truncated.write(&content[0], content.size() - 4);
+    truncated.close();
+    LesionAtlas::Index truncatedIndex;
+    Check(!truncatedIndex.Read(truncatedFileName), "truncated index read");
+    Check(truncatedIndex.GetNumberOfLesions() == 0, "truncated index left lesions");
+
+    std::remove(fileName.c_str());
+    std::remove(truncatedFileName.c_str());
+}
+
+} // end of anonymous namespace
+
+int main(int argc, char* argv[])
+{
+    const std::string folder = argc > 1 ? argv[1] : ".";
+    TestSolver();
+    TestOccupancyGrid();
+    TestIndexFile(folder);
+    if (failures > 0) {
+        std::cerr << failures << " checks failed" << std::endl;
+        return EXIT_FAILURE;
+    }
+    std::cout << "All checks passed" << std::endl;
+    return EXIT_SUCCESS;
+}
@@ -21,6 +21,9 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import multiprocessing
+import time
+
+from MSLesionSimulatorLib.Pipeline import INTERMEDIATE_COMPRESSION_LEVEL, splitNumberOfThreads
 
 #
 # MSLesionSimulator
@@ -165,8 +168,8 @@ class MSLesionSimulatorWidget(ScriptedLoadableModuleWidget):
     self.setReturnOriginalSpaceBooleanWidget = ctk.ctkCheckBox()
     self.setReturnOriginalSpaceBooleanWidget.setChecked(False)
     self.setReturnOriginalSpaceBooleanWidget.setToolTip(
-      "Choose if you want to transform the final images to its original space. If not, all the input images will be in T1 space. NOTE: This choice only takes "
-      "effect on the baseline MS lesion simulation, i.e. the longitudinal lesion simulation (if checked) will always return the data using the T1 space.")
+      "Choose if you want to transform the final images to its original space. If not, all the input images will be in T1 space. The images are "
+      "not resampled: the lesion map is warped into the original space of each image, also for the longitudinal lesion simulation.")
     parametersInputFormLayout.addRow("Return output data in the original space",
                                       self.setReturnOriginalSpaceBooleanWidget)
 
@@ -332,8 +335,26 @@ class MSLesionSimulatorWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersInputFormLayout.addRow(self.applyButton)
 
+    #
+    # Progress Bar and Cancel Button
+    #
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.setRange(0, 100)
+    self.progressBar.visible = False
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Abort the running simulation."
+    self.cancelButton.visible = False
+    progressLayout = qt.QHBoxLayout()
+    progressLayout.addWidget(self.progressBar)
+    progressLayout.addWidget(self.cancelButton)
+    parametersInputFormLayout.addRow(progressLayout)
+
+    # Logic of the running simulation
+    self.logic = None
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
     self.inputT1Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.inputT2Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.inputFLAIRSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
@@ -346,16 +367,17 @@ class MSLesionSimulatorWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    if self.logic is not None:
+      self.logic.cancel()
 
   def onSelect(self):
-    self.applyButton.enabled = self.inputT1Selector.currentNode()\
-                               or self.inputT2Selector.currentNode()\
-                               or self.inputFLAIRSelector.currentNode()\
-                               or self.inputPDSelector.currentNode()
+    self.applyButton.enabled = (self.logic is None) and bool(self.inputT1Selector.currentNode()
+                                                             or self.inputT2Selector.currentNode()
+                                                             or self.inputFLAIRSelector.currentNode()
+                                                             or self.inputPDSelector.currentNode())
 
   def onApplyButton(self):
-    logic = MSLesionSimulatorLogic()
+    self.logic = MSLesionSimulatorLogic()
     returnSpace = self.setReturnOriginalSpaceBooleanWidget.isChecked()
     isBET = self.setIsBETBooleanWidget.isChecked()
     isMNI = self.setIsMNIBooleanWidget.isChecked()
@@ -372,25 +394,49 @@ class MSLesionSimulatorWidget(ScriptedLoadableModuleWidget):
     initiationMethod = self.setInitiationRegistrationBooleanWidget.currentText
     numberOfThreads = self.setNumberOfThreadsWidget.value
 
-    logic.run(self.inputT1Selector.currentNode()
-              , self.inputFLAIRSelector.currentNode()
-              , self.inputT2Selector.currentNode()
-              , self.inputPDSelector.currentNode()
-              , self.inputFASelector.currentNode()
-              , self.inputADCSelector.currentNode()
-              , returnSpace
-              , isBET
-              , isMNI
-              , lesionLoad
-              , isLongitudinal
-              , numberFollowUp
-              , balanceHI
-              , outputFolder
-              , cutFraction
-              , samplingPerc
-              , grid
-              , initiationMethod
-              , numberOfThreads)
+    self.applyButton.enabled = False
+    self.progressBar.value = 0
+    self.progressBar.format = "%p%"
+    self.progressBar.visible = True
+    self.cancelButton.enabled = True
+    self.cancelButton.visible = True
+    # The CLIs are run one after the other without blocking the application, so the simulation can be cancelled
+    self.logic.runAsync(self.inputT1Selector.currentNode()
+                        , self.inputFLAIRSelector.currentNode()
+                        , self.inputT2Selector.currentNode()
+                        , self.inputPDSelector.currentNode()
+                        , self.inputFASelector.currentNode()
+                        , self.inputADCSelector.currentNode()
+                        , returnSpace
+                        , isBET
+                        , isMNI
+                        , lesionLoad
+                        , isLongitudinal
+                        , numberFollowUp
+                        , balanceHI
+                        , outputFolder
+                        , cutFraction
+                        , samplingPerc
+                        , grid
+                        , initiationMethod
+                        , numberOfThreads
+                        , progressCallback=self.onProgress
+                        , finishedCallback=self.onFinished)
+
+  def onCancelButton(self):
+    if self.logic is not None:
+      self.cancelButton.enabled = False
+      self.logic.cancel()
+
+  def onProgress(self, name, progress):
+    self.progressBar.value = int(progress)
+    self.progressBar.format = name + ": %p%"
+
+  def onFinished(self, success):
+    self.logic = None
+    self.progressBar.visible = False
+    self.cancelButton.visible = False
+    self.onSelect()
 
 #
 # MSLesionSimulatorLogic
@@ -406,6 +452,31 @@ class MSLesionSimulatorLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    # MNI152 registrations are cached in this folder (an empty folder disables the cache), limited
+    # to registrationCacheMaximumSize megabytes
+    settings = qt.QSettings()
+    self.registrationCacheFolder = settings.value("MSLesionSimulator/RegistrationCacheFolder",
+                                                  os.path.join(slicer.app.cachePath, "MSLesionSimulator", "registrations"))
+    self.registrationCacheMaximumSize = int(settings.value("MSLesionSimulator/RegistrationCacheMaximumSize", 2048))
+    # Low memory mode of DeformImage, for running many simulations at the same time
+    self.lowMemory = False
+    # Volumes are exchanged in memory with the CLIs loaded as shared libraries, instead of temporary files
+    self.inProcess = str(settings.value("MSLesionSimulator/InProcessCLIs", True)).lower() == "true"
+    # Timing and memory report of the last run (see MSLesionSimulatorLib.Profiling), also saved in
+    # profilingReportPath if set
+    self.profilingReportPath = ""
+    self.profilingReport = None
+    self.profiler = None
+    # CLI steps run by runAsync, resumed when the CLI nodes of the current step are finished
+    self.steps = None
+    self.stepCliNodes = []
+    self.stepObservations = []
+    self.stepCancelled = False
+    self.progressCallback = None
+    self.finishedCallback = None
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -423,424 +494,788 @@ class MSLesionSimulatorLogic(ScriptedLoadableModuleLogic):
   def run(self, inputT1Volume, inputFLAIRVolume, inputT2Volume, inputPDVolume,
           inputFAVolume, inputADCVolume, returnSpace, isBET, isMNI,
           lesionLoad, isLongitudinal, numberFollowUp, balanceHI, outputFolder,
-          cutFraction, samplingPerc, grid, initiationMethod, numberOfThreads):
+          cutFraction, samplingPerc, grid, initiationMethod, numberOfThreads, seed=0):
     """
-    Run the actual algorithm
+    Run the actual algorithm, waiting for its completion
+    :param seed: seed of the lesion map generation, 0 for a time based seed
+    :return: True if the simulation was done
     """
+    return self.runSteps(self.simulationSteps(inputT1Volume, inputFLAIRVolume, inputT2Volume, inputPDVolume,
+                                              inputFAVolume, inputADCVolume, returnSpace, isBET, isMNI,
+                                              lesionLoad, isLongitudinal, numberFollowUp, balanceHI, outputFolder,
+                                              cutFraction, samplingPerc, grid, initiationMethod, numberOfThreads, seed))
+
+  def runAsync(self, inputT1Volume, inputFLAIRVolume, inputT2Volume, inputPDVolume,
+               inputFAVolume, inputADCVolume, returnSpace, isBET, isMNI,
+               lesionLoad, isLongitudinal, numberFollowUp, balanceHI, outputFolder,
+               cutFraction, samplingPerc, grid, initiationMethod, numberOfThreads, seed=0,
+               progressCallback=None, finishedCallback=None):
+    """
+    Start the algorithm without blocking the application. Every CLI is started when the previous one
+    finishes (see startSteps), and the simulation is stopped by cancel.
+    :param progressCallback: called with the name and progress (0 to 100) of the running CLI
+    :param finishedCallback: called with True when the simulation is done, False if it failed or was cancelled
+    :return:
+    """
+    self.startSteps(self.simulationSteps(inputT1Volume, inputFLAIRVolume, inputT2Volume, inputPDVolume,
+                                         inputFAVolume, inputADCVolume, returnSpace, isBET, isMNI,
+                                         lesionLoad, isLongitudinal, numberFollowUp, balanceHI, outputFolder,
+                                         cutFraction, samplingPerc, grid, initiationMethod, numberOfThreads, seed),
+                    progressCallback, finishedCallback)
+
+  def simulationSteps(self, inputT1Volume, inputFLAIRVolume, inputT2Volume, inputPDVolume,
+                      inputFAVolume, inputADCVolume, returnSpace, isBET, isMNI,
+                      lesionLoad, isLongitudinal, numberFollowUp, balanceHI, outputFolder,
+                      cutFraction, samplingPerc, grid, initiationMethod, numberOfThreads, seed=0):
+    """
+    Steps of the algorithm: a generator yielding the CLI node, or list of CLI nodes, started at each step,
+    and resumed with True if they completed. The simulation stops at the first step that did not complete.
+    The intermediate nodes are removed from the scene when it ends, also when it is closed because the
+    simulation was cancelled.
+    :return: True if the simulation was done
+    """
+    intermediateNodes = []
+    try:
+      #
+      # Defines reference image modality based on pre-defined order if data is not in MNI space
+      #
+      if not isMNI:
+        if inputT1Volume is not None:
+          referenceVolume = inputT1Volume
+          logging.info('T1 volume found. Will be used as reference space.')
+        elif inputT2Volume is not None:
+          referenceVolume = inputT2Volume
+          logging.info('T2 volume found. Will be used as reference space.')
+        elif inputFLAIRVolume is not None:
+          referenceVolume = inputFLAIRVolume
+          logging.info('FLAIR volume found. Will be used as reference space.')
+        elif inputPDVolume is not None:
+          referenceVolume = inputPDVolume
+          logging.info('PD volume found. Will be used as reference space.')
+        else:
+          logging.info('ERROR: At least one structural image should be provided. Aborting.')
+          return False
 
-    #
-    # Defines reference image modality based on pre-defined order if data is not in MNI space
-    #
-    if not isMNI:
-      if inputT1Volume is not None:
-        referenceVolume = inputT1Volume
-        logging.info('T1 volume found. Will be used as reference space.')
-      elif inputT2Volume is not None:
-        referenceVolume = inputT2Volume
-        logging.info('T2 volume found. Will be used as reference space.')
-      elif inputFLAIRVolume is not None:
-        referenceVolume = inputFLAIRVolume
-        logging.info('FLAIR volume found. Will be used as reference space.')
-      elif inputPDVolume is not None:
-        referenceVolume = inputPDVolume
-        logging.info('PD volume found. Will be used as reference space.')
-      else:
-        logging.info('ERROR: At least one structural image should be provided. Aborting.')
-        return False
-
-    #
-    # Defines count variable for step progression log
-    #
-    currentStep = 1
-
-    logging.info('Processing started')
-    slicer.util.showStatusMessage("Processing started")
-    #
-    # Data space normalization to T1 space
-    #
-    volumesLogic = slicer.modules.volumes.logic()
-    if not isMNI:
-      if inputT2Volume is not None and inputT2Volume is not referenceVolume:
-        try:
-          slicer.util.showStatusMessage("Pre-processing: Conforming T2 volume to reference space...")
-          regT2toRefTransform = slicer.vtkMRMLLinearTransformNode()
-          slicer.mrmlScene.AddNode(regT2toRefTransform)
-          clonedT2Volume = volumesLogic.CloneVolume(slicer.mrmlScene, inputT2Volume, "Cloned T2")
-
-          self.conformInputSpace(referenceVolume, inputT2Volume, inputT2Volume, regT2toRefTransform, numberOfThreads)
-        except:
-          logging.info("Exception caught when trying to conform T2 image to reference space.")
-      if inputFLAIRVolume is not None and inputFLAIRVolume is not referenceVolume:
-        try:
-          slicer.util.showStatusMessage("Pre-processing: Conforming T2-FLAIR volume to reference space...")
-          regFLAIRtoRefTransform = slicer.vtkMRMLLinearTransformNode()
-          slicer.mrmlScene.AddNode(regFLAIRtoRefTransform)
-          clonedFLAIRVolume = volumesLogic.CloneVolume(slicer.mrmlScene, inputFLAIRVolume, "Cloned FLAIR")
-
-          self.conformInputSpace(referenceVolume, inputFLAIRVolume, inputFLAIRVolume, regFLAIRtoRefTransform, numberOfThreads)
-        except:
-          logging.info("Exception caught when trying to create node for T2-FLAIR image in reference space.")
-      if inputPDVolume is not None and inputPDVolume is not referenceVolume:
-        try:
-          slicer.util.showStatusMessage("Pre-processing: Conforming PD volume to reference space...")
-          regPDtoRefTransform = slicer.vtkMRMLLinearTransformNode()
-          slicer.mrmlScene.AddNode(regPDtoRefTransform)
-          clonedPDVolume = volumesLogic.CloneVolume(slicer.mrmlScene, inputPDVolume, "Cloned PD")
-
-          self.conformInputSpace(referenceVolume, inputPDVolume, inputPDVolume, regPDtoRefTransform, numberOfThreads)
-        except:
-          logging.info("Exception caught when trying to create node for PD image in reference space.")
-      if inputFAVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Pre-processing: Conforming DTI-FA map to reference space...")
-          regFAtoRefTransform = slicer.vtkMRMLLinearTransformNode()
-          slicer.mrmlScene.AddNode(regFAtoRefTransform)
-          clonedFAVolume = volumesLogic.CloneVolume(slicer.mrmlScene, inputFAVolume, "Cloned FA")
-
-          self.conformInputSpace(referenceVolume, inputFAVolume, inputFAVolume, regFAtoRefTransform, numberOfThreads)
-        except:
-          logging.info("Exception caught when trying to create node for FA image in reference space.")
-      if inputADCVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Pre-processing: Conforming DTI-ADC map to reference space...")
-          regADCtoRefTransform = slicer.vtkMRMLLinearTransformNode()
-          slicer.mrmlScene.AddNode(regADCtoRefTransform)
-          clonedADCVolume = volumesLogic.CloneVolume(slicer.mrmlScene, inputADCVolume, "Cloned ADC")
+      #
+      # Defines count variable for step progression log
+      #
+      currentStep = 1
+
+      logging.info('Processing started')
+      slicer.util.showStatusMessage("Processing started")
+      self.configureInProcessExecution()
+      from MSLesionSimulatorLib.Profiling import RunProfiler
+      self.profiler = RunProfiler({"lesionLoad": lesionLoad, "isLongitudinal": isLongitudinal, "numberFollowUp": numberFollowUp,
+                                   "numberOfThreads": numberOfThreads, "seed": seed, "inProcess": self.inProcess,
+                                   "lowMemory": self.lowMemory})
+      #
+      # Data space normalization to T1 space. With returnSpace, the modalities are not resampled: the conforming
+      # registrations only compute their transform, and the lesion map is warped into the grid of each modality.
+      #
+      conformTransforms = {}
+      def conformedVolume(inputVolume):
+        return None if returnSpace else inputVolume
+      if not isMNI:
+        self.profiler.startStage("Conforming input volumes")
+        # The conforming registrations are independent of each other, so they run simultaneously sharing the threads
+        conformVolumes = [volume for volume in [inputT2Volume, inputFLAIRVolume, inputPDVolume] if volume is not None and volume is not referenceVolume]
+        conformVolumes += [volume for volume in [inputFAVolume, inputADCVolume] if volume is not None]
+        conformNumberOfThreads = splitNumberOfThreads(numberOfThreads, len(conformVolumes))
+        conformCliNodes = []
+        if inputT2Volume is not None and inputT2Volume is not referenceVolume:
+          try:
+            slicer.util.showStatusMessage("Pre-processing: Conforming T2 volume to reference space...")
+            regT2toRefTransform = slicer.vtkMRMLLinearTransformNode()
+            slicer.mrmlScene.AddNode(regT2toRefTransform)
+            intermediateNodes.append(regT2toRefTransform)
+            conformTransforms[inputT2Volume.GetID()] = regT2toRefTransform
+
+            conformCliNodes.append(self.conformInputSpace(referenceVolume, inputT2Volume, conformedVolume(inputT2Volume), regT2toRefTransform, conformNumberOfThreads, False))
+          except Exception:
+            logging.info("Exception caught when trying to conform T2 image to reference space.")
+        if inputFLAIRVolume is not None and inputFLAIRVolume is not referenceVolume:
+          try:
+            slicer.util.showStatusMessage("Pre-processing: Conforming T2-FLAIR volume to reference space...")
+            regFLAIRtoRefTransform = slicer.vtkMRMLLinearTransformNode()
+            slicer.mrmlScene.AddNode(regFLAIRtoRefTransform)
+            intermediateNodes.append(regFLAIRtoRefTransform)
+            conformTransforms[inputFLAIRVolume.GetID()] = regFLAIRtoRefTransform
+
+            conformCliNodes.append(self.conformInputSpace(referenceVolume, inputFLAIRVolume, conformedVolume(inputFLAIRVolume), regFLAIRtoRefTransform, conformNumberOfThreads, False))
+          except Exception:
+            logging.info("Exception caught when trying to create node for T2-FLAIR image in reference space.")
+        if inputPDVolume is not None and inputPDVolume is not referenceVolume:
+          try:
+            slicer.util.showStatusMessage("Pre-processing: Conforming PD volume to reference space...")
+            regPDtoRefTransform = slicer.vtkMRMLLinearTransformNode()
+            slicer.mrmlScene.AddNode(regPDtoRefTransform)
+            intermediateNodes.append(regPDtoRefTransform)
+            conformTransforms[inputPDVolume.GetID()] = regPDtoRefTransform
+
+            conformCliNodes.append(self.conformInputSpace(referenceVolume, inputPDVolume, conformedVolume(inputPDVolume), regPDtoRefTransform, conformNumberOfThreads, False))
+          except Exception:
+            logging.info("Exception caught when trying to create node for PD image in reference space.")
+        if inputFAVolume is not None:
+          try:
+            slicer.util.showStatusMessage("Pre-processing: Conforming DTI-FA map to reference space...")
+            regFAtoRefTransform = slicer.vtkMRMLLinearTransformNode()
+            slicer.mrmlScene.AddNode(regFAtoRefTransform)
+            intermediateNodes.append(regFAtoRefTransform)
+            conformTransforms[inputFAVolume.GetID()] = regFAtoRefTransform
+
+            conformCliNodes.append(self.conformInputSpace(referenceVolume, inputFAVolume, conformedVolume(inputFAVolume), regFAtoRefTransform, conformNumberOfThreads, False))
+          except Exception:
+            logging.info("Exception caught when trying to create node for FA image in reference space.")
+        if inputADCVolume is not None:
+          try:
+            slicer.util.showStatusMessage("Pre-processing: Conforming DTI-ADC map to reference space...")
+            regADCtoRefTransform = slicer.vtkMRMLLinearTransformNode()
+            slicer.mrmlScene.AddNode(regADCtoRefTransform)
+            intermediateNodes.append(regADCtoRefTransform)
+            conformTransforms[inputADCVolume.GetID()] = regADCtoRefTransform
+
+            conformCliNodes.append(self.conformInputSpace(referenceVolume, inputADCVolume, conformedVolume(inputADCVolume), regADCtoRefTransform, conformNumberOfThreads, False))
+          except Exception:
+            logging.info("Exception caught when trying to create node for ADC image in reference space.")
+
+        slicer.util.showStatusMessage("Pre-processing: Waiting for the conforming registrations...")
+        completed = yield conformCliNodes
+        if not completed:
+          return self.stopSimulation("the input volumes could not be conformed to reference space.")
+
+      self.profiler.startStage("Reading brain templates")
+      slicer.util.showStatusMessage("Step "+str(currentStep)+": Reading brain templates...")
+      logging.info("Step "+str(currentStep)+": Reading brain templates...")
+      currentStep+=1
+
+      databasePath = self.getDatabasePath()
+      MNINode = self.loadMNITemplate(databasePath, isBET)
+      intermediateNodes.append(MNINode)
+
+      if not isMNI:
+        #
+        # Registration between Input Image and MNI Image Space
+        #
+
+        self.profiler.startStage("MNI152 registration")
+        slicer.util.showStatusMessage("Step " + str(currentStep) + ": MNI152 template to native space...")
+        logging.info("Step " + str(currentStep) + ": MNI152 template to native space...")
+        currentStep += 1
+
+        regMNItoRefTransform = yield from self.registerMNIToReferenceSteps(referenceVolume, MNINode, isBET, samplingPerc, grid, initiationMethod, numberOfThreads)
+        if regMNItoRefTransform is None:
+          return self.stopSimulation("the MNI152 template could not be registered to reference space.")
+        intermediateNodes.append(regMNItoRefTransform)
 
-          self.conformInputSpace(referenceVolume, inputADCVolume, inputADCVolume, regADCtoRefTransform, numberOfThreads)
-        except:
-          logging.info("Exception caught when trying to create node for ADC image in reference space.")
+      #
+      # Find lesion mask using Probability Image, lesion labels and desired Lesion Load
+      #
+      self.profiler.startStage("Lesion map generation")
+      slicer.util.showStatusMessage("Step "+str(currentStep)+": Simulating MS lesion map...")
+      logging.info("Step "+str(currentStep)+": Simulating MS lesion map...")
+      currentStep+=1
+
+      lesionMap = slicer.vtkMRMLLabelMapVolumeNode()
+      slicer.mrmlScene.AddNode(lesionMap)
+      intermediateNodes.append(lesionMap)
+      lesionIndexPath = self.getLesionIndexPath()
+      if platform.system() == "Windows":
+        completed = yield self.doGenerateMask(MNINode, lesionLoad, lesionMap, databasePath+"\\labels-database", lesionIndexPath, seed, waitForCompletion=False)
+      else:
+        completed = yield self.doGenerateMask(MNINode, lesionLoad, lesionMap, databasePath + "/labels-database", lesionIndexPath, seed, waitForCompletion=False)
+      if not completed:
+        return self.stopSimulation("the lesion map could not be generated.")
+
+
+      # Transforming lesion map to native space
+      simulationInputs = [volume for volume in [inputT1Volume, inputFLAIRVolume, inputT2Volume, inputPDVolume, inputFAVolume, inputADCVolume]
+                          if volume is not None]
+      lesionMaps = {}
+      if not isMNI:
+        self.profiler.startStage("Lesion map to native space")
+        # Get transform logic for hardening transforms
+        transformLogic = slicer.vtkSlicerTransformLogic()
+
+        # The lesion map is warped from the MNI152 space into the grid of every modality at once: the modalities
+        # left in their native space get it through the MNI152 to reference and reference to native transforms
+        warpCliNodes = []
+        for inputVolume in simulationInputs:
+          if inputVolume.GetID() not in conformTransforms or not returnSpace:
+            continue
+          nativeLesionMap = slicer.vtkMRMLLabelMapVolumeNode()
+          slicer.mrmlScene.AddNode(nativeLesionMap)
+          MNItoNativeTransform = self.composeTransforms(regMNItoRefTransform, conformTransforms[inputVolume.GetID()])
+          intermediateNodes += [nativeLesionMap, MNItoNativeTransform]
+          warpCliNodes.append(self.applyRegistrationTransform(lesionMap, inputVolume, nativeLesionMap, MNItoNativeTransform, False, True,
+                                                              waitForCompletion=False))
+          lesionMaps[inputVolume.GetID()] = nativeLesionMap
+        referenceLesionMap = lesionMap
+        if warpCliNodes:
+          referenceLesionMap = slicer.vtkMRMLLabelMapVolumeNode()
+          slicer.mrmlScene.AddNode(referenceLesionMap)
+          intermediateNodes.append(referenceLesionMap)
+        warpCliNodes.append(self.applyRegistrationTransform(lesionMap,referenceVolume,referenceLesionMap,regMNItoRefTransform,False, True,
+                                                            waitForCompletion=False))
+        completed = yield warpCliNodes
+        if not completed:
+          return self.stopSimulation("the lesion map could not be transformed to native space.")
+        for warpedLesionMap in [referenceLesionMap] + list(lesionMaps.values()):
+          transformLogic.hardenTransform(warpedLesionMap)
+        lesionMap = referenceLesionMap
+
+      # Filtering lesion map to minimize or exclude regions outside of WM
+      self.profiler.startStage("Lesion map filtering")
+      filterInputs = []
+      filterOutputs = []
+      if inputT1Volume is not None:
+        # Lesion Map: T1
+        lesionMapT1 = slicer.vtkMRMLLabelMapVolumeNode()
+        slicer.mrmlScene.AddNode(lesionMapT1)
+        lesionMapT1.SetName("T1_lesion_label")
+        filterInputs.append(inputT1Volume)
+        filterOutputs.append(lesionMapT1)
 
-    slicer.util.showStatusMessage("Step "+str(currentStep)+": Reading brain templates...")
-    logging.info("Step "+str(currentStep)+": Reading brain templates...")
-    currentStep+=1
+      if inputFLAIRVolume is not None:
+        # Lesion Map: T2-FLAIR
+        lesionMapFLAIR = slicer.vtkMRMLLabelMapVolumeNode()
+        slicer.mrmlScene.AddNode(lesionMapFLAIR)
+        lesionMapFLAIR.SetName("T2FLAIR_lesion_label")
+        filterInputs.append(inputFLAIRVolume)
+        filterOutputs.append(lesionMapFLAIR)
 
-    modulePath = os.path.dirname(slicer.modules.mslesionsimulator.path)
+      if inputT2Volume is not None:
+        # Lesion Map: T2
+        lesionMapT2 = slicer.vtkMRMLLabelMapVolumeNode()
+        slicer.mrmlScene.AddNode(lesionMapT2)
+        lesionMapT2.SetName("T2_lesion_label")
+        filterInputs.append(inputT2Volume)
+        filterOutputs.append(lesionMapT2)
 
-    if platform.system() == "Windows":
+      if inputPDVolume is not None:
+        # Lesion Map: PD
+        lesionMapPD = slicer.vtkMRMLLabelMapVolumeNode()
+        slicer.mrmlScene.AddNode(lesionMapPD)
+        lesionMapPD.SetName("PD_lesion_label")
+        filterInputs.append(inputPDVolume)
+        filterOutputs.append(lesionMapPD)
 
-      databasePath = modulePath + "\\Resources\\MSlesion_database"
-    else:
+      if inputFAVolume is not None:
+        # Lesion Map: DTI-FA
+        lesionMapFA = slicer.vtkMRMLLabelMapVolumeNode()
+        slicer.mrmlScene.AddNode(lesionMapFA)
+        lesionMapFA.SetName("FA_lesion_label")
+        filterInputs.append(inputFAVolume)
+        filterOutputs.append(lesionMapFA)
 
-      databasePath = modulePath + "/Resources/MSlesion_database"
+      if inputADCVolume is not None:
+        # Lesion Map: DTI-FA
+        lesionMapADC = slicer.vtkMRMLLabelMapVolumeNode()
+        slicer.mrmlScene.AddNode(lesionMapADC)
+        lesionMapADC.SetName("ADC_lesion_label")
+        filterInputs.append(inputADCVolume)
+        filterOutputs.append(lesionMapADC)
+
+      # The modalities sharing the grid of a lesion map are filtered by a single FilterMask execution
+      filterGroups = {}
+      for inputVolume, filterOutput in zip(filterInputs, filterOutputs):
+        inputLesionMap = lesionMaps.get(inputVolume.GetID(), lesionMap)
+        filterGroups.setdefault(inputLesionMap.GetID(), (inputLesionMap, [], []))
+        filterGroups[inputLesionMap.GetID()][1].append(inputVolume)
+        filterGroups[inputLesionMap.GetID()][2].append(filterOutput)
+      completed = yield [self.doFilterMask(inputVolumes, inputLesionMap, outputMasks, cutFraction, waitForCompletion=False)
+                         for inputLesionMap, inputVolumes, outputMasks in filterGroups.values()]
+      if not completed:
+        return self.stopSimulation("the lesion map could not be filtered.")
 
-    if isBET:
-      if platform.system() == "Windows":
-        (readSuccess, MNINode)=slicer.util.loadVolume(databasePath+"\\MNI152_T1_1mm_brain.nii.gz",{},True)
-      else:
-        (readSuccess,MNINode)=slicer.util.loadVolume(databasePath + "/MNI152_T1_1mm_brain.nii.gz",{},True)
-    else:
-      if platform.system() == "Windows":
-        (readSuccess, MNINode)=slicer.util.loadVolume(databasePath + "\\MNI152_T1_1mm.nii.gz",{},True)
-      else:
-        (readSuccess, MNINode)=slicer.util.loadVolume(databasePath + "/MNI152_T1_1mm.nii.gz",{},True)
 
-    if not isMNI:
       #
-      # Registration between Input Image and MNI Image Space
+      # Generating lesions in each input image
       #
+      # List of parameters: Sigma
+      Sigma= {}
+      Sigma["T1"]=0.75
+      Sigma["T2"]=0.75
+      Sigma["PD"]=0.75
+      Sigma["T2FLAIR"]=0.75
+      Sigma["DTI-FA"]=1.5
+      Sigma["DTI-ADC"]=1.3
+
+      variability = 0.5
+
+      self.profiler.startStage("Longitudinal exams simulation" if isLongitudinal else "Lesion simulation")
+      if not isLongitudinal:
+        # The modalities whose lesion labels share a grid are deformed by a single DeformImage execution, sharing
+        # the lesion labelling
+        simulateInputs = []
+        simulateModalities = []
+        simulateLabels = []
+        simulateSigmas = []
+        if inputT1Volume is not None:
+          simulateInputs.append(inputT1Volume)
+          simulateModalities.append("T1")
+          simulateLabels.append(lesionMapT1)
+          simulateSigmas.append(Sigma["T1"])
+        if inputFLAIRVolume is not None:
+          simulateInputs.append(inputFLAIRVolume)
+          simulateModalities.append("T2-FLAIR")
+          simulateLabels.append(lesionMapFLAIR)
+          simulateSigmas.append(Sigma["T2FLAIR"])
+        if inputT2Volume is not None:
+          simulateInputs.append(inputT2Volume)
+          simulateModalities.append("T2")
+          simulateLabels.append(lesionMapT2)
+          simulateSigmas.append(Sigma["T2"])
+        if inputPDVolume is not None:
+          simulateInputs.append(inputPDVolume)
+          simulateModalities.append("PD")
+          simulateLabels.append(lesionMapPD)
+          simulateSigmas.append(Sigma["PD"])
+        if inputFAVolume is not None:
+          simulateInputs.append(inputFAVolume)
+          simulateModalities.append("DTI-FA")
+          simulateLabels.append(lesionMapFA)
+          simulateSigmas.append(Sigma["DTI-FA"])
+        if inputADCVolume is not None:
+          simulateInputs.append(inputADCVolume)
+          simulateModalities.append("DTI-ADC")
+          simulateLabels.append(lesionMapADC)
+          simulateSigmas.append(Sigma["DTI-ADC"])
+        simulateGroups = {}
+        for i in range(len(simulateInputs)):
+          simulateGroups.setdefault(lesionMaps.get(simulateInputs[i].GetID(), lesionMap).GetID(), []).append(i)
+        try:
+          slicer.util.showStatusMessage("Step "+str(currentStep)+": Applying lesion deformation on " + ", ".join(simulateModalities) + " volumes...")
+          logging.info("Step "+str(currentStep)+": Applying lesion deformation on " + ", ".join(simulateModalities) + " volumes...")
+          completed = yield [self.doSimulateLesions([simulateInputs[i] for i in group], [simulateModalities[i] for i in group],
+                                                    [simulateLabels[i] for i in group], [simulateInputs[i] for i in group],
+                                                    [simulateSigmas[i] for i in group], variability, seed, waitForCompletion=False)
+                             for group in simulateGroups.values()]
+        except Exception:
+          logging.info("Exception caught when trying to apply lesion deformation.")
+          completed = False
+        if not completed:
+          return self.stopSimulation("the lesions could not be simulated.")
+      else:
+        #
+        # Simulate Longitudinal Exams
+        #
+        if inputT1Volume is not None:
+          try:
+            slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on T1 volume...")
+            logging.info("Extra: Generating longitudinal lesion deformation on T1 volume......")
+            completed = yield self.doLongitudinalExams(inputT1Volume, "T1", lesionMapT1, outputFolder, numberFollowUp, balanceHI, Sigma["T1"], variability, seed, waitForCompletion=False)
+          except Exception:
+            logging.info("Exception caught when trying to generate longitudinal lesion deformation in T1 volume.")
+            completed = False
+          if not completed:
+            return self.stopSimulation("the longitudinal lesions could not be simulated in the T1 volume.")
+        if inputFLAIRVolume is not None:
+          try:
+            slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on T2-FLAIR volume...")
+            logging.info("Extra: Generating longitudinal lesion deformation on T2-FLAIR volume......")
+            completed = yield self.doLongitudinalExams(inputFLAIRVolume, "T2-FLAIR", lesionMapFLAIR, outputFolder, numberFollowUp, balanceHI, Sigma["T2FLAIR"], variability, seed, waitForCompletion=False)
+          except Exception:
+            logging.info("Exception caught when trying to generate longitudinal lesion deformation in T2-FLAIR volume.")
+            completed = False
+          if not completed:
+            return self.stopSimulation("the longitudinal lesions could not be simulated in the T2-FLAIR volume.")
+        if inputT2Volume is not None:
+          try:
+            slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on T2 volume...")
+            logging.info("Extra: Generating longitudinal lesion deformation on T2 volume...")
+            completed = yield self.doLongitudinalExams(inputT2Volume, "T2", lesionMapT2, outputFolder, numberFollowUp, balanceHI, Sigma["T2"], variability, seed, waitForCompletion=False)
+          except Exception:
+            logging.info("Exception caught when trying to generate longitudinal lesion deformation in T2 volume.")
+            completed = False
+          if not completed:
+            return self.stopSimulation("the longitudinal lesions could not be simulated in the T2 volume.")
+        if inputPDVolume is not None:
+          try:
+            slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on PD volume...")
+            logging.info("Extra: Generating longitudinal lesion deformation on PD volume...")
+            completed = yield self.doLongitudinalExams(inputPDVolume, "PD", lesionMapPD, outputFolder, numberFollowUp, balanceHI, Sigma["PD"], variability, seed, waitForCompletion=False)
+          except Exception:
+            logging.info("Exception caught when trying to generate longitudinal lesion deformation in PD volume.")
+            completed = False
+          if not completed:
+            return self.stopSimulation("the longitudinal lesions could not be simulated in the PD volume.")
+        if inputFAVolume is not None:
+          try:
+            slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on DTI-FA volume...")
+            logging.info("Extra: Generating longitudinal lesion deformation on DTI-FA volume...")
+            completed = yield self.doLongitudinalExams(inputFAVolume, "DTI-FA", lesionMapFA, outputFolder, numberFollowUp, balanceHI, Sigma["DTI-FA"], variability, seed, waitForCompletion=False)
+          except Exception:
+            logging.info("Exception caught when trying to generate longitudinal lesion deformation in FA volume.")
+            completed = False
+          if not completed:
+            return self.stopSimulation("the longitudinal lesions could not be simulated in the DTI-FA volume.")
+        if inputADCVolume is not None:
+          try:
+            slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on DTI-ADC volume...")
+            logging.info("Extra: Generating longitudinal lesion deformation on DTI-ADC volume...")
+            completed = yield self.doLongitudinalExams(inputADCVolume, "DTI-ADC", lesionMapADC, outputFolder, numberFollowUp, balanceHI, Sigma["DTI-ADC"], variability, seed, waitForCompletion=False)
+          except Exception:
+            logging.info("Exception caught when trying to generate longitudinal lesion deformation in ADC volume.")
+            completed = False
+          if not completed:
+            return self.stopSimulation("the longitudinal lesions could not be simulated in the DTI-ADC volume.")
+
+    finally:
+      # Removing unnecessary nodes
+      if self.profiler is not None:
+        self.profiler.startStage("Removing intermediate nodes")
+      for node in intermediateNodes:
+        slicer.mrmlScene.RemoveNode(node)
 
-      slicer.util.showStatusMessage("Step " + str(currentStep) + ": MNI152 template to native space...")
-      logging.info("Step " + str(currentStep) + ": MNI152 template to native space...")
-      currentStep += 1
-
-      MNI_ref = slicer.vtkMRMLScalarVolumeNode()
-      slicer.mrmlScene.AddNode(MNI_ref)
-      regMNItoRefTransform = slicer.vtkMRMLBSplineTransformNode()
-      slicer.mrmlScene.AddNode(regMNItoRefTransform)
-
-      self.doNonLinearRegistration(referenceVolume, MNINode, MNI_ref, regMNItoRefTransform, samplingPerc, grid, initiationMethod, numberOfThreads)
+    slicer.util.showStatusMessage("Processing completed")
+    logging.info('Processing completed')
+    self.writeProfilingReport()
 
-    #
-    # Find lesion mask using Probability Image, lesion labels and desired Lesion Load
-    #
-    slicer.util.showStatusMessage("Step "+str(currentStep)+": Simulating MS lesion map...")
-    logging.info("Step "+str(currentStep)+": Simulating MS lesion map...")
-    currentStep+=1
+    return True
 
-    lesionMap = slicer.vtkMRMLLabelMapVolumeNode()
-    slicer.mrmlScene.AddNode(lesionMap)
-    if platform.system() == "Windows":
-      self.doGenerateMask(MNINode, lesionLoad, lesionMap, databasePath+"\\labels-database")
-    else:
-      self.doGenerateMask(MNINode, lesionLoad, lesionMap, databasePath + "/labels-database")
 
+  def stopSimulation(self, reason):
+    """
+    End a simulation that did not complete, discarding its profiling
+    :param reason:
+    :return: False
+    """
+    slicer.util.showStatusMessage("Processing failed")
+    logging.info("ERROR: Processing stopped because " + reason)
+    if self.profiler is not None:
+      self.profiler.close()
+    self.profiler = None
+    return False
+
+  def generateLesionMaps(self, referenceVolume, isBET, isMNI, lesionLoads, seeds, outputFolder,
+                         samplingPerc, grid, initiationMethod, numberOfThreads):
+    """
+    Generate one lesion map for every lesion load and seed. The MNI152 template is loaded and registered
+    to the reference volume only once, and every lesion map is saved in outputFolder as soon as it is
+    generated.
+    :param referenceVolume: volume defining the native space of the lesion maps
+    :param lesionLoads: list of lesion loads, in mL
+    :param seeds: list of seeds of the lesion map generation
+    :return: list of the saved lesion map files
+    """
+    logging.info('Processing started')
+    self.configureInProcessExecution()
+    if not os.path.exists(outputFolder):
+      os.makedirs(outputFolder)
 
-    # Transforming lesion map to native space
+    databasePath = self.getDatabasePath()
+    MNINode = self.loadMNITemplate(databasePath, isBET)
+    lesionIndexPath = self.getLesionIndexPath()
 
     if not isMNI:
-      # Get transform logic for hardening transforms
-      transformLogic = slicer.vtkSlicerTransformLogic()
-
-      self.applyRegistrationTransform(lesionMap,referenceVolume,lesionMap,regMNItoRefTransform,False, True)
-      transformLogic.hardenTransform(lesionMap)
-
-    # Filtering lesion map to minimize or exclude regions outside of WM
-    if inputT1Volume is not None:
-      # Lesion Map: T1
-      lesionMapT1 = slicer.vtkMRMLLabelMapVolumeNode()
-      slicer.mrmlScene.AddNode(lesionMapT1)
-      lesionMapT1.SetName("T1_lesion_label")
-      self.doFilterMask(inputT1Volume, lesionMap, lesionMapT1, cutFraction)
-
-    if inputFLAIRVolume is not None:
-      # Lesion Map: T2-FLAIR
-      lesionMapFLAIR = slicer.vtkMRMLLabelMapVolumeNode()
-      slicer.mrmlScene.AddNode(lesionMapFLAIR)
-      lesionMapFLAIR.SetName("T2FLAIR_lesion_label")
-      self.doFilterMask(inputFLAIRVolume, lesionMap, lesionMapFLAIR, cutFraction)
-
-    if inputT2Volume is not None:
-      # Lesion Map: T2
-      lesionMapT2 = slicer.vtkMRMLLabelMapVolumeNode()
-      slicer.mrmlScene.AddNode(lesionMapT2)
-      lesionMapT2.SetName("T2_lesion_label")
-      self.doFilterMask(inputT2Volume, lesionMap, lesionMapT2, cutFraction)
-
-    if inputPDVolume is not None:
-      # Lesion Map: PD
-      lesionMapPD = slicer.vtkMRMLLabelMapVolumeNode()
-      slicer.mrmlScene.AddNode(lesionMapPD)
-      lesionMapPD.SetName("PD_lesion_label")
-      self.doFilterMask(inputPDVolume, lesionMap, lesionMapPD, cutFraction)
-
-    if inputFAVolume is not None:
-      # Lesion Map: DTI-FA
-      lesionMapFA = slicer.vtkMRMLLabelMapVolumeNode()
-      slicer.mrmlScene.AddNode(lesionMapFA)
-      lesionMapFA.SetName("FA_lesion_label")
-      self.doFilterMask(inputFAVolume, lesionMap, lesionMapFA, cutFraction)
-
-    if inputADCVolume is not None:
-      # Lesion Map: DTI-FA
-      lesionMapADC = slicer.vtkMRMLLabelMapVolumeNode()
-      slicer.mrmlScene.AddNode(lesionMapADC)
-      lesionMapADC.SetName("ADC_lesion_label")
-      self.doFilterMask(inputADCVolume, lesionMap, lesionMapADC, cutFraction)
-
-
-    #
-    # Generating lesions in each input image
-    #
-    # List of parameters: Sigma
-    Sigma= {}
-    Sigma["T1"]=0.75
-    Sigma["T2"]=0.75
-    Sigma["PD"]=0.75
-    Sigma["T2FLAIR"]=0.75
-    Sigma["DTI-FA"]=1.5
-    Sigma["DTI-ADC"]=1.3
-
-    variability = 0.5
-
-    if not isLongitudinal:
-      if inputT1Volume is not None:
-        try:
-          slicer.util.showStatusMessage("Step "+str(currentStep)+": Applying lesion deformation on T1 volume...")
-          logging.info("Step "+str(currentStep)+": Applying lesion deformation on T1 volume...")
-          self.doSimulateLesions(inputT1Volume, "T1", lesionMapT1, inputT1Volume, Sigma["T1"], variability)
-        except:
-          logging.info("Exception caught when trying to apply lesion deformation in T1 volume.")
-      if inputFLAIRVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Step "+str(currentStep)+": Applying lesion deformation on T2-FLAIR volume...")
-          logging.info("Step "+str(currentStep)+": Applying lesion deformation on T2-FLAIR volume...")
-          self.doSimulateLesions(inputFLAIRVolume, "T2-FLAIR", lesionMapFLAIR, inputFLAIRVolume, Sigma["T2FLAIR"], variability)
-        except:
-          logging.info("Exception caught when trying to apply lesion deformation in T2-FLAIR volume.")
-      if inputT2Volume is not None:
-        try:
-          slicer.util.showStatusMessage("Step "+str(currentStep)+": Applying lesion deformation on T2 volume...")
-          logging.info("Step "+str(currentStep)+": Applying lesion deformation on T2 volume...")
-          self.doSimulateLesions(inputT2Volume, "T2", lesionMapT2, inputT2Volume, Sigma["T2"], variability)
-        except:
-          logging.info("Exception caught when trying to apply lesion deformation in T2 volume.")
-      if inputPDVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Step "+str(currentStep)+": Applying lesion deformation on PD volume...")
-          logging.info("Step "+str(currentStep)+": Applying lesion deformation on PD volume...")
-          self.doSimulateLesions(inputPDVolume, "PD", lesionMapPD, inputPDVolume, Sigma["PD"], variability)
-        except:
-          logging.info("Exception caught when trying to apply lesion deformation in PD volume.")
-      if inputFAVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Step "+str(currentStep)+": Applying lesion deformation on DTI-FA map...")
-          logging.info("Step "+str(currentStep)+": Applying lesion deformation on DTI-FA volume...")
-          self.doSimulateLesions(inputFAVolume, "DTI-FA", lesionMapFA, inputFAVolume, Sigma["DTI-FA"], variability)
-        except:
-          logging.info("Exception caught when trying to apply lesion deformation in FA volume.")
-      if inputADCVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Step "+str(currentStep)+": Applying lesion deformation on DTI-ADC map...")
-          logging.info("Step "+str(currentStep)+": Applying lesion deformation on DTI-ADC volume...")
-          self.doSimulateLesions(inputADCVolume, "DTI-ADC", lesionMapADC, inputADCVolume, Sigma["DTI-ADC"], variability)
-        except:
-          logging.info("Exception caught when trying to apply lesion deformation in ADC volume.")
-    else:
-      #
-      # Simulate Longitudinal Exams
-      #
-      if inputT1Volume is not None:
-        try:
-          slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on T1 volume...")
-          logging.info("Extra: Generating longitudinal lesion deformation on T1 volume......")
-          self.doLongitudinalExams(inputT1Volume, "T1", lesionMapT1, outputFolder, numberFollowUp, balanceHI, Sigma["T1"], variability)
-        except:
-          logging.info("Exception caught when trying to generate longitudinal lesion deformation in T1 volume.")
-      if inputFLAIRVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on T2-FLAIR volume...")
-          logging.info("Extra: Generating longitudinal lesion deformation on T2-FLAIR volume......")
-          self.doLongitudinalExams(inputFLAIRVolume, "T2-FLAIR", lesionMapFLAIR, outputFolder, numberFollowUp, balanceHI, Sigma["T2FLAIR"], variability)
-        except:
-          logging.info("Exception caught when trying to generate longitudinal lesion deformation in T2-FLAIR volume.")
-      if inputT2Volume is not None:
-        try:
-          slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on T2 volume...")
-          logging.info("Extra: Generating longitudinal lesion deformation on T2 volume...")
-          self.doLongitudinalExams(inputT2Volume, "T2", lesionMapT2, outputFolder, numberFollowUp, balanceHI, Sigma["T2"], variability)
-        except:
-          logging.info("Exception caught when trying to generate longitudinal lesion deformation in T2 volume.")
-      if inputPDVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on PD volume...")
-          logging.info("Extra: Generating longitudinal lesion deformation on PD volume...")
-          self.doLongitudinalExams(inputPDVolume, "PD", lesionMapPD, outputFolder, numberFollowUp, balanceHI, Sigma["PD"], variability)
-        except:
-          logging.info("Exception caught when trying to generate longitudinal lesion deformation in PD volume.")
-      if inputFAVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on DTI-FA volume...")
-          logging.info("Extra: Generating longitudinal lesion deformation on DTI-FA volume...")
-          self.doLongitudinalExams(inputFAVolume, "DTI-FA", lesionMapFA, outputFolder, numberFollowUp, balanceHI, Sigma["DTI-FA"], variability)
-        except:
-          logging.info("Exception caught when trying to generate longitudinal lesion deformation in FA volume.")
-      if inputADCVolume is not None:
-        try:
-          slicer.util.showStatusMessage("Extra: Generating longitudinal lesion deformation on DTI-ADC volume...")
-          logging.info("Extra: Generating longitudinal lesion deformation on DTI-ADC volume...")
-          self.doLongitudinalExams(inputADCVolume, "DTI-ADC", lesionMapADC, outputFolder, numberFollowUp, balanceHI, Sigma["DTI-ADC"], variability)
-        except:
-          logging.info("Exception caught when trying to generate longitudinal lesion deformation in ADC volume.")
+      slicer.util.showStatusMessage("MNI152 template to native space...")
+      logging.info("MNI152 template to native space...")
+      regMNItoRefTransform = self.registerMNIToReference(referenceVolume, MNINode, isBET, samplingPerc, grid, initiationMethod, numberOfThreads)
+      if regMNItoRefTransform is None:
+        logging.info("ERROR: the MNI152 template could not be registered to reference space.")
+        slicer.mrmlScene.RemoveNode(MNINode)
+        return []
+      nativeLesionMap = slicer.vtkMRMLLabelMapVolumeNode()
+      slicer.mrmlScene.AddNode(nativeLesionMap)
 
-    currentStep+=1
-    #
-    # Return inputs to its original space
-    #
-    if returnSpace and not isMNI:
-      if inputT2Volume is not None and inputT2Volume is not referenceVolume:
-        try:
-          slicer.util.showStatusMessage("post-processing: Returning T2 image space...")
-          logging.info("post-processing: Returning T2 image space...")
-          # T2 inverse transform
-          self.applyRegistrationTransform(inputT2Volume,clonedT2Volume,inputT2Volume,regT2toRefTransform,True,False)
-        except:
-          logging.info("Exception caught when trying to return T2 image space.")
-      if inputFLAIRVolume is not None and inputFLAIRVolume is not referenceVolume:
-        try:
-          slicer.util.showStatusMessage("post-processing: Returning T2-FLAIR image space...")
-          logging.info("post-processing: Returning T2-FLAIR image space...")
-          # T2-FLAIR inverse transform
-          self.applyRegistrationTransform(inputFLAIRVolume,clonedFLAIRVolume,inputFLAIRVolume,regFLAIRtoRefTransform,True,False)
-        except:
-          logging.info("Exception caught when trying to return T2-FLAIR image space.")
-      if inputPDVolume is not None and inputPDVolume is not referenceVolume:
-        try:
-          slicer.util.showStatusMessage("post-processing: Returning PD image space...")
-          logging.info("post-processing: Returning PD image space...")
-          # PD inverse transform
-          self.applyRegistrationTransform(inputPDVolume, clonedPDVolume, inputPDVolume, regPDtoRefTransform, True, False)
-        except:
-          logging.info("Exception caught when trying to return PD image space.")
-      if inputFAVolume is not None:
-        try:
-          slicer.util.showStatusMessage("post-processing: Returning DTI-FA map space...")
-          logging.info("post-processing: Returning DTI-FA image space...")
-          # DTI-FA inverse transform
-          self.applyRegistrationTransform(inputFAVolume, clonedFAVolume, inputFAVolume, regFAtoRefTransform, True, False)
-        except:
-          logging.info("Exception caught when trying to return FA image space.")
-      if inputADCVolume is not None:
-        try:
-          slicer.util.showStatusMessage("post-processing: Returning DTI-ADC map space...")
-          logging.info("post-processing: Returning DTI-ADC image space...")
-          # DTI-ADC inverse transform
-          self.applyRegistrationTransform(inputADCVolume, clonedADCVolume, inputADCVolume, regADCtoRefTransform, True, False)
-        except:
-          logging.info("Exception caught when trying to return ADC image space.")
+    lesionMap = slicer.vtkMRMLLabelMapVolumeNode()
+    slicer.mrmlScene.AddNode(lesionMap)
+
+    # The CLI nodes are created once and run again for every lesion map
+    generateMaskCliNode = None
+    resampleCliNode = None
+    outputFiles = []
+    for lesionLoad in lesionLoads:
+      for seed in seeds:
+        slicer.util.showStatusMessage("Simulating MS lesion map: " + str(lesionLoad) + " mL, seed " + str(seed) + "...")
+        logging.info("Simulating MS lesion map: " + str(lesionLoad) + " mL, seed " + str(seed) + "...")
+        generateMaskCliNode = self.doGenerateMask(MNINode, lesionLoad, lesionMap, os.path.join(databasePath, "labels-database"),
+                                                  lesionIndexPath, seed, generateMaskCliNode)
+        outputLesionMap = lesionMap
+        if not isMNI:
+          resampleCliNode = self.applyRegistrationTransform(lesionMap, referenceVolume, nativeLesionMap, regMNItoRefTransform,
+                                                            False, True, resampleCliNode)
+          outputLesionMap = nativeLesionMap
+
+        outputFile = os.path.join(outputFolder, "lesion_map_" + str(lesionLoad) + "mL_seed" + str(seed) + ".nii.gz")
+        slicer.util.saveNode(outputLesionMap, outputFile)
+        outputFiles.append(outputFile)
 
     # Removing unnecessary nodes
     slicer.mrmlScene.RemoveNode(lesionMap)
     slicer.mrmlScene.RemoveNode(MNINode)
+    for cliNode in [generateMaskCliNode, resampleCliNode]:
+      if cliNode is not None:
+        slicer.mrmlScene.RemoveNode(cliNode)
     if not isMNI:
-      slicer.mrmlScene.RemoveNode(MNI_ref)
+      slicer.mrmlScene.RemoveNode(nativeLesionMap)
       slicer.mrmlScene.RemoveNode(regMNItoRefTransform)
 
-      if inputFLAIRVolume is not None and inputFLAIRVolume is not referenceVolume:
-        try:
-          slicer.mrmlScene.RemoveNode(regFLAIRtoRefTransform)
-          slicer.mrmlScene.RemoveNode(clonedFLAIRVolume)
-        except:
-          logging.info('Exception caught when trying to delete FLAIR in T1 space node.')
-      if inputT2Volume is not None and inputT2Volume is not referenceVolume:
-        try:
-          slicer.mrmlScene.RemoveNode(regT2toRefTransform)
-          slicer.mrmlScene.RemoveNode(clonedT2Volume)
-        except:
-          logging.info('Exception caught when trying to delete T2 in T1 space node.')
-      if inputPDVolume is not None and inputPDVolume is not referenceVolume:
-        try:
-          slicer.mrmlScene.RemoveNode(regPDtoRefTransform)
-          slicer.mrmlScene.RemoveNode(clonedPDVolume)
-        except:
-          logging.info('Exception caught when trying to delete PD in T1 space node.')
-      if inputFAVolume is not None:
-        try:
-          slicer.mrmlScene.RemoveNode(regFAtoRefTransform)
-          slicer.mrmlScene.RemoveNode(clonedFAVolume)
-        except:
-          logging.info('Exception caught when trying to delete FA in T1 space node.')
-      if inputADCVolume is not None:
-        try:
-          slicer.mrmlScene.RemoveNode(regADCtoRefTransform)
-          slicer.mrmlScene.RemoveNode(clonedADCVolume)
-        except:
-          logging.info('Exception caught when trying to delete ADC in T1 space node.')
-
     slicer.util.showStatusMessage("Processing completed")
     logging.info('Processing completed')
+    return outputFiles
 
-    return True
+  def getDatabasePath(self):
+    modulePath = os.path.dirname(slicer.modules.mslesionsimulator.path)
+
+    if platform.system() == "Windows":
+      return modulePath + "\\Resources\\MSlesion_database"
+    else:
+      return modulePath + "/Resources/MSlesion_database"
+
+  def loadMNITemplate(self, databasePath, isBET):
+    """
+    Read the MNI152 T1 template, brain extracted if isBET
+    :param databasePath:
+    :param isBET:
+    :return:
+    """
+    if isBET:
+      (readSuccess, MNINode)=slicer.util.loadVolume(os.path.join(databasePath, "MNI152_T1_1mm_brain.nii.gz"),{},True)
+    else:
+      (readSuccess, MNINode)=slicer.util.loadVolume(os.path.join(databasePath, "MNI152_T1_1mm.nii.gz"),{},True)
+    return MNINode
 
+  def registerMNIToReference(self, referenceVolume, MNINode, isBET, samplingPerc, grid, initiationMethod, numberOfThreads):
+    """
+    Transform from the MNI152 template to the reference volume space, read from the registration cache
+    when available. Only the transform is computed: the template itself is never resampled, the lesion
+    map is.
+    :return: transform node, None if the registration did not complete
+    """
+    return self.runSteps(self.registerMNIToReferenceSteps(referenceVolume, MNINode, isBET, samplingPerc, grid,
+                                                          initiationMethod, numberOfThreads))
+
+  def registerMNIToReferenceSteps(self, referenceVolume, MNINode, isBET, samplingPerc, grid, initiationMethod, numberOfThreads):
+    """
+    Steps of registerMNIToReference (see simulationSteps)
+    :return: transform node, None if the registration did not complete
+    """
+    registrationCache = self.getRegistrationCache()
+    if registrationCache is not None:
+      registrationKey = registrationCache.computeKey(referenceVolume, samplingPerc, grid, initiationMethod, isBET)
+      regMNItoRefTransform = registrationCache.loadTransform(registrationKey)
+      if regMNItoRefTransform is not None:
+        logging.info("MNI152 to native space transform found in the registration cache.")
+        return regMNItoRefTransform
+
+    regMNItoRefTransform = slicer.vtkMRMLBSplineTransformNode()
+    slicer.mrmlScene.AddNode(regMNItoRefTransform)
+
+    completed = yield self.doNonLinearRegistration(referenceVolume, MNINode, None, regMNItoRefTransform, samplingPerc, grid,
+                                                   initiationMethod, numberOfThreads, waitForCompletion=False)
+    if not completed:
+      slicer.mrmlScene.RemoveNode(regMNItoRefTransform)
+      return None
+    if registrationCache is not None:
+      try:
+        registrationCache.storeTransform(registrationKey, regMNItoRefTransform)
+      except OSError:
+        logging.info("Exception caught when trying to save the transform in the registration cache.")
+    return regMNItoRefTransform
+
+  def runCLI(self, module, cliNode, parameters, waitForCompletion=True):
+    """
+    Run a CLI module, measured by the profiler of the current run
+    :param module:
+    :param cliNode: CLI node of a previous execution to be reused, or None
+    :param parameters:
+    :param waitForCompletion: if False, waitForCompletion must be called for the returned node
+    :return: CLI node
+    """
+    if self.profiler is None:
+      return slicer.cli.run(module, cliNode, parameters, wait_for_completion=waitForCompletion)
+    if cliNode is None:
+      cliNode = slicer.cli.createNode(module)
+    self.profiler.startCLI(cliNode, module.name)
+    cliNode = slicer.cli.run(module, cliNode, parameters, wait_for_completion=waitForCompletion)
+    if waitForCompletion:
+      self.profiler.endCLI(cliNode)
+    return cliNode
+
+  def writeProfilingReport(self):
+    """
+    End the profiling of the current run, log its stages and save the report in profilingReportPath if set
+    :return:
+    """
+    from MSLesionSimulatorLib.Profiling import logReport
+    if self.profilingReportPath:
+      try:
+        self.profilingReport = self.profiler.write(self.profilingReportPath)
+      except OSError:
+        logging.info("Exception caught when trying to save the profiling report.")
+        self.profilingReport = self.profiler.report()
+    else:
+      self.profilingReport = self.profiler.report()
+    logReport(self.profilingReport)
+    self.profiler = None
 
-  def conformInputSpace(self, fixedNode, movingNode, resultNode, transform, numberOfThreads):
+  def waitForCompletion(self, cliNodes):
+    """
+    Wait for CLI modules started without waiting for completion, keeping the application responsive
+    :param cliNodes:
+    :return: True if all of them completed without errors
+    """
+    success = True
+    for cliNode in cliNodes:
+      while cliNode.IsBusy():
+        slicer.app.processEvents()
+        time.sleep(0.05)
+      if cliNode.GetStatus() != cliNode.Completed:
+        logging.info(cliNode.GetName() + " did not complete: " + cliNode.GetErrorText())
+        success = False
+      if self.profiler is not None:
+        self.profiler.endCLI(cliNode)
+      slicer.mrmlScene.RemoveNode(cliNode)
+    return success
+
+  def runSteps(self, steps):
+    """
+    Run a generator of CLI steps (see simulationSteps), waiting for the CLIs of every step
+    :param steps:
+    :return: value returned by the generator
+    """
+    try:
+      cliNodes = next(steps)
+      while True:
+        completed = self.waitForCompletion(cliNodes if isinstance(cliNodes, list) else [cliNodes])
+        cliNodes = steps.send(completed)
+    except StopIteration as stop:
+      return stop.value
+
+  def startSteps(self, steps, progressCallback=None, finishedCallback=None):
+    """
+    Run a generator of CLI steps (see simulationSteps) without blocking the application: the generator is
+    resumed from the status events of the CLI nodes, when the CLIs of the current step are finished
+    :param steps:
+    :param progressCallback: called with the name and progress (0 to 100) of the running CLI
+    :param finishedCallback: called with the value returned by the generator, False if it failed or was cancelled
+    :return:
+    """
+    if self.isRunning():
+      raise RuntimeError("A simulation is already running.")
+    self.steps = steps
+    self.stepCliNodes = []
+    self.stepObservations = []
+    self.stepCancelled = False
+    self.progressCallback = progressCallback
+    self.finishedCallback = finishedCallback
+    self.resumeSteps(None)
+
+  def isRunning(self):
+    return self.steps is not None
+
+  def cancel(self):
+    """
+    Cancel the simulation started by runAsync, aborting its running CLIs. The finished callback is called
+    once they are stopped.
+    :return:
+    """
+    if not self.isRunning():
+      return
+    logging.info("Cancelling the simulation...")
+    self.stepCancelled = True
+    for cliNode in self.stepCliNodes:
+      cliNode.Cancel()
+    if not self.stepCliNodes:
+      self.finishSteps(False)
+
+  def resumeSteps(self, completed):
+    """
+    Resume the steps with the completion of the previous ones, starting the CLIs of the next step
+    :param completed: True if the CLIs of the previous step completed, None to start the steps
+    :return:
+    """
+    try:
+      cliNodes = self.steps.send(completed)
+    except StopIteration as stop:
+      self.finishSteps(stop.value)
+      return
+    except Exception:
+      logging.exception("Exception caught when running the simulation.")
+      self.finishSteps(False)
+      return
+    self.stepCliNodes = cliNodes if isinstance(cliNodes, list) else [cliNodes]
+    for cliNode in self.stepCliNodes:
+      self.stepObservations.append((cliNode, cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode.StatusModifiedEvent,
+                                                                 self.onStepCLIModified)))
+    self.onStepCLIModified()
+
+  def onStepCLIModified(self, caller=None, event=None):
+    runningCliNodes = [cliNode for cliNode in self.stepCliNodes if cliNode.IsBusy()]
+    if runningCliNodes:
+      if self.progressCallback is not None:
+        self.progressCallback(runningCliNodes[0].GetName(), runningCliNodes[0].GetProgress())
+      return
+    for cliNode, observation in self.stepObservations:
+      cliNode.RemoveObserver(observation)
+    self.stepObservations = []
+    # The CLI nodes are removed from the scene, so the next step is not started from their own events
+    qt.QTimer.singleShot(0, self.onStepCompleted)
+
+  def onStepCompleted(self):
+    if not self.isRunning():
+      return
+    completed = self.waitForCompletion(self.stepCliNodes)
+    self.stepCliNodes = []
+    if self.stepCancelled:
+      self.finishSteps(False)
+    else:
+      self.resumeSteps(completed)
+
+  def finishSteps(self, result):
+    """
+    End the steps, closing the generator if they were cancelled, and report their result
+    :param result:
+    :return:
+    """
+    steps, finishedCallback = self.steps, self.finishedCallback
+    self.steps = None
+    self.progressCallback = None
+    self.finishedCallback = None
+    # Removes the intermediate nodes of cancelled steps
+    steps.close()
+    if self.profiler is not None:
+      self.profiler.close()
+    self.profiler = None
+    if self.stepCancelled:
+      slicer.util.showStatusMessage("Processing cancelled")
+      logging.info("Processing cancelled")
+    if finishedCallback is not None:
+      finishedCallback(result)
+
+  def conformInputSpace(self, fixedNode, movingNode, resultNode, transform, numberOfThreads, waitForCompletion=True):
     regParams = {}
     regParams["fixedVolume"] = fixedNode.GetID()
     regParams["movingVolume"] = movingNode.GetID()
     regParams["samplingPercentage"] = 0.002
     regParams["linearTransform"] = transform.GetID()
-    regParams["outputVolume"] = resultNode.GetID()
+    if resultNode is not None:
+      regParams["outputVolume"] = resultNode.GetID()
     regParams["initializeTransformMode"] = "useMomentsAlign"
     regParams["useRigid"] = True
     regParams["useAffine"] = True
     regParams["numberOfThreads"] = numberOfThreads
 
-    slicer.cli.run(slicer.modules.brainsfit, None, regParams, wait_for_completion=True)
+    return self.runCLI(slicer.modules.brainsfit, None, regParams, waitForCompletion)
 
-  def doNonLinearRegistration(self, fixedNode, movingNode, resultNode, transform, samplePerc, grid, initiationMethod, numberOfThreads):
+  def doNonLinearRegistration(self, fixedNode, movingNode, resultNode, transform, samplePerc, grid, initiationMethod, numberOfThreads,
+                              waitForCompletion=True):
     """
     Execute the BrainsFit registration
     :param fixedNode:
     :param movingNode:
-    :param resultNode:
-    :return:
+    :param resultNode: moving volume resampled by the registration, None to only compute the transform
+    :param waitForCompletion: if False, waitForCompletion must be called for the returned node
+    :return: CLI node
     """
     regParams = {}
     regParams["fixedVolume"] = fixedNode.GetID()
     regParams["movingVolume"] = movingNode.GetID()
     regParams["samplingPercentage"] = samplePerc
     regParams["splineGridSize"] = grid
-    regParams["outputVolume"] = resultNode.GetID()
+    if resultNode is not None:
+      regParams["outputVolume"] = resultNode.GetID()
     # regParams["linearTransform"] = transform.GetID()
     regParams["bsplineTransform"] = transform.GetID()
     regParams["initializeTransformMode"] = initiationMethod
@@ -850,54 +1285,138 @@ class MSLesionSimulatorLogic(ScriptedLoadableModuleLogic):
     regParams["useBSpline"] = True
     regParams["numberOfThreads"] = numberOfThreads
 
-    slicer.cli.run(slicer.modules.brainsfit, None, regParams, wait_for_completion=True)
+    return self.runCLI(slicer.modules.brainsfit, None, regParams, waitForCompletion)
+
+  def getLesionIndexPath(self):
+    """
+    Location of the packed lesion atlas index used by GenerateMask. The index is built once from the
+    labels-database directory on the first run and kept in the application cache folder.
+    :return:
+    """
+    cacheFolder = os.path.join(slicer.app.cachePath, "MSLesionSimulator")
+    if not os.path.exists(cacheFolder):
+      try:
+        os.makedirs(cacheFolder)
+      except OSError:
+        logging.info("Could not create the lesion atlas index folder. Lesions will be read from the database directory.")
+        return ""
+    return os.path.join(cacheFolder, "labels-database.idx")
+
+  def getRegistrationCache(self):
+    """
+    Cache of the MNI152 to native space transforms, None if disabled
+    :return:
+    """
+    if not self.registrationCacheFolder:
+      return None
+    from MSLesionSimulatorLib.RegistrationCache import RegistrationCache
+    return RegistrationCache(self.registrationCacheFolder, self.registrationCacheMaximumSize * 1024 * 1024)
 
-  def doGenerateMask(self, probNode, lesionLoad, resultNode, databasePath):
+  def configureInProcessExecution(self):
+    """
+    Allow or forbid the in-memory transfer of volumes to the lesion simulation CLIs. When a CLI is loaded
+    as a shared library, Slicer runs it inside its own process and passes the MRML volumes to it in memory,
+    avoiding the temporary files written and read back around every execution. A CLI loaded as an
+    executable always exchanges temporary files. In low memory mode, DeformImage exchanges .mha files,
+    which it writes by parts.
+    :return: names of the CLIs that do not run in process
+    """
+    outOfProcess = []
+    for module in [slicer.modules.generatemask, slicer.modules.filtermask,
+                   slicer.modules.deformimage, slicer.modules.mslongitudinalexams]:
+      module.cliModuleLogic().SetAllowInMemoryTransfer(self.inProcess and not (self.lowMemory and module.name == "DeformImage"))
+      cliNode = slicer.cli.createNode(module)
+      if cliNode.GetModuleType() != "SharedObjectModule":
+        outOfProcess.append(module.name)
+      slicer.mrmlScene.RemoveNode(cliNode)
+    if self.inProcess and outOfProcess:
+      logging.info("The CLIs " + ", ".join(outOfProcess) + " are loaded as executables and exchange their volumes "
+                   "through temporary files. Disable the 'Prefer executable CLIs' application setting to run them in process.")
+    return outOfProcess
+
+  def doGenerateMask(self, probNode, lesionLoad, resultNode, databasePath, lesionIndexPath="", seed=0, cliNode=None,
+                     waitForCompletion=True):
     """
     Execute the GenerateMask CLI
     :param inputVolume:
     :param outputVolume:
     :param lesionLoad:
     :param databasePath:
-    :return:
+    :param lesionIndexPath:
+    :param seed:
+    :param cliNode: CLI node of a previous execution to be reused
+    :param waitForCompletion: if False, waitForCompletion must be called for the returned node
+    :return: CLI node
     """
     cliParams = {'inputVolume': probNode, 'outputVolume': resultNode.GetID(), 'lesionLoad': lesionLoad,
-                 'databasePath': databasePath}
-    return( slicer.cli.run(slicer.modules.generatemask, None, cliParams, wait_for_completion=True) )
+                 'databasePath': databasePath, 'lesionIndex': lesionIndexPath, 'seed': seed,
+                 'compressionLevel': INTERMEDIATE_COMPRESSION_LEVEL}
+    return( self.runCLI(slicer.modules.generatemask, cliNode, cliParams, waitForCompletion) )
+
+  def runBatch(self, manifestPath, outputFolder, numberOfWorkers=1):
+    """
+    Simulate a cohort of subjects described by a JSON manifest (see MSLesionSimulatorLib.Batch). Every
+    subject, lesion load and seed is processed by a separate Slicer process without main window.
+    :param manifestPath:
+    :param outputFolder:
+    :param numberOfWorkers: number of simultaneous worker processes
+    :return: list of job results
+    """
+    from MSLesionSimulatorLib import Batch
+    return Batch.runCohort(manifestPath, outputFolder, numberOfWorkers, slicer.app.launcherExecutableFilePath)
 
-  def doFilterMask(self, inputVolume, inputMask, resultMask, cutFactor):
+  def doFilterMask(self, inputVolumes, inputMask, resultMasks, cutFactor, waitForCompletion=True):
     """
     Execute the FilterMask CLI
-    :param inputVolume:
+    :param inputVolumes: volume or list of up to six volumes filtered by the same mask
     :param inputMask:
-    :param resultMask:
-    :return:
+    :param resultMasks: filtered mask of each input volume
+    :param waitForCompletion: if False, waitForCompletion must be called for the returned node
+    :return: CLI node
     """
-    cliParams = {'inputVolume': inputVolume, 'inputMask': inputMask, 'outputVolume': resultMask, 'cutFactor': cutFactor}
-    return( slicer.cli.run(slicer.modules.filtermask, None, cliParams, wait_for_completion=True) )
-
-  def doSimulateLesions(self, inputVolume, imageModality, lesionLabel, outputVolume, sigma, variability):
+    if not isinstance(inputVolumes, list):
+      inputVolumes = [inputVolumes]
+      resultMasks = [resultMasks]
+    cliParams = {'inputMask': inputMask, 'cutFactor': cutFactor, 'compressionLevel': INTERMEDIATE_COMPRESSION_LEVEL}
+    for i in range(len(inputVolumes)):
+      suffix = str(i + 1) if i > 0 else ""
+      cliParams['inputVolume' + suffix] = inputVolumes[i]
+      cliParams['outputVolume' + suffix] = resultMasks[i]
+    return( self.runCLI(slicer.modules.filtermask, None, cliParams, waitForCompletion) )
+
+  def doSimulateLesions(self, inputVolume, imageModality, lesionLabel, outputVolume, sigma, variability, seed=0,
+                        waitForCompletion=True):
     """
     Execute the DeformImage CLI
-    :param inputVolume:
-    :param imageModality:
-    :param lesionLabel:
-    :param outputVolume:
-    :param sigma:
+    :param inputVolume: volume or list of up to six volumes
+    :param imageModality: modality of each input volume
+    :param lesionLabel: lesion label of each input volume
+    :param outputVolume: output of each input volume
+    :param sigma: smoothing sigma of each input volume
     :param variability:
-    :return:
+    :param seed: seed of the lesion texture, 0 for a time based seed
+    :param waitForCompletion: if False, waitForCompletion must be called for the returned node
+    :return: CLI node
     """
+    if not isinstance(inputVolume, list):
+      inputVolume, imageModality, lesionLabel, outputVolume, sigma = [inputVolume], [imageModality], [lesionLabel], [outputVolume], [sigma]
     params = {}
-    params["inputVolume"] = inputVolume.GetID()
-    params["imageModality"] = imageModality
-    params["lesionLabel"] = lesionLabel.GetID()
-    params["outputVolume"] = outputVolume.GetID()
-    params["sigma"] = sigma
+    for i in range(len(inputVolume)):
+      suffix = str(i + 1) if i > 0 else ""
+      params["inputVolume" + suffix] = inputVolume[i].GetID()
+      params["imageModality" + suffix] = imageModality[i]
+      params["lesionLabel" + suffix] = lesionLabel[i].GetID()
+      params["outputVolume" + suffix] = outputVolume[i].GetID()
+      params["sigma" + suffix] = sigma[i]
     params["variability"] = variability
+    params["lowMemory"] = self.lowMemory
+    params["seed"] = seed
+    params["compressionLevel"] = INTERMEDIATE_COMPRESSION_LEVEL
 
-    slicer.cli.run(slicer.modules.deformimage, None, params, wait_for_completion=True)
+    return self.runCLI(slicer.modules.deformimage, None, params, waitForCompletion)
 
-  def applyRegistrationTransform(self, inputVolume, referenceVolume, outputVolume, warpTransform, doInverse, isLabelMap):
+  def applyRegistrationTransform(self, inputVolume, referenceVolume, outputVolume, warpTransform, doInverse, isLabelMap, cliNode=None,
+                                 waitForCompletion=True):
     """
     Execute the Resample Volume CLI
     :param inputVolume:
@@ -907,7 +1426,9 @@ class MSLesionSimulatorLogic(ScriptedLoadableModuleLogic):
     :param warpTransform:
     :param inverseTransform:
     :param interpolationMode:
-    :return:
+    :param cliNode: CLI node of a previous execution to be reused
+    :param waitForCompletion: if False, waitForCompletion must be called for the returned node
+    :return: CLI node
     """
     params = {}
     params["inputVolume"] = inputVolume.GetID()
@@ -922,9 +1443,29 @@ class MSLesionSimulatorLogic(ScriptedLoadableModuleLogic):
       params["interpolationMode"] = "Linear"
       params["pixelType"] = "float"
 
-    slicer.cli.run(slicer.modules.brainsresample, None, params, wait_for_completion=True)
+    return self.runCLI(slicer.modules.brainsresample, cliNode, params, waitForCompletion)
 
-  def doLongitudinalExams(self, inputVolume, imageModality, lesionLabel, outputFolder, numberFollowUp, balanceHI, sigma, variability):
+  def composeTransforms(self, MNIToReferenceTransform, conformTransform):
+    """
+    Transform from the MNI152 space to the native space of a modality: the MNI152 registration followed by
+    the inverse of the conforming registration of the modality, so that the lesion map is resampled only
+    once into the modality grid
+    :param MNIToReferenceTransform: transform of the MNI152 template to the reference volume
+    :param conformTransform: transform of the modality to the reference volume
+    :return: transform node
+    """
+    # Resampling direction, the one of the BRAINSFit transforms: native to reference, then reference to MNI152
+    transformFromNative = vtk.vtkGeneralTransform()
+    transformFromNative.PostMultiply()
+    transformFromNative.Concatenate(conformTransform.GetTransformToParent())
+    transformFromNative.Concatenate(MNIToReferenceTransform.GetTransformFromParent())
+    MNItoNativeTransform = slicer.vtkMRMLTransformNode()
+    slicer.mrmlScene.AddNode(MNItoNativeTransform)
+    MNItoNativeTransform.SetAndObserveTransformFromParent(transformFromNative)
+    return MNItoNativeTransform
+
+  def doLongitudinalExams(self, inputVolume, imageModality, lesionLabel, outputFolder, numberFollowUp, balanceHI, sigma, variability, seed=0,
+                          waitForCompletion=True):
     """
     Execute the SimulateLongitudinalLesions CLI
     :param inputVolume:
@@ -935,7 +1476,9 @@ class MSLesionSimulatorLogic(ScriptedLoadableModuleLogic):
     :param outputFolder:
     :param variability:
     :param sigma:
-    :return:
+    :param seed: seed of the lesion texture, 0 for a time based seed
+    :param waitForCompletion: if False, waitForCompletion must be called for the returned node
+    :return: CLI node
     """
     params = {}
     params["inputVolume"] = inputVolume.GetID()
@@ -946,8 +1489,9 @@ class MSLesionSimulatorLogic(ScriptedLoadableModuleLogic):
     params["outputFolder"] = outputFolder
     params["sigma"] = sigma
     params["variability"] = variability
+    params["seed"] = seed
 
-    slicer.cli.run(slicer.modules.mslongitudinalexams, None, params, wait_for_completion=True)
+    return self.runCLI(slicer.modules.mslongitudinalexams, None, params, waitForCompletion)
 
 class MSLesionSimulatorTest(ScriptedLoadableModuleTest):
   """
@@ -966,6 +1510,8 @@ class MSLesionSimulatorTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_MSLesionSimulator1()
+    self.setUp()
+    self.test_ComposeTransforms()
 
   def test_MSLesionSimulator1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -1002,3 +1548,37 @@ class MSLesionSimulatorTest(ScriptedLoadableModuleTest):
     logic = MSLesionSimulatorLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_ComposeTransforms(self):
+    """ The composed transform maps a native point to the reference space with the conforming registration,
+    then to the MNI152 space with the inverse of the MNI152 registration, as the BRAINSFit transforms.
+    """
+    self.delayDisplay("Starting the transform composition test")
+
+    def linearTransform(elements):
+      matrix = vtk.vtkMatrix4x4()
+      for row in range(3):
+        for column in range(4):
+          matrix.SetElement(row, column, elements[row * 4 + column])
+      transformNode = slicer.vtkMRMLLinearTransformNode()
+      slicer.mrmlScene.AddNode(transformNode)
+      transformNode.SetMatrixTransformToParent(matrix)
+      return transformNode, matrix
+
+    MNIToReference, MNIToReferenceMatrix = linearTransform([1.1, 0.1, 0.0, 5.0, -0.05, 0.9, 0.2, -3.0, 0.0, 0.1, 1.2, 12.0])
+    conform, conformMatrix = linearTransform([0.0, -1.0, 0.0, -7.0, 1.0, 0.0, 0.0, 4.0, 0.0, 0.0, 2.0, 0.5])
+
+    logic = MSLesionSimulatorLogic()
+    MNIToNative = logic.composeTransforms(MNIToReference, conform)
+
+    referenceToMNIMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Invert(MNIToReferenceMatrix, referenceToMNIMatrix)
+    expectedMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(referenceToMNIMatrix, conformMatrix, expectedMatrix)
+    transformFromNative = MNIToNative.GetTransformFromParent()
+    for point in [[0.0, 0.0, 0.0], [10.0, -20.0, 30.0], [-4.5, 7.25, 100.0]]:
+      expected = expectedMatrix.MultiplyPoint(point + [1.0])[:3]
+      composed = transformFromNative.TransformPoint(point)
+      for composedValue, expectedValue in zip(composed, expected):
+        self.assertAlmostEqual(composedValue, expectedValue, places=6)
+    self.delayDisplay('Test passed!')
@@ -0,0 +1,363 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Batch (cohort) execution of the MS lesion simulation.
+
+A cohort is described by a JSON manifest:
+
+  {
+    "subjects": [
+      {"id": "sub01", "T1": "/data/sub01_T1.nii.gz", "T2-FLAIR": "/data/sub01_FLAIR.nii.gz"},
+      {"id": "sub02", "T1": "/data/sub02_T1.nii.gz"}
+    ],
+    "lesionLoads": [5, 10, 20],
+    "seeds": [1, 2],
+    "parameters": {"isBET": true, "numberOfThreads": 4}
+  }
+
+Every subject is simulated for every lesion load and seed. Each of these jobs runs in its own
+Slicer process without main window, so jobs are scheduled across a pool of worker processes.
+Results are written to <outputFolder>/<subject>/<lesionLoad>mL_seed<seed>/ as soon as a job
+finishes, and one line per job is appended to <outputFolder>/cohort_results.jsonl. A failed job
+is reported there without aborting the rest of the cohort. The timing and memory report of each
+simulation is saved in its folder as profile.json, and the statistics of all of them in
+<outputFolder>/cohort_profile.json (see Profiling).
+
+With "lesionMapsOnly": true in the parameters, only the lesion maps are generated: each subject is a
+single job that registers the MNI152 template once and saves one lesion map per lesion load and seed
+(see MSLesionSimulatorLogic.generateLesionMaps).
+
+Headless usage (no Slicer GUI is started):
+
+  python Batch.py manifest.json --output /results --workers 4 --slicer /opt/Slicer/Slicer
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+  from MSLesionSimulatorLib.Profiling import aggregateReportFiles
+except ImportError:
+  # Run as a script from the MSLesionSimulatorLib folder
+  from Profiling import aggregateReportFiles
+
+MODALITIES = ["T1", "T2", "T2-FLAIR", "PD", "DTI-FA", "DTI-ADC"]
+
+# Same defaults as the MS Lesion Simulator module panel
+DEFAULT_PARAMETERS = {
+  "returnSpace": False,
+  "isBET": False,
+  "isMNI": False,
+  "isLongitudinal": False,
+  "numberFollowUp": 2,
+  "balanceHI": 56,
+  "cutFraction": 1.5,
+  "samplingPerc": 0.05,
+  "grid": "5,5,5",
+  "initiationMethod": "useCenterOfHeadAlign",
+  "numberOfThreads": -1,
+  "lesionMapsOnly": False,
+  "lowMemory": False,
+}
+
+# Name given by MSLesionSimulatorLogic.run to the lesion label of each modality
+LESION_LABEL_NAMES = {
+  "T1": "T1_lesion_label",
+  "T2": "T2_lesion_label",
+  "T2-FLAIR": "T2FLAIR_lesion_label",
+  "PD": "PD_lesion_label",
+  "DTI-FA": "FA_lesion_label",
+  "DTI-ADC": "ADC_lesion_label",
+}
+
+
+def loadManifest(manifestPath):
+  """
+  Read a cohort manifest file
+  :param manifestPath:
+  :return:
+  """
+  with open(manifestPath) as manifestFile:
+    manifest = json.load(manifestFile)
+  if not manifest.get("subjects"):
+    raise ValueError("The manifest does not list any subject.")
+  return manifest
+
+
+def expandJobs(manifest):
+  """
+  List the jobs of a cohort: one job per subject, lesion load and seed
+  :param manifest:
+  :return:
+  """
+  parameters = dict(DEFAULT_PARAMETERS)
+  parameters.update(manifest.get("parameters", {}))
+  lesionLoads = manifest.get("lesionLoads", [10])
+  seeds = manifest.get("seeds", [0])
+
+  jobs = []
+  for subject in manifest["subjects"]:
+    inputs = {modality: subject[modality] for modality in MODALITIES if subject.get(modality)}
+    if parameters["lesionMapsOnly"]:
+      jobs.append({"subject": subject["id"],
+                   "inputs": inputs,
+                   "lesionLoad": lesionLoads,
+                   "seed": seeds,
+                   "parameters": parameters})
+      continue
+    for lesionLoad in lesionLoads:
+      for seed in seeds:
+        jobs.append({"subject": subject["id"],
+                     "inputs": inputs,
+                     "lesionLoad": lesionLoad,
+                     "seed": seed,
+                     "parameters": parameters})
+  return jobs
+
+
+def jobOutputFolder(outputFolder, job):
+  if job["parameters"]["lesionMapsOnly"]:
+    return os.path.join(outputFolder, str(job["subject"]))
+  return os.path.join(outputFolder, str(job["subject"]), f'{job["lesionLoad"]}mL_seed{job["seed"]}')
+
+
+def missingOutputs(outputs, startTime):
+  """
+  Output files of a job that were not written since startTime, e.g. left by a previous run of the job
+  :param outputs: dictionary with the output file, or list of files, of each output
+  :param startTime: start time of the job (time.time())
+  :return: list of files
+  """
+  paths = []
+  for name, path in outputs.items():
+    # The profiling report is optional: the simulation goes on if it cannot be saved
+    if name != "profile":
+      paths += path if isinstance(path, list) else [path]
+  return [path for path in paths if not os.path.isfile(path) or os.path.getmtime(path) < startTime]
+
+
+def runJob(job, outputFolder):
+  """
+  Simulate one job in the running Slicer session and save its results. Must be called inside Slicer.
+  :param job:
+  :param outputFolder:
+  :return: dictionary with the saved output files
+  """
+  import slicer
+  from MSLesionSimulator import MSLesionSimulatorLogic
+
+  # File modification times have a one second resolution on some file systems
+  startTime = int(time.time())
+  folder = jobOutputFolder(outputFolder, job)
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+
+  volumes = {}
+  for modality, path in job["inputs"].items():
+    volumes[modality] = slicer.util.loadVolume(path)
+
+  parameters = job["parameters"]
+  logic = MSLesionSimulatorLogic()
+  logic.lowMemory = parameters["lowMemory"]
+  logic.profilingReportPath = os.path.join(folder, "profile.json")
+  if parameters["lesionMapsOnly"]:
+    # Lesion maps are generated in the space of the first structural image, as the reference space of run
+    referenceVolume = [volumes[modality] for modality in ["T1", "T2", "T2-FLAIR", "PD"] if modality in volumes][0]
+    lesionMaps = logic.generateLesionMaps(referenceVolume, parameters["isBET"], parameters["isMNI"],
+                                          job["lesionLoad"], job["seed"], folder, parameters["samplingPerc"],
+                                          parameters["grid"], parameters["initiationMethod"], parameters["numberOfThreads"])
+    if len(lesionMaps) != len(job["lesionLoad"]) * len(job["seed"]):
+      raise RuntimeError("Lesion map generation failed.")
+    outputs = {"lesionMaps": lesionMaps}
+  else:
+    outputs = runSimulation(logic, job, volumes, folder)
+  missing = missingOutputs(outputs, startTime)
+  if missing:
+    raise RuntimeError("Outputs not written: " + ", ".join(missing))
+  return outputs
+
+
+def runSimulation(logic, job, volumes, folder):
+  """
+  Simulate the lesions of a job and save the simulated volumes and lesion labels. Must be called inside Slicer.
+  :return: dictionary with the output files
+  """
+  import slicer
+
+  parameters = job["parameters"]
+
+  success = logic.run(volumes.get("T1"), volumes.get("T2-FLAIR"), volumes.get("T2"), volumes.get("PD"),
+                      volumes.get("DTI-FA"), volumes.get("DTI-ADC"),
+                      parameters["returnSpace"], parameters["isBET"], parameters["isMNI"],
+                      job["lesionLoad"], parameters["isLongitudinal"], parameters["numberFollowUp"],
+                      parameters["balanceHI"], folder, parameters["cutFraction"], parameters["samplingPerc"],
+                      parameters["grid"], parameters["initiationMethod"], parameters["numberOfThreads"],
+                      seed=job["seed"])
+  if not success:
+    raise RuntimeError("MS lesion simulation failed.")
+
+  outputs = {"profile": logic.profilingReportPath}
+  for modality, volume in volumes.items():
+    if not parameters["isLongitudinal"]:
+      outputs[modality] = os.path.join(folder, modality + ".nii.gz")
+      slicer.util.saveNode(volume, outputs[modality])
+    # A missing lesion label is reported by missingOutputs
+    outputs[modality + "_lesion_label"] = os.path.join(folder, modality + "_lesion_label.nii.gz")
+    labelNode = slicer.mrmlScene.GetFirstNodeByName(LESION_LABEL_NAMES[modality])
+    if labelNode is not None:
+      slicer.util.saveNode(labelNode, outputs[modality + "_lesion_label"])
+  return outputs
+
+
+def runWorker(jobFilePath, resultFilePath, outputFolder):
+  """
+  Entry point of a worker Slicer process: run the job described in jobFilePath and write its
+  status to resultFilePath
+  """
+  with open(jobFilePath) as jobFile:
+    job = json.load(jobFile)
+  result = {"status": "completed"}
+  try:
+    result["outputs"] = runJob(job, outputFolder)
+  except Exception as e:
+    logging.exception("Job failed")
+    result = {"status": "failed", "error": str(e)}
+  with open(resultFilePath, "w") as resultFile:
+    json.dump(result, resultFile)
+  return result["status"] == "completed"
+
+
+class CohortRunner:
+  """
+  Schedule the jobs of a cohort over a pool of worker Slicer processes and stream their results
+  to disk as they finish.
+  """
+
+  def __init__(self, slicerExecutable, outputFolder, numberOfWorkers=1):
+    self.slicerExecutable = slicerExecutable
+    self.outputFolder = outputFolder
+    self.numberOfWorkers = max(1, numberOfWorkers)
+    self.resultsFilePath = os.path.join(outputFolder, "cohort_results.jsonl")
+    self._resultsLock = threading.Lock()
+
+  def run(self, jobs):
+    """
+    Run all the jobs
+    :param jobs:
+    :return: list of job results, in completion order
+    """
+    if not os.path.exists(self.outputFolder):
+      os.makedirs(self.outputFolder)
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+      futures = [executor.submit(self.runJobProcess, job) for job in jobs]
+      for future in concurrent.futures.as_completed(futures):
+        result = future.result()
+        results.append(result)
+        self.writeResult(result)
+        logging.info(f'{result["subject"]} ({result["lesionLoad"]} mL, seed {result["seed"]}): {result["status"]}')
+
+    reportPaths = [result["outputs"]["profile"] for result in results
+                   if result["status"] == "completed" and "profile" in result.get("outputs", {})]
+    if reportPaths:
+      aggregateReportFiles(reportPaths, os.path.join(self.outputFolder, "cohort_profile.json"))
+    return results
+
+  def runJobProcess(self, job):
+    result = {"subject": job["subject"], "lesionLoad": job["lesionLoad"], "seed": job["seed"]}
+    startTime = time.time()
+    workingFolder = tempfile.mkdtemp(prefix="MSLesionSimulatorJob_")
+    jobFilePath = os.path.join(workingFolder, "job.json")
+    resultFilePath = os.path.join(workingFolder, "result.json")
+    with open(jobFilePath, "w") as jobFile:
+      json.dump(job, jobFile)
+
+    command = [self.slicerExecutable, "--no-splash", "--no-main-window",
+               "--python-script", os.path.abspath(__file__),
+               "--worker", jobFilePath, "--result", resultFilePath, "--output", self.outputFolder]
+    try:
+      process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+      # The worker output is the only diagnostic when Slicer fails before running the job, which
+      # then did not create the subject folder
+      logFilePath = jobOutputFolder(self.outputFolder, job) + ".log"
+      os.makedirs(os.path.dirname(logFilePath), exist_ok=True)
+      with open(logFilePath, "w") as logFile:
+        logFile.write(process.stdout)
+      if os.path.exists(resultFilePath):
+        with open(resultFilePath) as resultFile:
+          result.update(json.load(resultFile))
+      else:
+        result.update({"status": "failed", "error": f"Worker exited with code {process.returncode}"})
+    except Exception as e:
+      result.update({"status": "failed", "error": str(e)})
+    finally:
+      shutil.rmtree(workingFolder, ignore_errors=True)
+    result["elapsedTime"] = time.time() - startTime
+    return result
+
+  def writeResult(self, result):
+    with self._resultsLock:
+      with open(self.resultsFilePath, "a") as resultsFile:
+        resultsFile.write(json.dumps(result) + "\n")
+
+
+def runCohort(manifestPath, outputFolder, numberOfWorkers, slicerExecutable):
+  """
+  Simulate a whole cohort
+  :param manifestPath:
+  :param outputFolder:
+  :param numberOfWorkers:
+  :param slicerExecutable:
+  :return: list of job results
+  """
+  jobs = expandJobs(loadManifest(manifestPath))
+  logging.info(f"Running {len(jobs)} jobs with {numberOfWorkers} workers")
+  return CohortRunner(slicerExecutable, outputFolder, numberOfWorkers).run(jobs)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Simulate MS lesions over a cohort of subjects.")
+  parser.add_argument("manifest", nargs="?", help="JSON manifest describing subjects, lesion loads and seeds")
+  parser.add_argument("--output", required=True, help="Output folder")
+  parser.add_argument("--workers", type=int, default=1, help="Number of simultaneous worker processes")
+  parser.add_argument("--slicer", default="Slicer", help="Slicer executable used by the workers")
+  parser.add_argument("--worker", help=argparse.SUPPRESS)
+  parser.add_argument("--result", help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+
+  if args.worker:
+    import slicer
+    success = runWorker(args.worker, args.result, args.output)
+    slicer.util.exit(0 if success else 1)
+    return 0 if success else 1
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+  results = runCohort(args.manifest, args.output, args.workers, args.slicer)
+  failed = [result for result in results if result["status"] != "completed"]
+  logging.info(f"{len(results) - len(failed)} jobs completed, {len(failed)} failed")
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
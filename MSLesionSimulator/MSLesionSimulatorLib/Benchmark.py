@@ -0,0 +1,415 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Offline benchmark of the lesion simulation CLIs and of the headless pipeline.
+
+Synthetic brain-like phantoms (T1 and T2-FLAIR, with white matter, cortex and ventricles) and lesion labels
+are generated for several grids:
+
+  - MNI-1mm: 182 x 218 x 182 voxels of 1 mm, the grid of the MNI152 template and of the lesion database
+  - 0.7mm: the MNI152 field of view with 0.7 mm voxels
+  - 256: 256 x 256 x 256 voxels of 1 mm
+
+GenerateMask and the end-to-end pipeline (see Pipeline, with isMNI) work on the MNI152 grid, so they are only
+timed on the MNI-1mm phantom. FilterMask, DeformImage and MSLongitudinalExams are timed on every phantom.
+The cases cover several lesion loads and numbers of follow-ups.
+
+Each case is run --repeats times and its median time is kept. The results are appended to a JSON file, and
+compared with the last results of the same host (or with --baseline): the benchmark fails when the throughput
+of a case drops by more than --threshold.
+
+Usage:
+
+  python Benchmark.py --results benchmark_results.json --slicer /opt/Slicer/Slicer --repeats 3
+
+The phantoms require numpy. Nothing is downloaded: the lesion database and the MNI152 template come from the
+module resources.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+try:
+  from MSLesionSimulatorLib.Pipeline import (CLIRunner, LESION_SIGMAS, LESION_VARIABILITY, getDatabasePath,
+                                             runPipeline)
+except ImportError:
+  # Run as a script from the MSLesionSimulatorLib folder
+  from Pipeline import CLIRunner, LESION_SIGMAS, LESION_VARIABILITY, getDatabasePath, runPipeline
+
+# Size (voxels) and spacing (mm) of each phantom
+PHANTOMS = {
+  "MNI-1mm": ((182, 218, 182), 1.0),
+  "0.7mm": ((260, 311, 260), 0.7),
+  "256": ((256, 256, 256), 1.0),
+}
+
+# Tissue intensities of the phantoms: background, CSF, gray matter, white matter
+TISSUE_INTENSITIES = {
+  "T1": (0, 30, 75, 110),
+  "T2-FLAIR": (0, 10, 100, 80),
+}
+
+DEFAULT_LESION_LOADS = [5, 20, 50]
+DEFAULT_FOLLOW_UPS = [2, 6]
+BENCHMARKS = ["GenerateMask", "FilterMask", "DeformImage", "MSLongitudinalExams", "Pipeline"]
+
+# Fixed seed, so every run simulates the same lesions
+BENCHMARK_SEED = 1
+
+
+def writeNrrd(fileName, array, spacing, origin):
+  """
+  Write a 3D numpy array, indexed [z, y, x], as a raw NRRD file
+  :param fileName:
+  :param array:
+  :param spacing:
+  :param origin:
+  :return:
+  """
+  types = {"uint8": "uchar", "int16": "short", "float32": "float"}
+  header = ["NRRD0004",
+            "type: " + types[array.dtype.name],
+            "dimension: 3",
+            "space: left-posterior-superior",
+            "sizes: {} {} {}".format(array.shape[2], array.shape[1], array.shape[0]),
+            "space directions: ({0},0,0) (0,{0},0) (0,0,{0})".format(spacing),
+            "kinds: domain domain domain",
+            "endian: little",
+            "encoding: raw",
+            "space origin: ({},{},{})".format(*origin)]
+  with open(fileName, "wb") as nrrdFile:
+    nrrdFile.write(("\n".join(header) + "\n\n").encode("ascii"))
+    nrrdFile.write(array.astype(array.dtype.newbyteorder("<"), copy=False).tobytes())
+
+
+def phantomTissues(size, spacing):
+  """
+  Tissue classes of a brain-like phantom: 0 background, 1 CSF, 2 gray matter, 3 white matter. The brain is
+  an ellipsoid with a cortical shell and two ventricles, scaled to the MNI152 brain.
+  :param size: number of voxels along x, y and z
+  :param spacing: voxel size (mm)
+  :return: numpy array indexed [z, y, x]
+  """
+  import numpy as np
+  x, y, z = [(np.arange(n) - (n - 1) / 2.0) * spacing for n in size]
+  zz, yy, xx = np.meshgrid(z, y, x, indexing="ij", sparse=True)
+  brain = (xx / 70.0) ** 2 + (yy / 90.0) ** 2 + (zz / 65.0) ** 2
+  ventricles = ((np.abs(xx) - 10.0) / 6.0) ** 2 + (yy / 25.0) ** 2 + ((zz - 5.0) / 12.0) ** 2
+
+  tissues = np.zeros(brain.shape, dtype=np.uint8)
+  tissues[brain < 1.0] = 2
+  tissues[brain < 0.75] = 3
+  tissues[ventricles < 1.0] = 1
+  return tissues
+
+
+def phantomImage(tissues, modality, noiseSeed):
+  import numpy as np
+  intensities = np.array(TISSUE_INTENSITIES[modality], dtype=np.float32)
+  image = intensities[tissues]
+  noise = np.random.RandomState(noiseSeed).normal(0, 3.0, tissues.shape).astype(np.float32)
+  image[tissues > 0] += noise[tissues > 0]
+  return np.clip(image, 0, None).astype(np.int16)
+
+
+def phantomLesions(tissues, spacing, lesionLoad, seed):
+  """
+  Lesion label of spherical lesions of 2 to 6 mm of radius, inside the white matter, adding up to the
+  lesion load
+  :param tissues:
+  :param spacing:
+  :param lesionLoad: lesion load (mL)
+  :param seed:
+  :return: numpy array indexed [z, y, x]
+  """
+  import numpy as np
+  random = np.random.RandomState(seed)
+  label = np.zeros(tissues.shape, dtype=np.uint8)
+  whiteMatter = np.flatnonzero(tissues == 3)
+  desiredVoxels = lesionLoad * 1000.0 / spacing ** 3
+  lesionVoxels = 0
+  while lesionVoxels < desiredVoxels:
+    center = np.array(np.unravel_index(whiteMatter[random.randint(len(whiteMatter))], tissues.shape))
+    radius = random.uniform(2.0, 6.0) / spacing
+    low = np.maximum(0, np.floor(center - radius)).astype(int)
+    high = np.minimum(tissues.shape, np.ceil(center + radius) + 1).astype(int)
+    zz, yy, xx = np.ogrid[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+    sphere = (zz - center[0]) ** 2 + (yy - center[1]) ** 2 + (xx - center[2]) ** 2 <= radius ** 2
+    block = label[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+    lesionVoxels += int(np.count_nonzero(sphere & (block == 0)))
+    block[sphere] = 1
+  return label
+
+
+def generatePhantoms(folder, phantomNames, lesionLoads):
+  """
+  Write the phantom images and lesion labels that are not already in the folder
+  :param folder:
+  :param phantomNames:
+  :param lesionLoads:
+  :return: dictionary of file names, by phantom: {"T1": ..., "T2-FLAIR": ..., "labels": {lesionLoad: ...}}
+  """
+  phantoms = {}
+  for name in phantomNames:
+    size, spacing = PHANTOMS[name]
+    origin = [-(n - 1) / 2.0 * spacing for n in size]
+    files = {modality: os.path.join(folder, f"{name}_{modality}.nrrd") for modality in TISSUE_INTENSITIES}
+    files["labels"] = {load: os.path.join(folder, f"{name}_lesions_{load}mL.nrrd") for load in lesionLoads}
+    missing = [path for path in list(files.values()) + list(files["labels"].values())
+               if isinstance(path, str) and not os.path.exists(path)]
+    if missing:
+      logging.info(f"Generating {name} phantom...")
+      tissues = phantomTissues(size, spacing)
+      for i, modality in enumerate(TISSUE_INTENSITIES):
+        if not os.path.exists(files[modality]):
+          writeNrrd(files[modality], phantomImage(tissues, modality, BENCHMARK_SEED + i), spacing, origin)
+      for load, path in files["labels"].items():
+        if not os.path.exists(path):
+          writeNrrd(path, phantomLesions(tissues, spacing, load, BENCHMARK_SEED), spacing, origin)
+    phantoms[name] = files
+  return phantoms
+
+
+def readReturnParameters(fileName):
+  """
+  Output parameters written by a CLI to its --returnparameterfile
+  """
+  outputs = {}
+  if not os.path.exists(fileName):
+    return outputs
+  with open(fileName) as parametersFile:
+    for line in parametersFile:
+      name, separator, value = line.partition("=")
+      if separator:
+        try:
+          outputs[name.strip()] = float(value)
+        except ValueError:
+          pass
+  return outputs
+
+
+class BenchmarkRunner:
+  """
+  Time the benchmark cases, each one repeated several times
+  """
+
+  def __init__(self, runner, workingFolder, repeats=3, databasePath=None):
+    self.runner = runner
+    self.workingFolder = workingFolder
+    self.repeats = max(1, repeats)
+    self.databasePath = databasePath or getDatabasePath()
+    self.lesionIndexPath = os.path.join(workingFolder, "labels-database.idx")
+    self.results = {}
+
+  def timeCLI(self, caseName, voxels, name, positionalArguments, flags):
+    flags = dict(flags, returnparameterfile=os.path.join(self.workingFolder, "return_parameters.txt"))
+
+    def run():
+      self.runner.run(name, positionalArguments, flags)
+      return readReturnParameters(flags["returnparameterfile"])
+
+    self.timeCase(caseName, voxels, run)
+
+  def timeCase(self, caseName, voxels, function):
+    """
+    Time a case, keeping the median of the repeats
+    :param caseName:
+    :param voxels: number of voxels processed, for the throughput
+    :param function: runs the case once, returning a dictionary of outputs
+    :return:
+    """
+    times = []
+    outputs = {}
+    for repeat in range(self.repeats):
+      startTime = time.perf_counter()
+      outputs = function() or {}
+      times.append(time.perf_counter() - startTime)
+    medianTime = statistics.median(times)
+    self.results[caseName] = {"time": round(medianTime, 3),
+                              "times": [round(t, 3) for t in times],
+                              "voxels": voxels,
+                              "throughput": round(voxels / medianTime / 1e6, 3) if medianTime > 0 else None,
+                              "outputs": outputs}
+    logging.info(f"{caseName}: {medianTime:.2f} s")
+
+  def outputFile(self, fileName):
+    return os.path.join(self.workingFolder, "outputs", fileName)
+
+  def run(self, phantoms, benchmarks, lesionLoads, followUps):
+    """
+    Run the benchmark cases
+    :return: results of each case
+    """
+    if not os.path.exists(self.outputFile("")):
+      os.makedirs(self.outputFile(""))
+    labelsDatabase = os.path.join(self.databasePath, "labels-database")
+    template = os.path.join(self.databasePath, "MNI152_T1_1mm_brain.nii.gz")
+
+    if "MNI-1mm" in phantoms:
+      mni = phantoms["MNI-1mm"]
+      voxels = voxelCount("MNI-1mm")
+      if "GenerateMask" in benchmarks:
+        # The first execution builds the lesion atlas index, it is not timed
+        self.runner.run("GenerateMask", [mni["T1"], self.outputFile("mask.nrrd"), lesionLoads[0], labelsDatabase],
+                        {"lesionIndex": self.lesionIndexPath, "seed": BENCHMARK_SEED, "compressionLevel": 0})
+        for load in lesionLoads:
+          self.timeCLI(f"GenerateMask/MNI-1mm/{load}mL", voxels, "GenerateMask",
+                       [mni["T1"], self.outputFile("mask.nrrd"), load, labelsDatabase],
+                       {"lesionIndex": self.lesionIndexPath, "seed": BENCHMARK_SEED, "compressionLevel": 0})
+      if "Pipeline" in benchmarks and os.path.exists(template):
+        inputs = {modality: mni[modality] for modality in TISSUE_INTENSITIES}
+        for load in lesionLoads:
+          for followUp in [0] + list(followUps):
+            parameters = {"isMNI": True, "isBET": True, "isLongitudinal": followUp > 0, "numberFollowUp": followUp}
+            caseName = f"Pipeline/MNI-1mm/{load}mL" + (f"/{followUp}FU" if followUp else "")
+
+            def runCase():
+              runPipeline(inputs, self.outputFile("pipeline"), load, parameters, BENCHMARK_SEED, self.runner,
+                          self.databasePath, self.lesionIndexPath)
+
+            self.timeCase(caseName, voxels, runCase)
+
+    for name, files in phantoms.items():
+      voxels = voxelCount(name)
+      for load in lesionLoads:
+        label = files["labels"][load]
+        if "FilterMask" in benchmarks:
+          self.timeCLI(f"FilterMask/{name}/{load}mL", voxels, "FilterMask",
+                       [files["T1"], label, self.outputFile("T1_label.nrrd"), 1.5],
+                       {"inputVolume2": files["T2-FLAIR"], "outputVolume2": self.outputFile("FLAIR_label.nrrd"),
+                        "compressionLevel": 0})
+        if "DeformImage" in benchmarks:
+          self.timeCLI(f"DeformImage/{name}/{load}mL", voxels, "DeformImage",
+                       [files["T1"], label, self.outputFile("T1.nrrd")],
+                       {"type": "T1", "sigma": LESION_SIGMAS["T1"],
+                        "inputVolume2": files["T2-FLAIR"], "type2": "T2-FLAIR", "lesionLabel2": label,
+                        "outputVolume2": self.outputFile("FLAIR.nrrd"), "sigma2": LESION_SIGMAS["T2-FLAIR"],
+                        "variability": LESION_VARIABILITY, "seed": BENCHMARK_SEED, "compressionLevel": 0})
+        if "MSLongitudinalExams" in benchmarks:
+          for followUp in followUps:
+            self.timeCLI(f"MSLongitudinalExams/{name}/{load}mL/{followUp}FU", voxels * followUp, "MSLongitudinalExams",
+                         [files["T1"], label],
+                         {"type": "T1", "numFU": followUp, "outputFolder": self.outputFile(""),
+                          "sigma": LESION_SIGMAS["T1"], "variability": LESION_VARIABILITY, "seed": BENCHMARK_SEED})
+    return self.results
+
+
+def voxelCount(phantomName):
+  size = PHANTOMS[phantomName][0]
+  return size[0] * size[1] * size[2]
+
+
+def loadResults(resultsPath):
+  if not resultsPath or not os.path.exists(resultsPath):
+    return []
+  with open(resultsPath) as resultsFile:
+    return json.load(resultsFile).get("runs", [])
+
+
+def findBaseline(runs, host):
+  """
+  Last run of the same host, whose times can be compared
+  """
+  for run in reversed(runs):
+    if run.get("host") == host:
+      return run
+  return None
+
+
+def compareResults(results, baseline, threshold):
+  """
+  Cases whose throughput dropped by more than threshold (a fraction) with respect to the baseline
+  :return: list of messages
+  """
+  regressions = []
+  for caseName, result in sorted(results.items()):
+    reference = baseline["cases"].get(caseName)
+    if not reference or not reference.get("throughput") or not result.get("throughput"):
+      continue
+    change = result["throughput"] / reference["throughput"] - 1.0
+    if change < -threshold:
+      regressions.append(f"{caseName}: {reference['time']:.2f} s -> {result['time']:.2f} s ({change:+.0%} throughput)")
+  return regressions
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark the MS lesion simulation CLIs on synthetic phantoms.")
+  parser.add_argument("--results", required=True, help="JSON file where the results of every run are appended")
+  parser.add_argument("--baseline", help="JSON results file to compare with, instead of the last run of this host")
+  parser.add_argument("--threshold", type=float, default=0.15,
+                      help="Largest throughput decrease accepted before failing, as a fraction")
+  parser.add_argument("--repeats", type=int, default=3, help="Number of executions of each case")
+  parser.add_argument("--phantoms", nargs="+", default=list(PHANTOMS), choices=list(PHANTOMS))
+  parser.add_argument("--benchmarks", nargs="+", default=BENCHMARKS, choices=BENCHMARKS)
+  parser.add_argument("--lesionLoads", nargs="+", type=int, default=DEFAULT_LESION_LOADS, help="Lesion loads (mL)")
+  parser.add_argument("--followUps", nargs="+", type=int, default=DEFAULT_FOLLOW_UPS, help="Numbers of follow-ups")
+  parser.add_argument("--numberOfThreads", type=int, default=-1, help="Number of threads, -1 for all the processors")
+  parser.add_argument("--workingFolder", help="Folder of the phantoms and outputs, kept between runs if given")
+  parser.add_argument("--cliPath", action="append", default=[], help="Folder of the CLI executables (repeatable)")
+  parser.add_argument("--slicer", help="Slicer launcher used to set the library paths of the CLIs")
+  parser.add_argument("--label", default="", help="Label of this run in the results, e.g. a commit")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+  workingFolder = args.workingFolder or tempfile.mkdtemp(prefix="MSLesionSimulatorBenchmark_")
+  if not os.path.exists(workingFolder):
+    os.makedirs(workingFolder)
+  try:
+    phantoms = generatePhantoms(workingFolder, args.phantoms, args.lesionLoads)
+    runner = CLIRunner(args.cliPath, args.slicer, args.numberOfThreads, os.path.join(workingFolder, "benchmark.log"))
+    results = BenchmarkRunner(runner, workingFolder, args.repeats).run(phantoms, args.benchmarks, args.lesionLoads,
+                                                                       args.followUps)
+  except RuntimeError as e:
+    logging.info("ERROR: " + str(e))
+    return 1
+  finally:
+    if not args.workingFolder:
+      shutil.rmtree(workingFolder, ignore_errors=True)
+
+  host = platform.node()
+  runs = loadResults(args.results)
+  if args.baseline:
+    baselineRuns = loadResults(args.baseline)
+    baseline = baselineRuns[-1] if baselineRuns else None
+  else:
+    baseline = findBaseline(runs, host)
+  runs.append({"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "host": host,
+               "processors": os.cpu_count(),
+               "numberOfThreads": args.numberOfThreads,
+               "label": args.label,
+               "cases": results})
+  with open(args.results, "w") as resultsFile:
+    json.dump({"runs": runs}, resultsFile, indent=2)
+
+  if baseline is None:
+    logging.info("No previous results to compare with.")
+    return 0
+  regressions = compareResults(results, baseline, args.threshold)
+  for regression in regressions:
+    logging.info("Regression: " + regression)
+  logging.info(f"{len(regressions)} regressions beyond {args.threshold:.0%} with respect to the run of {baseline['date']}")
+  return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
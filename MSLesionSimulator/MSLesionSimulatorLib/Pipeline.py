@@ -0,0 +1,539 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Headless execution of the MS lesion simulation pipeline.
+
+The steps of MSLesionSimulatorLogic.run are executed on image files by calling the CLI executables
+(BRAINSFit, BRAINSResample, GenerateMask, FilterMask, DeformImage and MSLongitudinalExams) directly,
+without starting Slicer nor creating a MRML scene. Intermediate files are kept in a temporary folder.
+
+The simulated images are saved as <output>/<modality>.nii.gz, or <output>/<modality>.mha with --lowMemory
+because DeformImage then writes them by parts, and the lesion labels as <output>/<modality>_lesion_label.nii.gz. Longitudinal exams are saved by MSLongitudinalExams in <output>.
+
+Usage:
+
+  python Pipeline.py --t1 sub01_T1.nii.gz --flair sub01_FLAIR.nii.gz --output /results/sub01 \
+    --lesionLoad 10 --seed 1 --numberOfThreads 4 --cliPath /opt/Slicer/lib/Slicer-4.10/cli-modules
+
+The CLIs are looked up in the --cliPath folders, then in the PATH. With --slicer, they are started through
+"Slicer --launch", which only sets the library paths of the Slicer installation.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+try:
+  from MSLesionSimulatorLib.Batch import DEFAULT_PARAMETERS, MODALITIES
+except ImportError:
+  # Run as a script from the MSLesionSimulatorLib folder
+  from Batch import DEFAULT_PARAMETERS, MODALITIES
+
+# Candidates for the reference space, in the order used by MSLesionSimulatorLogic.run
+REFERENCE_MODALITIES = ["T1", "T2", "T2-FLAIR", "PD"]
+
+# Order of the modalities given to FilterMask and DeformImage by MSLesionSimulatorLogic.run
+SIMULATION_ORDER = ["T1", "T2-FLAIR", "T2", "PD", "DTI-FA", "DTI-ADC"]
+
+# Same lesion border smoothing and variability as MSLesionSimulatorLogic.run
+LESION_SIGMAS = {
+  "T1": 0.75,
+  "T2": 0.75,
+  "T2-FLAIR": 0.75,
+  "PD": 0.75,
+  "DTI-FA": 1.5,
+  "DTI-ADC": 1.3,
+}
+LESION_VARIABILITY = 0.5
+
+INPUT_FLAGS = {
+  "T1": "--t1",
+  "T2": "--t2",
+  "T2-FLAIR": "--flair",
+  "PD": "--pd",
+  "DTI-FA": "--fa",
+  "DTI-ADC": "--adc",
+}
+
+# Compression level of the files only read back by the next step or into the scene, also used by
+# MSLesionSimulatorLogic
+INTERMEDIATE_COMPRESSION_LEVEL = 0
+
+
+def getDatabasePath():
+  """
+  Location of the MSlesion_database resources next to the module, as in MSLesionSimulatorLogic.getDatabasePath
+  :return:
+  """
+  modulePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  return os.path.join(modulePath, "Resources", "MSlesion_database")
+
+
+def splitNumberOfThreads(numberOfThreads, numberOfJobs):
+  """
+  Number of threads of each one of simultaneous jobs sharing numberOfThreads (-1 for all the processors)
+  :param numberOfThreads:
+  :param numberOfJobs:
+  :return:
+  """
+  if numberOfThreads <= 0:
+    numberOfThreads = multiprocessing.cpu_count()
+  return max(1, int(numberOfThreads) // max(1, numberOfJobs))
+
+
+def readTextTransforms(transformPath):
+  """
+  Transforms of an ITK text transform file (.tfm), the components of a composite transform being listed in
+  its place
+  :param transformPath:
+  :return: list of dictionaries with the Transform, Parameters and FixedParameters entries
+  """
+  transforms = []
+  with open(transformPath) as transformFile:
+    for line in transformFile:
+      if ":" not in line or line.startswith("#"):
+        continue
+      key, value = [part.strip() for part in line.split(":", 1)]
+      if key == "Transform":
+        transforms.append({"Transform": value})
+      elif transforms:
+        transforms[-1][key] = [float(number) for number in value.split()]
+  return [transform for transform in transforms if not transform["Transform"].startswith("CompositeTransform")]
+
+
+def writeTextTransforms(transformPath, transforms):
+  """
+  Write transforms as a composite transform in an ITK text transform file. As in ITK, the last transform
+  of the list is applied first.
+  :param transformPath:
+  :param transforms: list of dictionaries with the Transform, Parameters and FixedParameters entries
+  :return:
+  """
+  with open(transformPath, "w") as transformFile:
+    transformFile.write("#Insight Transform File V1.0\n#Transform 0\nTransform: CompositeTransform_double_3_3\n")
+    for index, transform in enumerate(transforms):
+      transformFile.write("#Transform " + str(index + 1) + "\n")
+      transformFile.write("Transform: " + transform["Transform"] + "\n")
+      for key in ["Parameters", "FixedParameters"]:
+        transformFile.write(key + ": " + " ".join(repr(number) for number in transform.get(key, [])) + "\n")
+
+
+def invertAffineTransform(transform):
+  """
+  Inverse of an ITK affine transform y = A (x - c) + c + t, which is x = inv(A) (y - c) + c - inv(A) t
+  :param transform: dictionary with the Transform, Parameters (A row by row, then t) and FixedParameters (c) entries
+  :return: dictionary of the inverse transform
+  """
+  if not transform["Transform"].startswith(("AffineTransform", "MatrixOffsetTransformBase")):
+    raise ValueError("Cannot invert a " + transform["Transform"] + " transform.")
+  a = [transform["Parameters"][row * 3:row * 3 + 3] for row in range(3)]
+  translation = transform["Parameters"][9:12]
+  determinant = (a[0][0] * (a[1][1] * a[2][2] - a[1][2] * a[2][1])
+                 - a[0][1] * (a[1][0] * a[2][2] - a[1][2] * a[2][0])
+                 + a[0][2] * (a[1][0] * a[2][1] - a[1][1] * a[2][0]))
+  if determinant == 0:
+    raise ValueError("Cannot invert a singular affine transform.")
+  inverse = [[(a[(column + 1) % 3][(row + 1) % 3] * a[(column + 2) % 3][(row + 2) % 3]
+               - a[(column + 1) % 3][(row + 2) % 3] * a[(column + 2) % 3][(row + 1) % 3]) / determinant
+              for column in range(3)] for row in range(3)]
+  inverseTranslation = [-sum(inverse[row][column] * translation[column] for column in range(3)) for row in range(3)]
+  return {"Transform": transform["Transform"],
+          "Parameters": [value for row in inverse for value in row] + inverseTranslation,
+          "FixedParameters": list(transform["FixedParameters"])}
+
+
+def composeMNIToNativeTransform(MNIToReferencePath, conformPath, outputPath):
+  """
+  Transform from the MNI152 space to the native space of a modality: the MNI152 registration followed by
+  the inverse of the affine conforming registration of the modality. As the BRAINSFit transforms, it maps
+  the points of the modality grid to the MNI152 space, where BRAINSResample reads the lesion map.
+  :param MNIToReferencePath: MNI152 to reference registration (.tfm)
+  :param conformPath: modality to reference registration (.tfm)
+  :param outputPath: composite transform (.tfm)
+  :return:
+  """
+  conformTransforms = readTextTransforms(conformPath)
+  if len(conformTransforms) != 1:
+    raise ValueError(conformPath + " is not a single affine transform.")
+  writeTextTransforms(outputPath, readTextTransforms(MNIToReferencePath) + [invertAffineTransform(conformTransforms[0])])
+
+
+class CLIRunner:
+  """
+  Start CLI executables with their command line arguments and log their output.
+  """
+
+  def __init__(self, searchPaths=None, slicerExecutable=None, numberOfThreads=-1, logFilePath=None):
+    self.searchPaths = list(searchPaths or [])
+    self.slicerExecutable = slicerExecutable
+    self.numberOfThreads = numberOfThreads
+    self.logFilePath = logFilePath
+    self._logLock = threading.Lock()
+    if slicerExecutable:
+      # CLIs of the Slicer installation and of its extensions
+      slicerHome = os.path.dirname(os.path.abspath(slicerExecutable))
+      for root, folders, files in os.walk(slicerHome):
+        if os.path.basename(root) == "cli-modules":
+          self.searchPaths.append(root)
+
+  def findExecutable(self, name):
+    for folder in self.searchPaths:
+      for fileName in [name, name + ".exe"]:
+        path = os.path.join(folder, fileName)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+          return path
+    path = shutil.which(name)
+    if path is None:
+      raise RuntimeError(f"{name} executable not found. Add its folder with --cliPath.")
+    return path
+
+  def command(self, name, positionalArguments=(), flags=None):
+    """
+    Command line of a CLI. Boolean flags are only given when true, empty values are skipped and lists are
+    separated by commas.
+    :param name:
+    :param positionalArguments: arguments given by index, in order
+    :param flags: values of the long flags
+    :return:
+    """
+    command = [self.findExecutable(name)]
+    if self.slicerExecutable:
+      command = [self.slicerExecutable, "--launch"] + command
+    for flag, value in (flags or {}).items():
+      if value is None or value == "":
+        continue
+      if isinstance(value, bool):
+        if value:
+          command.append("--" + flag)
+      elif isinstance(value, (list, tuple)):
+        command += ["--" + flag, ",".join(str(item) for item in value)]
+      else:
+        command += ["--" + flag, str(value)]
+    command += [str(argument) for argument in positionalArguments]
+    return command
+
+  def start(self, name, positionalArguments=(), flags=None):
+    """
+    Start a CLI without waiting for its completion
+    :return: process, to be given to wait
+    """
+    command = self.command(name, positionalArguments, flags)
+    environment = dict(os.environ)
+    if self.numberOfThreads > 0:
+      environment["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(self.numberOfThreads)
+    logging.info(" ".join(command))
+    outputFile = tempfile.TemporaryFile(mode="w+")
+    process = subprocess.Popen(command, stdout=outputFile, stderr=subprocess.STDOUT, env=environment,
+                               universal_newlines=True)
+    process.cliName = name
+    process.outputFile = outputFile
+    return process
+
+  def wait(self, processes):
+    """
+    Wait for CLIs started by start
+    :param processes:
+    :return:
+    """
+    failed = []
+    for process in processes:
+      returnCode = process.wait()
+      process.outputFile.seek(0)
+      output = process.outputFile.read()
+      process.outputFile.close()
+      self.writeLog(" ".join(process.args), output)
+      if returnCode != 0:
+        logging.info(output)
+        failed.append(f"{process.cliName} exited with code {returnCode}")
+    if failed:
+      raise RuntimeError("; ".join(failed))
+
+  def run(self, name, positionalArguments=(), flags=None):
+    self.wait([self.start(name, positionalArguments, flags)])
+
+  def writeLog(self, command, output):
+    if not self.logFilePath:
+      return
+    with self._logLock:
+      with open(self.logFilePath, "a") as logFile:
+        logFile.write("$ " + command + "\n" + output + "\n")
+
+
+def runPipeline(inputs, outputFolder, lesionLoad, parameters=None, seed=0, runner=None, databasePath=None,
+                lesionIndexPath="", keepIntermediate=False):
+  """
+  Simulate MS lesions in image files, following the steps of MSLesionSimulatorLogic.run
+  :param inputs: dictionary with the image file of each modality (see MODALITIES)
+  :param outputFolder:
+  :param lesionLoad:
+  :param parameters: parameters of MSLesionSimulatorLogic.run (see Batch.DEFAULT_PARAMETERS)
+  :param seed: seed of the lesion map generation, 0 for a time based seed
+  :param runner: CLIRunner starting the CLI executables
+  :param databasePath: MSlesion_database folder
+  :param lesionIndexPath: packed lesion atlas index used by GenerateMask, built on the first run
+  :param keepIntermediate: keep the temporary folder with the intermediate files
+  :return: dictionary with the saved output files
+  """
+  parameters = dict(DEFAULT_PARAMETERS, **(parameters or {}))
+  runner = runner or CLIRunner(numberOfThreads=parameters["numberOfThreads"])
+  databasePath = databasePath or getDatabasePath()
+  isMNI = parameters["isMNI"]
+  numberOfThreads = parameters["numberOfThreads"]
+  inputs = {modality: path for modality, path in inputs.items() if path}
+
+  unknownModalities = [modality for modality in inputs if modality not in MODALITIES]
+  if unknownModalities:
+    raise ValueError("Unknown modalities: " + ", ".join(unknownModalities))
+  referenceModalities = [modality for modality in REFERENCE_MODALITIES if modality in inputs]
+  if not isMNI and not referenceModalities:
+    raise ValueError("At least one structural image should be provided.")
+  if parameters["isLongitudinal"] and int(parameters["numberFollowUp"]) < 1:
+    raise ValueError("The number of follow-ups must be at least 1.")
+  templatePath = os.path.join(databasePath, "MNI152_T1_1mm_brain.nii.gz" if parameters["isBET"] else "MNI152_T1_1mm.nii.gz")
+  if not os.path.exists(templatePath):
+    raise RuntimeError(templatePath + " not found.")
+
+  if not os.path.exists(outputFolder):
+    os.makedirs(outputFolder)
+  workingFolder = tempfile.mkdtemp(prefix="MSLesionSimulator_")
+
+  def intermediate(fileName):
+    return os.path.join(workingFolder, fileName)
+
+  def output(fileName):
+    return os.path.join(outputFolder, fileName)
+
+  try:
+    #
+    # Data space normalization to the reference space. When the images are returned to their original
+    # space, only the conforming transforms are computed: the lesion map is warped straight into the grid
+    # of each modality, which is never resampled.
+    #
+    returnSpace = parameters["returnSpace"] and not isMNI
+    volumes = dict(inputs)
+    conformTransforms = {}
+    if not isMNI:
+      referenceModality = referenceModalities[0]
+      logging.info(referenceModality + " volume found. Will be used as reference space.")
+      conformModalities = [modality for modality in MODALITIES if modality in inputs and modality != referenceModality]
+      # The conforming registrations are independent of each other, so they run simultaneously sharing the threads
+      conformNumberOfThreads = splitNumberOfThreads(numberOfThreads, len(conformModalities))
+      processes = []
+      for modality in conformModalities:
+        logging.info("Pre-processing: Conforming " + modality + " volume to reference space...")
+        # Text transform files, composed with the MNI152 registration by composeMNIToNativeTransform
+        conformTransforms[modality] = intermediate(modality + "_to_reference.tfm")
+        conformFlags = {
+          "fixedVolume": inputs[referenceModality],
+          "movingVolume": inputs[modality],
+          "samplingPercentage": 0.002,
+          "linearTransform": conformTransforms[modality],
+          "initializeTransformMode": "useMomentsAlign",
+          "useRigid": True,
+          "useAffine": True,
+          "numberOfThreads": conformNumberOfThreads}
+        if not returnSpace:
+          volumes[modality] = conformFlags["outputVolume"] = intermediate(modality + "_reference.nrrd")
+        processes.append(runner.start("BRAINSFit", flags=conformFlags))
+      runner.wait(processes)
+
+      #
+      # Registration between Input Image and MNI Image Space. Only the transform is computed: the
+      # lesion map is the only image resampled with it.
+      #
+      logging.info("MNI152 template to native space...")
+      MNIToReferenceTransform = intermediate("MNI_to_reference.tfm")
+      runner.run("BRAINSFit", flags={
+        "fixedVolume": inputs[referenceModality],
+        "movingVolume": templatePath,
+        "samplingPercentage": parameters["samplingPerc"],
+        "splineGridSize": parameters["grid"],
+        "bsplineTransform": MNIToReferenceTransform,
+        "initializeTransformMode": parameters["initiationMethod"],
+        "useRigid": True,
+        "useAffine": True,
+        "useBSpline": True,
+        "numberOfThreads": numberOfThreads})
+
+    #
+    # Find lesion mask using Probability Image, lesion labels and desired Lesion Load
+    #
+    logging.info("Simulating MS lesion map...")
+    lesionMap = intermediate("lesion_map_MNI.nrrd")
+    runner.run("GenerateMask", [templatePath, lesionMap, lesionLoad, os.path.join(databasePath, "labels-database")],
+               {"lesionIndex": lesionIndexPath, "seed": seed, "compressionLevel": INTERMEDIATE_COMPRESSION_LEVEL})
+
+    # Transforming lesion map to native space: the reference grid and, when the images are returned to
+    # their original space, the grid of each conformed modality through the composed transform
+    modalities = [modality for modality in SIMULATION_ORDER if modality in volumes]
+    lesionMaps = {modality: lesionMap for modality in modalities}
+    if not isMNI:
+      warps = {referenceModality: (inputs[referenceModality], MNIToReferenceTransform)}
+      if returnSpace:
+        for modality in conformTransforms:
+          MNIToNativeTransform = intermediate("MNI_to_" + modality + ".tfm")
+          composeMNIToNativeTransform(MNIToReferenceTransform, conformTransforms[modality], MNIToNativeTransform)
+          warps[modality] = (inputs[modality], MNIToNativeTransform)
+      nativeLesionMaps = {}
+      processes = []
+      for modality, (referenceVolume, warpTransform) in warps.items():
+        nativeLesionMaps[modality] = intermediate(modality + "_lesion_map.nrrd")
+        processes.append(runner.start("BRAINSResample", flags={
+          "inputVolume": lesionMap,
+          "referenceVolume": referenceVolume,
+          "outputVolume": nativeLesionMaps[modality],
+          "warpTransform": warpTransform,
+          "interpolationMode": "NearestNeighbor",
+          "pixelType": "binary"}))
+      runner.wait(processes)
+      lesionMaps = {modality: nativeLesionMaps.get(modality, nativeLesionMaps[referenceModality]) for modality in modalities}
+
+    # FilterMask and DeformImage need the images of an execution on the grid of its lesion map, so the
+    # modalities sharing a lesion map are processed together, one execution per grid
+    groups = []
+    for modality in modalities:
+      group = next((group for group in groups if lesionMaps[group[0]] == lesionMaps[modality]), None)
+      if group is None:
+        groups.append([modality])
+      else:
+        group.append(modality)
+
+    # Filtering lesion map to minimize or exclude regions outside of WM
+    outputs = {}
+    processes = []
+    for group in groups:
+      filterFlags = {}
+      for i, modality in enumerate(group):
+        outputs[modality + "_lesion_label"] = output(modality + "_lesion_label.nii.gz")
+        if i > 0:
+          filterFlags["inputVolume" + str(i + 1)] = volumes[modality]
+          filterFlags["outputVolume" + str(i + 1)] = outputs[modality + "_lesion_label"]
+      processes.append(runner.start("FilterMask", [volumes[group[0]], lesionMaps[group[0]],
+                                                   outputs[group[0] + "_lesion_label"], parameters["cutFraction"]],
+                                    filterFlags))
+    runner.wait(processes)
+
+    #
+    # Generating lesions in each input image
+    #
+    if not parameters["isLongitudinal"]:
+      # The modalities of a grid are deformed by a single DeformImage execution, sharing the lesion labelling
+      processes = []
+      for group in groups:
+        deformFlags = {"variability": LESION_VARIABILITY, "seed": seed, "lowMemory": parameters["lowMemory"]}
+        for i, modality in enumerate(group):
+          outputs[modality] = output(modality + (".mha" if parameters["lowMemory"] else ".nii.gz"))
+          suffix = str(i + 1) if i > 0 else ""
+          deformFlags["type" + suffix] = modality
+          deformFlags["sigma" + suffix] = LESION_SIGMAS[modality]
+          if i > 0:
+            deformFlags["inputVolume" + suffix] = volumes[modality]
+            deformFlags["lesionLabel" + suffix] = outputs[modality + "_lesion_label"]
+            deformFlags["outputVolume" + suffix] = outputs[modality]
+        logging.info("Simulating MS lesions in " + ", ".join(group) + "...")
+        processes.append(runner.start("DeformImage", [volumes[group[0]], outputs[group[0] + "_lesion_label"],
+                                                      outputs[group[0]]], deformFlags))
+      runner.wait(processes)
+    else:
+      for modality in modalities:
+        logging.info("Simulating longitudinal MS lesions in " + modality + " volume...")
+        runner.run("MSLongitudinalExams", [volumes[modality], outputs[modality + "_lesion_label"]], {
+          "type": modality,
+          "numFU": parameters["numberFollowUp"],
+          "balanceHI": parameters["balanceHI"],
+          "outputFolder": outputFolder,
+          "sigma": LESION_SIGMAS[modality],
+          "variability": LESION_VARIABILITY,
+          "seed": seed,
+          "timePointThreads": max(0, numberOfThreads)})
+  finally:
+    if keepIntermediate:
+      logging.info("Intermediate files kept in " + workingFolder)
+    else:
+      shutil.rmtree(workingFolder, ignore_errors=True)
+
+  logging.info("Processing completed")
+  return outputs
+
+
+def positiveInteger(value):
+  """
+  Argument type of the counts that must be at least 1
+  :param value:
+  :return:
+  """
+  number = int(value)
+  if number < 1:
+    raise argparse.ArgumentTypeError("must be at least 1, got " + value)
+  return number
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Simulate MS lesions in image files without Slicer.")
+  for modality in MODALITIES:
+    parser.add_argument(INPUT_FLAGS[modality], dest=modality, help=modality + " image file")
+  parser.add_argument("--output", required=True, help="Output folder")
+  parser.add_argument("--lesionLoad", type=int, default=10, help="Lesion load (mL)")
+  parser.add_argument("--seed", type=int, default=0, help="Random seed, 0 for a time based seed")
+  parser.add_argument("--numberOfThreads", type=int, default=DEFAULT_PARAMETERS["numberOfThreads"],
+                      help="Number of threads, -1 for all the processors")
+  parser.add_argument("--returnSpace", action="store_true", help="Return the images to their original space")
+  parser.add_argument("--isBET", action="store_true", help="The images are brain extracted")
+  parser.add_argument("--isMNI", action="store_true", help="The images are in the MNI152 space")
+  parser.add_argument("--isLongitudinal", action="store_true", help="Simulate longitudinal exams")
+  parser.add_argument("--numberFollowUp", type=positiveInteger, default=DEFAULT_PARAMETERS["numberFollowUp"],
+                      help="Number of follow-ups of the longitudinal exams")
+  parser.add_argument("--balanceHI", type=float, default=DEFAULT_PARAMETERS["balanceHI"],
+                      help="Percentage of lesions changing from hypo to isointense along the follow-ups")
+  parser.add_argument("--cutFraction", type=float, default=DEFAULT_PARAMETERS["cutFraction"],
+                      help="White matter threshold of the lesion map filtering")
+  parser.add_argument("--samplingPerc", type=float, default=DEFAULT_PARAMETERS["samplingPerc"],
+                      help="Percentage of voxels used in the MNI152 registration")
+  parser.add_argument("--grid", default=DEFAULT_PARAMETERS["grid"], help="BSpline grid of the MNI152 registration")
+  parser.add_argument("--initiationMethod", default=DEFAULT_PARAMETERS["initiationMethod"],
+                      choices=["useCenterOfHeadAlign", "Off", "useMomentsAlign", "useGeometryAlign"],
+                      help="Initialization method of the MNI152 registration")
+  parser.add_argument("--lowMemory", action="store_true", help="Stream the DeformImage output to disk, saving the simulated images as .mha files")
+  parser.add_argument("--cliPath", action="append", default=[], help="Folder of the CLI executables (repeatable)")
+  parser.add_argument("--slicer", help="Slicer launcher used to set the library paths of the CLIs")
+  parser.add_argument("--databasePath", help="MSlesion_database folder")
+  parser.add_argument("--lesionIndex", default="", help="Lesion atlas index file, built on the first run")
+  parser.add_argument("--keepIntermediate", action="store_true", help="Keep the intermediate files")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+  parameters = {name: getattr(args, name) for name in DEFAULT_PARAMETERS if hasattr(args, name)}
+  inputs = {modality: getattr(args, modality) for modality in MODALITIES if getattr(args, modality)}
+  runner = CLIRunner(args.cliPath, args.slicer, args.numberOfThreads, os.path.join(args.output, "pipeline.log"))
+  if not os.path.exists(args.output):
+    os.makedirs(args.output)
+  try:
+    outputs = runPipeline(inputs, args.output, args.lesionLoad, parameters, args.seed, runner,
+                          args.databasePath, args.lesionIndex, args.keepIntermediate)
+  except (RuntimeError, ValueError) as e:
+    logging.info("ERROR: " + str(e))
+    return 1
+  for name, path in sorted(outputs.items()):
+    logging.info(name + ": " + path)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
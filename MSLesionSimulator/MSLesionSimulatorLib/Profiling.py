@@ -0,0 +1,349 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Timing and memory report of the MS lesion simulation.
+
+MSLesionSimulatorLogic.run marks the beginning of each of its stages and of each CLI execution. For every
+one of them, the report gives:
+
+  - wallTime: elapsed time (s)
+  - cpuTime: processor time (s) of Slicer, including the CLIs run in process, plus the one of the CLI
+    processes that finished in the meantime
+  - peakMemoryUsage: peak resident memory (MB) of Slicer and of its CLI processes during the stage or
+    CLI execution, sampled every SAMPLING_INTERVAL seconds. It is None when the resident memory cannot
+    be read (neither psutil nor /proc available). The CLIs also return their own peak memory usage, and
+    counters such as the number of lesions, in "outputs".
+
+CLIs run simultaneously overlap, so their processor times and memory usages cannot be told apart.
+
+The JSON reports of several runs, e.g. the profile.json files of a batch execution, are aggregated with:
+
+  python Profiling.py /results/*/*/profile.json --output aggregated_profile.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+try:
+  import resource
+except ImportError:
+  # Not available on Windows: only the processor time of Slicer is reported
+  resource = None
+
+try:
+  import psutil
+except ImportError:
+  # The resident memory is read from /proc, on Linux only
+  psutil = None
+
+REPORT_VERSION = 2
+
+# Period (s) of the resident memory sampling
+SAMPLING_INTERVAL = 0.1
+
+
+def procResidentMemory(pid):
+  """
+  Resident memory (kB) of a process and of all its descendants, read from /proc
+  """
+  residentMemory = 0
+  try:
+    with open(f"/proc/{pid}/status") as statusFile:
+      for line in statusFile:
+        if line.startswith("VmRSS:"):
+          residentMemory = int(line.split()[1])
+          break
+    for task in os.listdir(f"/proc/{pid}/task"):
+      with open(f"/proc/{pid}/task/{task}/children") as childrenFile:
+        for child in childrenFile.read().split():
+          residentMemory += procResidentMemory(child)
+  except OSError:
+    # The process finished meanwhile
+    pass
+  return residentMemory
+
+
+def memoryUsage():
+  """
+  Current resident memory (MB) of this process and of its child processes, such as the CLIs
+  :return: None if it cannot be read on this platform
+  """
+  if psutil is not None:
+    process = psutil.Process()
+    processes = [process] + process.children(recursive=True)
+    residentMemory = 0
+    for process in processes:
+      try:
+        residentMemory += process.memory_info().rss
+      except psutil.Error:
+        pass
+    return residentMemory / (1024.0 * 1024.0)
+  if os.path.exists("/proc/self/status"):
+    return procResidentMemory(os.getpid()) / 1024.0
+  return None
+
+
+def resourceSnapshot():
+  snapshot = {"wallTime": time.perf_counter(), "cpuTime": time.process_time()}
+  if resource is not None:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    snapshot["cpuTime"] += children.ru_utime + children.ru_stime
+  return snapshot
+
+
+def measure(name, start, end, peakMemory=None):
+  return {"name": name,
+          "wallTime": round(end["wallTime"] - start["wallTime"], 3),
+          "cpuTime": round(end["cpuTime"] - start["cpuTime"], 3),
+          "peakMemoryUsage": round(peakMemory, 1) if peakMemory is not None else None}
+
+
+class MemorySampler:
+  """
+  Sample the resident memory in a background thread, keeping the peak of every measured interval
+  (a stage or a CLI execution) since it was started.
+  """
+
+  def __init__(self, interval=SAMPLING_INTERVAL, usage=memoryUsage):
+    self.interval = interval
+    self.usage = usage
+    self._peaks = {}
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._thread = None
+    if self.usage() is not None:
+      self._thread = threading.Thread(target=self._sample, name="MemorySampler", daemon=True)
+      self._thread.start()
+
+  def _sample(self):
+    while not self._stopped.wait(self.interval):
+      self.update()
+
+  def update(self):
+    current = self.usage()
+    if current is None:
+      return
+    with self._lock:
+      for key, peak in self._peaks.items():
+        if peak is None or current > peak:
+          self._peaks[key] = current
+
+  def start(self, key):
+    if self._thread is None:
+      return
+    with self._lock:
+      self._peaks[key] = None
+    self.update()
+
+  def end(self, key):
+    """
+    Stop measuring an interval
+    :param key:
+    :return: peak resident memory (MB) of the interval, None if not measured
+    """
+    if self._thread is None:
+      return None
+    self.update()
+    with self._lock:
+      return self._peaks.pop(key, None)
+
+  def stop(self):
+    self._stopped.set()
+    if self._thread is not None:
+      self._thread.join()
+
+
+class RunProfiler:
+  """
+  Measure the stages of a run and its CLI executions.
+  """
+
+  def __init__(self, parameters=None):
+    self.parameters = parameters or {}
+    self.stages = []
+    self.clis = []
+    self._start = resourceSnapshot()
+    self._stage = None
+    self._runningClis = {}
+    self._total = None
+    self._memorySampler = MemorySampler()
+    self._memorySampler.start("total")
+
+  def startStage(self, name):
+    """
+    Start a stage, ending the previous one
+    :param name:
+    :return:
+    """
+    self.endStage()
+    self._stage = (name, resourceSnapshot())
+    self._memorySampler.start("stage")
+
+  def endStage(self):
+    if self._stage is None:
+      return
+    name, start = self._stage
+    self.stages.append(measure(name, start, resourceSnapshot(), self._memorySampler.end("stage")))
+    self._stage = None
+
+  def startCLI(self, cliNode, moduleName):
+    self._runningClis[cliNode.GetID()] = (moduleName, self._stage[0] if self._stage else None, resourceSnapshot())
+    self._memorySampler.start(cliNode.GetID())
+
+  def endCLI(self, cliNode):
+    """
+    Measure a finished CLI execution and read its output parameters (see cliOutputs)
+    :param cliNode:
+    :return:
+    """
+    if cliNode.GetID() not in self._runningClis:
+      return
+    moduleName, stage, start = self._runningClis.pop(cliNode.GetID())
+    record = measure(moduleName, start, resourceSnapshot(), self._memorySampler.end(cliNode.GetID()))
+    record["stage"] = stage
+    record["status"] = cliNode.GetStatusString()
+    record["outputs"] = cliOutputs(cliNode)
+    self.clis.append(record)
+
+  def report(self):
+    """
+    Report of the run, ending the current stage and the memory sampling
+    :return: dictionary
+    """
+    self.endStage()
+    if self._total is None:
+      self._total = measure("total", self._start, resourceSnapshot(), self._memorySampler.end("total"))
+      del self._total["name"]
+      self.close()
+    total = self._total
+    return {"version": REPORT_VERSION,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters": self.parameters,
+            "total": total,
+            "stages": self.stages,
+            "clis": self.clis}
+
+  def close(self):
+    """
+    Stop the memory sampling, when the report of the run is not needed
+    :return:
+    """
+    self._memorySampler.stop()
+
+  def write(self, reportPath):
+    report = self.report()
+    with open(reportPath, "w") as reportFile:
+      json.dump(report, reportFile, indent=2)
+    return report
+
+
+def cliOutputs(cliNode):
+  """
+  Scalar output parameters returned by a CLI, such as the number of lesions and its peak memory usage
+  :param cliNode:
+  :return: dictionary of numbers
+  """
+  outputs = {}
+  for group in range(cliNode.GetNumberOfParameterGroups()):
+    for parameter in range(cliNode.GetNumberOfParametersInGroup(group)):
+      if cliNode.GetParameterChannel(group, parameter) != "output":
+        continue
+      if cliNode.GetParameterTag(group, parameter) not in ["integer", "float", "double"]:
+        continue
+      name = cliNode.GetParameterName(group, parameter)
+      try:
+        outputs[name] = float(cliNode.GetParameterAsString(name))
+      except ValueError:
+        pass
+  return outputs
+
+
+def logReport(report):
+  for stage in report["stages"]:
+    logging.info(f'{stage["name"]}: {stage["wallTime"]:.1f} s (CPU {stage["cpuTime"]:.1f} s)')
+  logging.info(f'Total: {report["total"]["wallTime"]:.1f} s (CPU {report["total"]["cpuTime"]:.1f} s)')
+
+
+def summarize(values):
+  values = [value for value in values if value is not None]
+  if not values:
+    return None
+  return {"mean": round(statistics.mean(values), 3),
+          "median": round(statistics.median(values), 3),
+          "max": round(max(values), 3)}
+
+
+def aggregateReports(reports):
+  """
+  Statistics of the stages and CLIs of several run reports: count, mean, median and maximum of the
+  wall time, processor time, peak memory usage and CLI outputs
+  :param reports: list of report dictionaries
+  :return: dictionary
+  """
+  def aggregate(records):
+    groups = {}
+    for record in records:
+      groups.setdefault(record["name"], []).append(record)
+    aggregated = {}
+    for name, group in groups.items():
+      aggregated[name] = {"count": len(group)}
+      for measurement in ["wallTime", "cpuTime", "peakMemoryUsage"]:
+        aggregated[name][measurement] = summarize([record[measurement] for record in group])
+      outputNames = sorted(set(output for record in group for output in record.get("outputs", {})))
+      if outputNames:
+        aggregated[name]["outputs"] = {output: summarize([record["outputs"].get(output) for record in group])
+                                       for output in outputNames}
+    return aggregated
+
+  return {"version": REPORT_VERSION,
+          "runs": len(reports),
+          "total": aggregate([dict(report["total"], name="total") for report in reports])["total"] if reports else {},
+          "stages": aggregate([stage for report in reports for stage in report["stages"]]),
+          "clis": aggregate([cli for report in reports for cli in report["clis"]])}
+
+
+def aggregateReportFiles(reportPaths, outputPath=None):
+  reports = []
+  for reportPath in reportPaths:
+    if not os.path.exists(reportPath):
+      continue
+    with open(reportPath) as reportFile:
+      reports.append(json.load(reportFile))
+  aggregated = aggregateReports(reports)
+  if outputPath:
+    with open(outputPath, "w") as outputFile:
+      json.dump(aggregated, outputFile, indent=2)
+  return aggregated
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Aggregate MS lesion simulation profiling reports.")
+  parser.add_argument("reports", nargs="+", help="JSON reports written by MSLesionSimulatorLogic.run")
+  parser.add_argument("--output", help="Aggregated report file, printed if not given")
+  args = parser.parse_args(argv)
+
+  aggregated = aggregateReportFiles(args.reports, args.output)
+  if not args.output:
+    print(json.dumps(aggregated, indent=2))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
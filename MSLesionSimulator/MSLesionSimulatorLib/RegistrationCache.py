@@ -0,0 +1,176 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+
+class RegistrationCache:
+  """
+  On-disk cache of the MNI152 to reference space BSpline transforms.
+
+  Transforms are keyed by the content of the reference volume (voxels and geometry) and by the
+  registration parameters, so simulating the same subject again, at another lesion load or seed,
+  reuses the transform instead of running BRAINSFit. The least recently used transforms are removed
+  once the cache grows beyond its maximum size.
+
+  Only computeKey, loadTransform and storeTransform need Slicer, the keys and the cache files are
+  handled without it.
+  """
+
+  def __init__(self, cacheFolder, maximumSize):
+    """
+    :param cacheFolder: folder where the transforms are stored
+    :param maximumSize: maximum total size of the cached transforms, in bytes
+    """
+    self.cacheFolder = cacheFolder
+    self.maximumSize = maximumSize
+
+  @staticmethod
+  def computeKey(referenceVolume, samplingPerc, grid, initiationMethod, isBET):
+    """
+    Content hash of the reference volume and of the registration parameters
+    :param referenceVolume:
+    :param samplingPerc:
+    :param grid:
+    :param initiationMethod:
+    :param isBET:
+    :return:
+    """
+    import slicer
+    import vtk
+    voxels = slicer.util.arrayFromVolume(referenceVolume)
+    ijkToRASMatrix = vtk.vtkMatrix4x4()
+    referenceVolume.GetIJKToRASMatrix(ijkToRASMatrix)
+    ijkToRAS = [ijkToRASMatrix.GetElement(i, j) for i in range(4) for j in range(4)]
+    return RegistrationCache.contentKey(str(voxels.dtype), voxels.shape, voxels.tobytes(), ijkToRAS,
+                                        samplingPerc, grid, initiationMethod, isBET)
+
+  @staticmethod
+  def contentKey(voxelType, shape, voxelData, ijkToRAS, samplingPerc, grid, initiationMethod, isBET):
+    """
+    Content hash of the voxels and geometry of a volume and of the registration parameters
+    :param voxelType: name of the voxel type, such as int16
+    :param shape: shape of the voxel array
+    :param voxelData: voxels, as bytes
+    :param ijkToRAS: IJK to RAS matrix, row by row
+    :param samplingPerc:
+    :param grid:
+    :param initiationMethod:
+    :param isBET:
+    :return:
+    """
+    contentHash = hashlib.sha256()
+    contentHash.update(voxelType.encode())
+    contentHash.update(str(tuple(shape)).encode())
+    contentHash.update(json.dumps([float(value) for value in ijkToRAS]).encode())
+    contentHash.update(voxelData)
+    contentHash.update(json.dumps({"samplingPerc": samplingPerc,
+                                   "grid": str(grid),
+                                   "initiationMethod": initiationMethod,
+                                   "isBET": bool(isBET)}, sort_keys=True).encode())
+    return contentHash.hexdigest()
+
+  def getTransformPath(self, key):
+    return os.path.join(self.cacheFolder, key + ".h5")
+
+  def findTransformFile(self, key):
+    """
+    Path of the cached transform of the given key
+    :param key:
+    :return: path, None if the transform is not cached
+    """
+    transformPath = self.getTransformPath(key)
+    return transformPath if os.path.exists(transformPath) else None
+
+  def markUsed(self, key):
+    """
+    Cached transforms are evicted by modification time, so a hit marks the transform as recently used
+    :param key:
+    :return:
+    """
+    os.utime(self.getTransformPath(key), None)
+
+  def addTransformFile(self, key, writeTransform):
+    """
+    Add a transform to the cache and evict the least recently used ones if needed
+    :param key:
+    :param writeTransform: function writing the transform to the given path, returning False on failure
+    :return: True if the transform was added
+    """
+    if not os.path.exists(self.cacheFolder):
+      os.makedirs(self.cacheFolder)
+    # Written under a temporary name first, so that other Slicer processes sharing the cache never
+    # read a partial transform
+    temporaryPath = os.path.join(self.cacheFolder, key + "." + uuid.uuid4().hex + ".h5")
+    if not writeTransform(temporaryPath):
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+      return False
+    os.replace(temporaryPath, self.getTransformPath(key))
+    self.evict()
+    return True
+
+  def loadTransform(self, key):
+    """
+    Load the cached transform of the given key into the scene
+    :param key:
+    :return: transform node, None if the transform is not cached
+    """
+    import slicer
+    transformPath = self.findTransformFile(key)
+    if transformPath is None:
+      return None
+    (readSuccess, transformNode) = slicer.util.loadTransform(transformPath, True)
+    if not readSuccess:
+      logging.info("Could not read the cached transform " + transformPath)
+      return None
+    self.markUsed(key)
+    return transformNode
+
+  def storeTransform(self, key, transformNode):
+    """
+    Save the transform in the cache and evict the least recently used ones if needed
+    :param key:
+    :param transformNode:
+    :return:
+    """
+    import slicer
+    if not self.addTransformFile(key, lambda path: slicer.util.saveNode(transformNode, path)):
+      logging.info("Could not save the transform in the registration cache.")
+
+  def evict(self):
+    """
+    Remove the least recently used transforms until the cache fits its maximum size
+    :return:
+    """
+    entries = []
+    for fileName in os.listdir(self.cacheFolder):
+      path = os.path.join(self.cacheFolder, fileName)
+      # Temporary files of transforms being written are named <key>.<uid>.h5 and are left alone
+      if fileName.endswith(".h5") and fileName.count(".") == 1 and os.path.isfile(path):
+        fileStat = os.stat(path)
+        entries.append((fileStat.st_mtime, fileStat.st_size, path))
+
+    totalSize = sum(entry[1] for entry in entries)
+    for (modificationTime, size, path) in sorted(entries):
+      if totalSize <= self.maximumSize:
+        break
+      try:
+        os.remove(path)
+        totalSize -= size
+      except OSError:
+        logging.info("Could not remove the cached transform " + path)
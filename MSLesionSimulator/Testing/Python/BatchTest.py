@@ -0,0 +1,103 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+  from MSLesionSimulatorLib import Batch
+except ImportError:
+  # Run from the source tree
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+  from MSLesionSimulatorLib import Batch
+
+
+class BatchTest(unittest.TestCase):
+
+  manifest = {"subjects": [{"id": "sub01", "T1": "sub01_T1.nii.gz", "T2-FLAIR": "sub01_FLAIR.nii.gz"},
+                           {"id": "sub02", "T1": "sub02_T1.nii.gz", "PD": ""}],
+              "lesionLoads": [5, 10, 20],
+              "seeds": [1, 2],
+              "parameters": {"numberOfThreads": 4}}
+
+  def test_expandJobs(self):
+    jobs = Batch.expandJobs(self.manifest)
+    # One job per subject, lesion load and seed
+    self.assertEqual(len(jobs), 2 * 3 * 2)
+    self.assertEqual([(job["subject"], job["lesionLoad"], job["seed"]) for job in jobs],
+                     [(subject, lesionLoad, seed) for subject in ["sub01", "sub02"]
+                      for lesionLoad in [5, 10, 20] for seed in [1, 2]])
+    self.assertEqual(jobs[0]["inputs"], {"T1": "sub01_T1.nii.gz", "T2-FLAIR": "sub01_FLAIR.nii.gz"})
+    # Modalities without a file are left out
+    self.assertEqual(jobs[-1]["inputs"], {"T1": "sub02_T1.nii.gz"})
+    self.assertEqual(jobs[0]["parameters"]["numberOfThreads"], 4)
+    self.assertEqual(jobs[0]["parameters"]["samplingPerc"], Batch.DEFAULT_PARAMETERS["samplingPerc"])
+    self.assertEqual(len(set(Batch.jobOutputFolder("out", job) for job in jobs)), len(jobs))
+
+  def test_expandLesionMapsOnlyJobs(self):
+    manifest = dict(self.manifest, parameters={"lesionMapsOnly": True})
+    jobs = Batch.expandJobs(manifest)
+    # Every lesion load and seed of a subject is generated by a single job
+    self.assertEqual(len(jobs), 2)
+    self.assertEqual(jobs[0]["lesionLoad"], [5, 10, 20])
+    self.assertEqual(jobs[0]["seed"], [1, 2])
+    self.assertEqual(Batch.jobOutputFolder("out", jobs[0]), os.path.join("out", "sub01"))
+
+  def test_expandDefaultJobs(self):
+    jobs = Batch.expandJobs({"subjects": [{"id": "sub01", "T1": "sub01_T1.nii.gz"}]})
+    self.assertEqual(len(jobs), 1)
+    self.assertEqual((jobs[0]["lesionLoad"], jobs[0]["seed"]), (10, 0))
+    self.assertEqual(jobs[0]["parameters"], Batch.DEFAULT_PARAMETERS)
+
+  def test_missingOutputs(self):
+    folder = tempfile.mkdtemp()
+    try:
+      startTime = int(time.time())
+      paths = [os.path.join(folder, name) for name in ["T1.nii.gz", "old.nii.gz", "map1.nii.gz", "missing.nii.gz"]]
+      for path in paths[:3]:
+        open(path, "w").close()
+      # Left by a previous run of the job
+      os.utime(paths[1], (startTime - 100, startTime - 100))
+      outputs = {"T1": paths[0], "T2": paths[1], "lesionMaps": [paths[2], paths[3]],
+                 "profile": os.path.join(folder, "profile.json")}
+      self.assertEqual(Batch.missingOutputs(outputs, startTime), [paths[1], paths[3]])
+    finally:
+      shutil.rmtree(folder)
+
+  def test_runJobProcessFailingWorker(self):
+    folder = tempfile.mkdtemp()
+    temporaryFolder = tempfile.tempdir
+    try:
+      tempfile.tempdir = os.path.join(folder, "tmp")
+      os.makedirs(tempfile.tempdir)
+      outputFolder = os.path.join(folder, "output")
+      job = Batch.expandJobs(self.manifest)[0]
+      # The Python interpreter stands for a Slicer executable exiting before running the job
+      result = Batch.CohortRunner(sys.executable, outputFolder).runJobProcess(job)
+      self.assertEqual(result["status"], "failed")
+      self.assertTrue(result["error"].startswith("Worker exited with code"))
+      with open(Batch.jobOutputFolder(outputFolder, job) + ".log") as logFile:
+        self.assertIn("--no-splash", logFile.read())
+      # The working folder of the job is removed
+      self.assertEqual(os.listdir(tempfile.tempdir), [])
+    finally:
+      tempfile.tempdir = temporaryFolder
+      shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+  unittest.main()
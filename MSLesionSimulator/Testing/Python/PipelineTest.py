@@ -0,0 +1,143 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+  from MSLesionSimulatorLib import Pipeline
+except ImportError:
+  # Run from the source tree
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+  from MSLesionSimulatorLib import Pipeline
+
+
+def applyAffineTransform(transform, point):
+  """
+  Point mapped by an ITK affine transform y = A (x - c) + c + t
+  :param transform: dictionary with the Transform, Parameters and FixedParameters entries
+  :param point:
+  :return:
+  """
+  parameters = transform["Parameters"]
+  center = transform["FixedParameters"]
+  return [sum(parameters[row * 3 + column] * (point[column] - center[column]) for column in range(3))
+          + center[row] + parameters[9 + row] for row in range(3)]
+
+
+def applyTransforms(transforms, point):
+  """
+  Point mapped by a list of transforms, the last one being applied first as in an ITK composite transform
+  :param transforms:
+  :param point:
+  :return:
+  """
+  for transform in reversed(transforms):
+    point = applyAffineTransform(transform, point)
+  return point
+
+
+class PipelineTransformTest(unittest.TestCase):
+
+  MNIToReference = {"Transform": "AffineTransform_double_3_3",
+                    "Parameters": [1.1, 0.1, 0.0, -0.05, 0.9, 0.2, 0.0, 0.1, 1.2, 5.0, -3.0, 12.0],
+                    "FixedParameters": [1.0, 2.0, 3.0]}
+  conform = {"Transform": "AffineTransform_double_3_3",
+             "Parameters": [0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 2.0, -7.0, 4.0, 0.5],
+             "FixedParameters": [-10.0, 0.0, 20.0]}
+  points = [[0.0, 0.0, 0.0], [10.0, -20.0, 30.0], [-4.5, 7.25, 100.0]]
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def assertPointsEqual(self, first, second):
+    for firstValue, secondValue in zip(first, second):
+      self.assertAlmostEqual(firstValue, secondValue, places=9)
+
+  def test_invertAffineTransform(self):
+    for transform in [self.MNIToReference, self.conform]:
+      inverse = Pipeline.invertAffineTransform(transform)
+      self.assertEqual(inverse["Transform"], transform["Transform"])
+      for point in self.points:
+        self.assertPointsEqual(applyAffineTransform(inverse, applyAffineTransform(transform, point)), point)
+        self.assertPointsEqual(applyAffineTransform(transform, applyAffineTransform(inverse, point)), point)
+
+  def test_invertSingularTransform(self):
+    singular = dict(self.conform, Parameters=[1.0, 2.0, 3.0, 2.0, 4.0, 6.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0])
+    with self.assertRaises(ValueError):
+      Pipeline.invertAffineTransform(singular)
+    with self.assertRaises(ValueError):
+      Pipeline.invertAffineTransform(dict(self.conform, Transform="BSplineTransform_double_3_3"))
+
+  def test_readTextTransforms(self):
+    transformPath = os.path.join(self.folder, "composite.tfm")
+    Pipeline.writeTextTransforms(transformPath, [self.MNIToReference, self.conform])
+    transforms = Pipeline.readTextTransforms(transformPath)
+    # The composite transform is replaced by its components, in the same order
+    self.assertEqual(len(transforms), 2)
+    for transform, expected in zip(transforms, [self.MNIToReference, self.conform]):
+      self.assertEqual(transform["Transform"], expected["Transform"])
+      self.assertEqual(transform["Parameters"], expected["Parameters"])
+      self.assertEqual(transform["FixedParameters"], expected["FixedParameters"])
+
+  def test_composeMNIToNativeTransform(self):
+    MNIToReferencePath = os.path.join(self.folder, "MNIToReference.tfm")
+    conformPath = os.path.join(self.folder, "conform.tfm")
+    outputPath = os.path.join(self.folder, "MNIToNative.tfm")
+    Pipeline.writeTextTransforms(MNIToReferencePath, [self.MNIToReference])
+    Pipeline.writeTextTransforms(conformPath, [self.conform])
+    Pipeline.composeMNIToNativeTransform(MNIToReferencePath, conformPath, outputPath)
+
+    composed = Pipeline.readTextTransforms(outputPath)
+    self.assertEqual(len(composed), 2)
+    # A native point is mapped back to the reference space first, then to the MNI152 space
+    inverseConform = Pipeline.invertAffineTransform(self.conform)
+    for point in self.points:
+      expected = applyAffineTransform(self.MNIToReference, applyAffineTransform(inverseConform, point))
+      self.assertPointsEqual(applyTransforms(composed, point), expected)
+      # The conforming registration of the native point gives back the point itself
+      self.assertPointsEqual(applyTransforms(composed[1:], applyAffineTransform(self.conform, point)), point)
+
+  def test_composeNonAffineConformTransform(self):
+    MNIToReferencePath = os.path.join(self.folder, "MNIToReference.tfm")
+    conformPath = os.path.join(self.folder, "conform.tfm")
+    Pipeline.writeTextTransforms(MNIToReferencePath, [self.MNIToReference])
+    Pipeline.writeTextTransforms(conformPath, [self.conform, self.conform])
+    with self.assertRaises(ValueError):
+      Pipeline.composeMNIToNativeTransform(MNIToReferencePath, conformPath, os.path.join(self.folder, "output.tfm"))
+
+
+class PipelineArgumentsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def test_numberFollowUp(self):
+    # Rejected before any CLI is started
+    with self.assertRaises(SystemExit):
+      Pipeline.main(["--t1", "T1.nii.gz", "--output", self.folder, "--isLongitudinal", "--numberFollowUp", "0"])
+    with self.assertRaises(ValueError):
+      Pipeline.runPipeline({"T1": "T1.nii.gz"}, self.folder, 10, {"isLongitudinal": True, "numberFollowUp": 0})
+
+
+if __name__ == "__main__":
+  unittest.main()
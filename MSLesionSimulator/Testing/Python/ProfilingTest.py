@@ -0,0 +1,95 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+  from MSLesionSimulatorLib import Profiling
+except ImportError:
+  # Run from the source tree
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+  from MSLesionSimulatorLib import Profiling
+
+
+def record(name, wallTime, cpuTime, peakMemoryUsage, outputs=None):
+  measured = {"name": name, "wallTime": wallTime, "cpuTime": cpuTime, "peakMemoryUsage": peakMemoryUsage}
+  if outputs:
+    measured["outputs"] = outputs
+  return measured
+
+
+class ProfilingTest(unittest.TestCase):
+
+  # The peak memory usage is None when it cannot be measured on the platform of the run
+  reports = [{"version": Profiling.REPORT_VERSION,
+              "total": {"wallTime": 10.0, "cpuTime": 30.0, "peakMemoryUsage": None},
+              "stages": [record("registration", 6.0, 20.0, None), record("simulation", 4.0, 10.0, None)],
+              "clis": [record("GenerateMask", 1.0, 2.0, None, {"peakMemoryUsage": 100.0})]},
+             {"version": Profiling.REPORT_VERSION,
+              "total": {"wallTime": 20.0, "cpuTime": 50.0, "peakMemoryUsage": 800.0},
+              "stages": [record("registration", 12.0, 36.0, 700.0), record("simulation", 8.0, 14.0, 500.0)],
+              "clis": [record("GenerateMask", 3.0, 4.0, 300.0, {"peakMemoryUsage": 200.0})]}]
+
+  def test_aggregateReports(self):
+    aggregated = Profiling.aggregateReports(self.reports)
+    self.assertEqual(aggregated["runs"], 2)
+    self.assertEqual(aggregated["total"]["count"], 2)
+    self.assertEqual(aggregated["total"]["wallTime"], {"mean": 15.0, "median": 15.0, "max": 20.0})
+    # Runs without a peak memory usage are left out of its statistics
+    self.assertEqual(aggregated["total"]["peakMemoryUsage"], {"mean": 800.0, "median": 800.0, "max": 800.0})
+    self.assertEqual(sorted(aggregated["stages"]), ["registration", "simulation"])
+    self.assertEqual(aggregated["stages"]["registration"]["cpuTime"], {"mean": 28.0, "median": 28.0, "max": 36.0})
+    self.assertEqual(aggregated["stages"]["simulation"]["peakMemoryUsage"]["max"], 500.0)
+    cli = aggregated["clis"]["GenerateMask"]
+    self.assertEqual(cli["peakMemoryUsage"], {"mean": 300.0, "median": 300.0, "max": 300.0})
+    self.assertEqual(cli["outputs"]["peakMemoryUsage"], {"mean": 150.0, "median": 150.0, "max": 200.0})
+
+  def test_aggregateReportsWithoutMemory(self):
+    aggregated = Profiling.aggregateReports(self.reports[:1])
+    self.assertIsNone(aggregated["total"]["peakMemoryUsage"])
+    self.assertIsNone(aggregated["stages"]["registration"]["peakMemoryUsage"])
+    self.assertEqual(Profiling.aggregateReports([])["total"], {})
+
+  def test_aggregateReportFiles(self):
+    folder = tempfile.mkdtemp()
+    try:
+      reportPaths = []
+      for index, report in enumerate(self.reports):
+        reportPaths.append(os.path.join(folder, f"report{index}.json"))
+        with open(reportPaths[-1], "w") as reportFile:
+          json.dump(report, reportFile)
+      # Jobs that failed before writing their report are skipped
+      reportPaths.append(os.path.join(folder, "missing.json"))
+      outputPath = os.path.join(folder, "aggregated.json")
+      aggregated = Profiling.aggregateReportFiles(reportPaths, outputPath)
+      self.assertEqual(aggregated, Profiling.aggregateReports(self.reports))
+      with open(outputPath) as outputFile:
+        self.assertEqual(json.load(outputFile), aggregated)
+    finally:
+      shutil.rmtree(folder)
+
+  def test_measure(self):
+    start = {"wallTime": 1.0, "cpuTime": 2.0}
+    end = {"wallTime": 3.5, "cpuTime": 7.25}
+    self.assertEqual(Profiling.measure("stage", start, end),
+                     {"name": "stage", "wallTime": 2.5, "cpuTime": 5.25, "peakMemoryUsage": None})
+    self.assertEqual(Profiling.measure("stage", start, end, 123.456)["peakMemoryUsage"], 123.5)
+
+
+if __name__ == "__main__":
+  unittest.main()
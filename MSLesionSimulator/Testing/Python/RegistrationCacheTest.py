@@ -0,0 +1,101 @@
+# Copyright 2016 Antonio Carlos da Silva Senra Filho and Fabricio Henrique Simozo
+#
+# Licensed under the Apache License, Version 2.0(the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http: // www.apache.org / licenses / LICENSE - 2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+  from MSLesionSimulatorLib.RegistrationCache import RegistrationCache
+except ImportError:
+  # Run from the source tree
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+  from MSLesionSimulatorLib.RegistrationCache import RegistrationCache
+
+
+class RegistrationCacheTest(unittest.TestCase):
+
+  identity = [1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+  voxels = bytes(range(24))
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.cacheFolder = os.path.join(self.folder, "cache")
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def key(self, voxelType="uint8", shape=(2, 3, 4), voxels=None, ijkToRAS=None, samplingPerc=0.05,
+          grid="5,5,5", initiationMethod="useMomentsAlign", isBET=False):
+    return RegistrationCache.contentKey(voxelType, shape, self.voxels if voxels is None else voxels,
+                                        self.identity if ijkToRAS is None else ijkToRAS,
+                                        samplingPerc, grid, initiationMethod, isBET)
+
+  def writeTransform(self, size):
+    def write(path):
+      with open(path, "wb") as transformFile:
+        transformFile.write(b"\0" * size)
+      return True
+    return write
+
+  def setModificationTime(self, cache, key, modificationTime):
+    os.utime(cache.getTransformPath(key), (modificationTime, modificationTime))
+
+  def test_contentKey(self):
+    key = self.key()
+    self.assertEqual(key, self.key(shape=[2, 3, 4]))
+    spacing = list(self.identity)
+    spacing[0] = 2.0
+    for otherKey in [self.key(voxelType="int8"), self.key(shape=(4, 3, 2)), self.key(voxels=bytes(24)),
+                     self.key(ijkToRAS=spacing), self.key(samplingPerc=0.1), self.key(grid="7,7,7"),
+                     self.key(initiationMethod="useGeometryAlign"), self.key(isBET=True)]:
+      self.assertNotEqual(key, otherKey)
+
+  def test_findTransformFile(self):
+    cache = RegistrationCache(self.cacheFolder, 1000)
+    self.assertIsNone(cache.findTransformFile("a"))
+    self.assertTrue(cache.addTransformFile("a", self.writeTransform(10)))
+    self.assertEqual(cache.findTransformFile("a"), cache.getTransformPath("a"))
+    # A failed write leaves neither the transform nor its temporary file
+    self.assertFalse(cache.addTransformFile("b", lambda path: self.writeTransform(10)(path) and False))
+    self.assertIsNone(cache.findTransformFile("b"))
+    self.assertEqual(os.listdir(self.cacheFolder), ["a.h5"])
+
+  def test_evictLeastRecentlyUsed(self):
+    cache = RegistrationCache(self.cacheFolder, 350)
+    now = time.time()
+    for index, key in enumerate(["a", "b", "c"]):
+      cache.addTransformFile(key, self.writeTransform(100))
+      self.setModificationTime(cache, key, now - 1000 + index * 100)
+    # The first cached transform is the least recently used one, unless it was used since
+    cache.markUsed("a")
+    self.assertTrue(cache.addTransformFile("d", self.writeTransform(100)))
+    self.assertEqual(sorted(os.listdir(self.cacheFolder)), ["a.h5", "c.h5", "d.h5"])
+
+  def test_evictSkipsTemporaryFiles(self):
+    cache = RegistrationCache(self.cacheFolder, 150)
+    os.makedirs(self.cacheFolder)
+    temporaryPath = os.path.join(self.cacheFolder, "a.0123456789abcdef.h5")
+    with open(temporaryPath, "wb") as temporaryFile:
+      temporaryFile.write(b"\0" * 1000)
+    cache.addTransformFile("b", self.writeTransform(100))
+    cache.addTransformFile("c", self.writeTransform(100))
+    self.assertTrue(os.path.exists(temporaryPath))
+    self.assertEqual(len([fileName for fileName in os.listdir(self.cacheFolder) if fileName.count(".") == 1]), 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
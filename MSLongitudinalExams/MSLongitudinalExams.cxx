@@ -17,16 +17,23 @@
 
 #include "itkPluginUtilities.h"
 
-#include "itkCastImageFilter.h"
 #include "itkGaussianDistribution.h"
 #include "itkImageRegionIterator.h"
-#include "itkMaskNegatedImageFilter.h"
 #include "itkSmoothingRecursiveGaussianImageFilter.h"
-#include "itkMultiplyImageFilter.h"
 #include "itkConnectedComponentImageFilter.h"
 #include "itkRelabelComponentImageFilter.h"
-#include "itkNormalVariateGenerator.h"
-#include "itkImageRegionIterator.h"
+
+#include "itkPhiloxGaussianImageSource.h"
+#include "LesionImageWriter.h"
+#include "LesionExecutionReport.h"
+#include "LesionProgress.h"
+
+#include <algorithm>
+#include <ctime>
+#include <mutex>
+#include <sstream>
+#include <thread>
+#include <vector>
 
 #include "MSLongitudinalExamsCLP.h"
 
@@ -57,6 +64,14 @@ int DoIt( int argc, char * argv[], T )
 {
     PARSE_ARGS;
 
+    LesionReport::ProgressReporter progress("MSLongitudinalExams", "Simulating longitudinal exams", CLPProcessInformation);
+
+    //The minimum of the XML description is not enforced on the command line
+    if (numberFollowUp < 1) {
+        cerr<<"The number of follow-ups must be at least 1, got "<<numberFollowUp<<"."<<endl;
+        return EXIT_FAILURE;
+    }
+
     typedef    T                    InputPixelType;
     typedef    unsigned short       LabelPixelType;
     typedef    T                    OutputPixelType;
@@ -68,34 +83,23 @@ int DoIt( int argc, char * argv[], T )
 
     typedef itk::ImageFileReader<InputImageType>    ReaderType;
     typedef itk::ImageFileReader<LabelInputType>    LabelReaderType;
-    typedef itk::ImageFileWriter<OutputImageType>   WriterType;
-    typedef itk::ImageFileWriter<CastImageType>     DebugWriterType;
-
-    typedef itk::CastImageFilter<InputImageType, CastImageType>    CastInputType;
-    typedef itk::CastImageFilter<CastImageType, OutputImageType>   CastOutputType;
-
-    typedef itk::MaskImageFilter<CastImageType, LabelInputType>                         MaskType;
-    typedef itk::MaskNegatedImageFilter<CastImageType, LabelInputType>                  MaskNegateType;
 
-    typedef itk::ImageRegionIterator<CastImageType>                                     ImageIterator;
     typedef itk::SmoothingRecursiveGaussianImageFilter<CastImageType, CastImageType>    SmoothType;
-    typedef itk::MultiplyImageFilter<CastImageType, CastImageType>                      MultiplyImageType;
     typedef itk::ConnectedComponentImageFilter<LabelInputType, LabelInputType>          ConnectedType;
     typedef itk::RelabelComponentImageFilter<LabelInputType, LabelInputType>            RelabelerType;
-    typedef itk::Statistics::NormalVariateGenerator                                     GeneratorType;
-    typedef itk::ImageRegionIterator<CastImageType>                                     IteratorType;
+    typedef itk::PhiloxGaussianImageSource<CastImageType>                               NoiseSourceType;
 
     typename ReaderType::Pointer reader = ReaderType::New();
     typename LabelReaderType::Pointer lesionMask = LabelReaderType::New();
 
     reader->SetFileName( inputVolume.c_str() );
-    reader->Update();
-
-    typename CastInputType::Pointer castInput = CastInputType::New();
-    castInput->SetInput(reader->GetOutput());
-    castInput->Update();
     lesionMask->SetFileName( lesionLabel.c_str() );
+    {
+    itk::PluginFilterWatcher watchReader(reader, "Reading input volume", CLPProcessInformation, 0.05, 0);
+    itk::PluginFilterWatcher watchLabelReader(lesionMask, "Reading lesion label", CLPProcessInformation, 0.05, 0.05);
+    reader->Update();
     lesionMask->Update();
+    }
 
     itk::Statistics::GaussianDistribution::Pointer gaussian = itk::Statistics::GaussianDistribution::New();
 
@@ -126,257 +130,240 @@ int DoIt( int argc, char * argv[], T )
         gaussian->SetVariance(adcStd*adcStd);
     }
     cout<<"Lesion intensity distribution ("<<imageModality<<") - Mean: "<<gaussian->GetMean()<<" and Variance: "<<gaussian->GetVariance()<<endl;
-    typename GeneratorType::Pointer normalGenerator = GeneratorType::New();
-    normalGenerator->Initialize(rand());
-
-    //Creating deformation map
-    typename CastImageType::Pointer deformationMap = CastImageType::New();
-    deformationMap->CopyInformation(reader->GetOutput());
-    deformationMap->SetRegions(reader->GetOutput()->GetBufferedRegion());
-    deformationMap->Allocate();
-
-    ImageIterator defMapIt(deformationMap, deformationMap->GetBufferedRegion());
-    defMapIt.GoToBegin();
-    while (!defMapIt.IsAtEnd()) {
-        defMapIt.Set(normalGenerator->GetVariate()*sqrt(gaussian->GetVariance()) + gaussian->GetMean());
-        ++defMapIt;
-    }
+    const uint64_t randomSeed = static_cast<uint64_t>(seed != 0 ? seed : time(0));
+    const uint32_t stream = LesionRandom::ModalityStream(imageModality);
+    cout<<"Random seed: "<<randomSeed<<endl;
+    LesionRandom::NormalGenerator normalGenerator(randomSeed, stream, LesionRandom::LesionLevelSubstream);
+
+    //Creating deformation map: the noise is drawn in parallel from the modality stream of the seed
+    typename NoiseSourceType::Pointer deformationMap = NoiseSourceType::New();
+    deformationMap->SetReferenceImage(reader->GetOutput());
+    deformationMap->SetRegion(reader->GetOutput()->GetBufferedRegion());
+    deformationMap->SetSeed(randomSeed);
+    deformationMap->SetStream(stream);
+    deformationMap->SetSubstream(LesionRandom::NoiseFieldSubstream);
+    deformationMap->SetMean(gaussian->GetMean());
+    deformationMap->SetStandardDeviation(sqrt(gaussian->GetVariance()));
+
     typename SmoothType::Pointer smoothDeformationMap = SmoothType::New();
-    smoothDeformationMap->SetInput(deformationMap);
+    smoothDeformationMap->SetInput(deformationMap->GetOutput());
     smoothDeformationMap->SetSigma(homogeneity);
 
-    //Mask deformation map, adding independent intensity levels, and smooth lesion borders
-    CastImageType::Pointer lesionMaskDeformationMapDCLevel = CastImageType::New();
-    lesionMaskDeformationMapDCLevel->CopyInformation(lesionMask->GetOutput());
-    lesionMaskDeformationMapDCLevel->SetRegions(lesionMask->GetOutput()->GetBufferedRegion());
-    lesionMaskDeformationMapDCLevel->SetSpacing(lesionMask->GetOutput()->GetSpacing());
-    lesionMaskDeformationMapDCLevel->SetOrigin(lesionMask->GetOutput()->GetOrigin());
-    lesionMaskDeformationMapDCLevel->Allocate();
-
-    typename MaskNegateType::Pointer lesionMaskDeformationMap = MaskNegateType::New();
-    lesionMaskDeformationMap->SetInput(smoothDeformationMap->GetOutput());
-    lesionMaskDeformationMap->SetOutsideValue(0.0);
-
     typename ConnectedType::Pointer connectedLesions = ConnectedType::New();
     connectedLesions->SetInput(lesionMask->GetOutput());
-    connectedLesions->Update();
 
     typename RelabelerType::Pointer sortLesions = RelabelerType::New();
     sortLesions->SetInput(connectedLesions->GetOutput());
     sortLesions->SetSortByObjectSize(true);
+    {
+    itk::PluginFilterWatcher watchSmooth(smoothDeformationMap, "Smoothing deformation map", CLPProcessInformation, 0.1, 0.1);
+    itk::PluginFilterWatcher watchConnected(connectedLesions, "Labelling connected lesions", CLPProcessInformation, 0.05, 0.2);
+    itk::PluginFilterWatcher watchRelabel(sortLesions, "Sorting lesions by size", CLPProcessInformation, 0.05, 0.25);
+    smoothDeformationMap->Update();
     sortLesions->Update();
+    }
     int nLesion = sortLesions->GetNumberOfObjects();
     //    int nLesion = connectedLesions->GetObjectCount();
     int nChangingLesion = sortLesions->GetNumberOfObjects() * static_cast<double>((double)balanceHI/(double)100.0) ;
     cout<<"Number of temporally changing lesions: "<<nChangingLesion<<endl;
 
+    //Voxels of every lesion, found once: offsets in the image buffer, lesion label and smoothed lesion texture
+    vector<size_t> lesionOffsets;
+    vector<LabelPixelType> lesionLabels;
+    vector<float> lesionTexture;
+    const LabelPixelType* labelBuffer = sortLesions->GetOutput()->GetBufferPointer();
+    const LabelPixelType* maskBuffer = lesionMask->GetOutput()->GetBufferPointer();
+    const float* textureBuffer = smoothDeformationMap->GetOutput()->GetBufferPointer();
+    const size_t numberOfVoxels = lesionMask->GetOutput()->GetBufferedRegion().GetNumberOfPixels();
+    for (size_t offset = 0; offset < numberOfVoxels; offset++) {
+        if (maskBuffer[offset] > 0 && labelBuffer[offset] > 0) {
+            lesionOffsets.push_back(offset);
+            lesionLabels.push_back(labelBuffer[offset]);
+            lesionTexture.push_back(textureBuffer[offset]);
+        }
+    }
+    smoothDeformationMap = nullptr;
+    deformationMap = nullptr;
+
+    //Longitudinal DC level function of the changing lesions: f(t) = alpha * t + local fluctuation,
+    //where alpha is based on the lesion contrast. Lesions that get brighter than the normal tissue
+    //are clipped above 1, and the ones that get darker are clipped below 1.
+    double alpha = 0.0, fluctuationSign = 1.0;
+    bool clipAbove = true;
+    if (imageModality=="T1" || imageModality=="DTI-FA") {
+        alpha = (1.0 - t1Contrast)/(double)6.0;
+    }else if (imageModality=="T2") {
+        alpha = (-1.0)*(t2Contrast - 1.0)/(double)6.0;
+    }else if (imageModality=="T2-FLAIR") {
+        alpha = (-1.0)*(flairContrast - 1.0)/(double)6.0;
+    }else if (imageModality=="PD") {
+        alpha = (-1.0)*(pdContrast - 1.0)/(double)6.0;
+    }else if (imageModality=="DTI-ADC") {
+        alpha = (-1.0)*(adcContrast - 1.0)/(double)6.0;
+    }
+    if (imageModality!="T1" && imageModality!="DTI-FA") {
+        fluctuationSign = -1.0;
+        clipAbove = false;
+    }
+
+    //DC level of every lesion at every time point, drawn in the same order as the lesions are modulated
+    const double stdev = sqrt(gaussian->GetVariance());
+    vector<float> DClevels((numberFollowUp+1)*(nLesion+1), 0.0);
+    vector<char> changingLesion(nLesion+1, 0);
     float DClevel=0.0, localFluctuation=0.0;
     for (int t = 1; t <= numberFollowUp; ++t) {
         nChangingLesion = sortLesions->GetNumberOfObjects() * static_cast<double>((double)balanceHI/(double)100.0);
         cout<<"Time point "<<t<<" simulation"<<endl;
-        for (unsigned int lesion = nLesion; lesion >= 1; --lesion) {
+        for (int lesion = nLesion; lesion >= 1; --lesion) {
             cout<<"Modulating lesion "<<(nLesion - lesion) + 1<<" of "<<nLesion<<"..."<<endl;
-            DClevel=0.0;
             if (nChangingLesion>0) {
-                lesionMaskDeformationMap->SetMaskImage(sortLesions->GetOutput());
-                lesionMaskDeformationMap->SetMaskingValue(lesion);
-                lesionMaskDeformationMap->Update();
-
-                IteratorType addLesion(lesionMaskDeformationMapDCLevel,lesionMaskDeformationMapDCLevel->GetBufferedRegion());
-                IteratorType lesionIt(lesionMaskDeformationMap->GetOutput(),lesionMaskDeformationMap->GetOutput()->GetBufferedRegion());
-                addLesion.GoToBegin();
-                lesionIt.GoToBegin();
-
-                if (imageModality=="T1") {
-                    //f(t) = alpha * t + (sigmaT1) - Longitudinal DC level function (based on the lesion contrast)
-                    localFluctuation = abs(normalGenerator->GetVariate())*variability*sqrt(gaussian->GetVariance());
-                    DClevel = ((1.0 - t1Contrast)/(double)6.0) * t + localFluctuation;
-                    cout<<lesion<<" - Mean fluctuation intensity: "<<DClevel<<endl;
-                    while (!addLesion.IsAtEnd()) {
-                        if (lesionIt.Get()!=static_cast<float>(0)) {
-                            if (lesionIt.Get()+DClevel>1.0) {
-                                addLesion.Set(1.0);
-                            }else{
-                                addLesion.Set(lesionIt.Get()+DClevel);
-                            }
-                            ++addLesion;
-                            ++lesionIt;
-                        }else{
-                            ++addLesion;
-                            ++lesionIt;
-                        }
-                    }
-                }else if (imageModality=="T2") {
-                    //f(t) = alpha * t + (sigmaT1) - Longitudinal DC level function (based on the lesion contrast)
-                    localFluctuation = (-1.0)*abs(normalGenerator->GetVariate())*variability*sqrt(gaussian->GetVariance());
-                    DClevel = (-1.0)*((t2Contrast - 1.0)/(double)6.0) * t + localFluctuation;
-                    cout<<lesion<<" - Mean fluctuation intensity: "<<DClevel<<endl;
-                    while (!addLesion.IsAtEnd()) {
-                        if (lesionIt.Get()!=static_cast<float>(0)) {
-                            if (lesionIt.Get()+DClevel<1.0) {
-                                addLesion.Set(1.0);
-                            }else{
-                                addLesion.Set(lesionIt.Get()+DClevel);
-                            }
-                            ++addLesion;
-                            ++lesionIt;
-                        }else{
-                            ++addLesion;
-                            ++lesionIt;
-                        }
-                    }
-                }else if (imageModality=="T2-FLAIR") {
-                    //f(t) = alpha * t + (sigmaT1) - Longitudinal DC level function (based on the lesion contrast)
-                    localFluctuation = (-1.0)*abs(normalGenerator->GetVariate())*variability*sqrt(gaussian->GetVariance());
-                    DClevel = (-1.0)*((flairContrast - 1.0)/(double)6.0) * t + localFluctuation;
-                    cout<<lesion<<" - Mean fluctuation intensity: "<<DClevel<<endl;
-                    while (!addLesion.IsAtEnd()) {
-                        if (lesionIt.Get()!=static_cast<float>(0)) {
-                            if (lesionIt.Get()+DClevel<1.0) {
-                                addLesion.Set(1.0);
-                            }else{
-                                addLesion.Set(lesionIt.Get()+DClevel);
-                            }
-                            ++addLesion;
-                            ++lesionIt;
-                        }else{
-                            ++addLesion;
-                            ++lesionIt;
-                        }
-                    }
-                }else if (imageModality=="PD") {
-                    //f(t) = alpha * t + (sigmaT1) - Longitudinal DC level function (based on the lesion contrast)
-                    localFluctuation = (-1.0)*abs(normalGenerator->GetVariate())*variability*sqrt(gaussian->GetVariance());
-                    DClevel = (-1.0)*((pdContrast - 1.0)/(double)6.0) * t + localFluctuation;
-                    cout<<lesion<<" - Mean fluctuation intensity: "<<DClevel<<endl;
-                    while (!addLesion.IsAtEnd()) {
-                        if (lesionIt.Get()!=static_cast<float>(0)) {
-                            if (lesionIt.Get()+DClevel<1.0) {
-                                addLesion.Set(1.0);
-                            }else{
-                                addLesion.Set(lesionIt.Get()+DClevel);
-                            }
-                            ++addLesion;
-                            ++lesionIt;
-                        }else{
-                            ++addLesion;
-                            ++lesionIt;
-                        }
-                    }
-                }else if (imageModality=="DTI-FA") {
-                    //f(t) = alpha * t + (sigmaT1) - Longitudinal DC level function (based on the lesion contrast)
-                    localFluctuation = abs(normalGenerator->GetVariate())*variability*sqrt(gaussian->GetVariance());
-                    DClevel = ((1.0 - t1Contrast)/(double)6.0) * t + localFluctuation;
-                    while (DClevel>1.0) {
-                        localFluctuation = abs(normalGenerator->GetVariate())*variability*sqrt(gaussian->GetVariance());
-                        DClevel = ((1.0 - t1Contrast)/(double)6.0) * t + localFluctuation;
-                    }
-                    cout<<lesion<<" - Mean fluctuation intensity: "<<DClevel<<endl;
-                    while (!addLesion.IsAtEnd()) {
-                        if (lesionIt.Get()!=static_cast<float>(0)) {
-                            if (lesionIt.Get()+DClevel>1.0) {
-                                addLesion.Set(1.0);
-                            }else{
-                                addLesion.Set(lesionIt.Get()+DClevel);
-                            }
-                            ++addLesion;
-                            ++lesionIt;
-                        }else{
-                            ++addLesion;
-                            ++lesionIt;
-                        }
-                    }
-                }else if (imageModality=="DTI-ADC") {
-                    //f(t) = alpha * t + (sigmaT1) - Longitudinal DC level function (based on the lesion contrast)
-                    localFluctuation = (-1.0)*abs(normalGenerator->GetVariate())*variability*sqrt(gaussian->GetVariance());
-                    DClevel = (-1.0)*((adcContrast - 1.0)/(double)6.0) * t + localFluctuation;
-                    cout<<lesion<<" - Mean fluctuation intensity: "<<DClevel<<endl;
-                    while (!addLesion.IsAtEnd()) {
-                        if (lesionIt.Get()!=static_cast<float>(0)) {
-                            if (lesionIt.Get()+DClevel<1.0) {
-                                addLesion.Set(1.0);
-                            }else{
-                                addLesion.Set(lesionIt.Get()+DClevel);
-                            }
-                            ++addLesion;
-                            ++lesionIt;
-                        }else{
-                            ++addLesion;
-                            ++lesionIt;
-                        }
-                    }
+                localFluctuation = fluctuationSign*abs(normalGenerator.GetVariate())*variability*stdev;
+                DClevel = alpha * t + localFluctuation;
+                while (imageModality=="DTI-FA" && DClevel>1.0) {
+                    localFluctuation = abs(normalGenerator.GetVariate())*variability*stdev;
+                    DClevel = alpha * t + localFluctuation;
                 }
+                changingLesion[lesion] = 1;
                 nChangingLesion--;
             }else{
-                lesionMaskDeformationMap->SetMaskImage(sortLesions->GetOutput());
-                lesionMaskDeformationMap->SetMaskingValue(lesion);
-                lesionMaskDeformationMap->Update();
-
-                IteratorType addLesion(lesionMaskDeformationMapDCLevel,lesionMaskDeformationMapDCLevel->GetBufferedRegion());
-                IteratorType lesionIt(lesionMaskDeformationMap->GetOutput(),lesionMaskDeformationMap->GetOutput()->GetBufferedRegion());
-                addLesion.GoToBegin();
-                lesionIt.GoToBegin();
-
-                DClevel = static_cast<float>(normalGenerator->GetVariate());
-                while(abs(DClevel)>variability*sqrt(gaussian->GetVariance())){
-                    DClevel = static_cast<float>(normalGenerator->GetVariate());
-                }
-                cout<<lesion<<" - Mean fluctuation intensity: "<<DClevel<<endl;
-                while (!addLesion.IsAtEnd()) {
-                    if (lesionIt.Get()!=static_cast<float>(0)) {
-                        addLesion.Set(lesionIt.Get()+DClevel);
-                        ++addLesion;
-                        ++lesionIt;
-                    }else{
-                        ++addLesion;
-                        ++lesionIt;
-                    }
+                DClevel = static_cast<float>(normalGenerator.GetVariate());
+                while(abs(DClevel)>variability*stdev){
+                    DClevel = static_cast<float>(normalGenerator.GetVariate());
                 }
             }
+            cout<<lesion<<" - Mean fluctuation intensity: "<<DClevel<<endl;
+            DClevels[t*(nLesion+1) + lesion] = DClevel;
+        }
+    }
+
+    //Lesion contrast of all time points in a single pass over the lesion voxels
+    const size_t nLesionVoxel = lesionOffsets.size();
+    vector<float> lesionContrast(numberFollowUp*nLesionVoxel);
+    for (size_t v = 0; v < nLesionVoxel; v++) {
+        const LabelPixelType lesion = lesionLabels[v];
+        for (int t = 1; t <= numberFollowUp; ++t) {
+            float contrast = lesionTexture[v] + DClevels[t*(nLesion+1) + lesion];
+            if (changingLesion[lesion] && (clipAbove ? contrast>1.0 : contrast<1.0))
+                contrast = 1.0;
+            lesionContrast[(t-1)*nLesionVoxel + v] = contrast;
         }
+    }
 
-        typename MaskType::Pointer finalDeformationMap = MaskType::New();
-        finalDeformationMap->SetInput(lesionMaskDeformationMapDCLevel);
-        finalDeformationMap->SetMaskImage(lesionMask->GetOutput());
-        finalDeformationMap->SetOutsideValue(1.0);
+    //Follow-up jobs: the smoothing, multiplication and writing of each time point are independent,
+    //so they are dispatched to a pool of worker threads. Every job in progress keeps its own
+    //deformation map, smoothed map and output image, so the number of workers bounds the memory.
+    const InputImageType* inputImage = reader->GetOutput();
+    const LabelInputType* maskImage = lesionMask->GetOutput();
+    std::vector<ostringstream> logs(numberFollowUp+1);
+    std::vector<int> status(numberFollowUp+1, EXIT_SUCCESS);
+    std::mutex jobMutex;
+    int nextTimePoint = 1;
+    int finishedTimePoints = 0;
+
+    int numberOfWorkers = timePointThreads;
+    if (numberOfWorkers <= 0)
+        numberOfWorkers = std::max(1u, std::thread::hardware_concurrency());
+    numberOfWorkers = std::min(numberOfWorkers, numberFollowUp);
+    cout<<"Writing "<<numberFollowUp<<" time points with "<<numberOfWorkers<<" threads"<<endl;
+
+    //The time points are compressed at the same time, so they share the processors
+    const unsigned int compressionThreads = std::max<unsigned int>(1, std::thread::hardware_concurrency() / numberOfWorkers);
+
+    auto simulateTimePoint = [&](int t) {
+        typename CastImageType::Pointer lesionDeformationMap = CastImageType::New();
+        lesionDeformationMap->CopyInformation(maskImage);
+        lesionDeformationMap->SetRegions(maskImage->GetBufferedRegion());
+        lesionDeformationMap->Allocate();
+        lesionDeformationMap->FillBuffer(1.0);
+        float* deformationBuffer = lesionDeformationMap->GetBufferPointer();
+        const float* contrast = &lesionContrast[(t-1)*nLesionVoxel];
+        for (size_t v = 0; v < nLesionVoxel; v++)
+            deformationBuffer[lesionOffsets[v]] = contrast[v];
 
         typename SmoothType::Pointer smoothLesions = SmoothType::New();
-        smoothLesions->SetInput(finalDeformationMap->GetOutput());
+        smoothLesions->SetInput(lesionDeformationMap);
         smoothLesions->SetSigma(sigma);
         smoothLesions->Update();
 
-
+        stringstream outputTimePoint;
+        outputTimePoint<<outputFolder<<PATH_SEPARATOR;
         if (deformationMapVolume) {
-            cout<<"Output lesion deformation map was requested"<<endl;
-            stringstream outputTimePoint;
-            outputTimePoint<<outputFolder<<PATH_SEPARATOR;
-            outputTimePoint<<"vol"<<imageModality<<"_TimePoint_"<<t<<"_lesionContrast.nii.gz";
-            typename DebugWriterType::Pointer deformationMapWriter = DebugWriterType::New();
-            deformationMapWriter->SetFileName( outputTimePoint.str().c_str() );
-            deformationMapWriter->SetInput( smoothLesions->GetOutput() );
-            deformationMapWriter->SetUseCompression(1);
-            deformationMapWriter->Update();
-        }else{
-            //Effectivelly apply the deformation map over the input image
-            typename MultiplyImageType::Pointer multiply = MultiplyImageType::New();
-            multiply->SetInput1(smoothLesions->GetOutput());
-            multiply->SetInput2(castInput->GetOutput());
-
-            typename CastOutputType::Pointer castOutput = CastOutputType::New();
-            castOutput->SetInput(multiply->GetOutput());
-
-            stringstream outputTimePoint;
-            outputTimePoint<<outputFolder<<PATH_SEPARATOR;
-            outputTimePoint<<"vol"<<imageModality<<"_TimePoint_"<<t<<".nii.gz";
-            typename WriterType::Pointer writer = WriterType::New();
-            writer->SetFileName( outputTimePoint.str().c_str() );
-            writer->SetInput( castOutput->GetOutput() );
-            writer->SetUseCompression(1);
-            writer->Update();
+            logs[t]<<"Output lesion deformation map was requested"<<endl;
+            outputTimePoint<<"vol"<<imageModality<<"_TimePoint_"<<t<<"_lesionContrast"<<outputExtension;
+            LesionIO::WriteImage<CastImageType>(smoothLesions->GetOutput(), outputTimePoint.str(), compressionLevel, compressionThreads);
+            return;
         }
+        lesionDeformationMap = nullptr;
+
+        //Effectivelly apply the deformation map over the input image
+        typename OutputImageType::Pointer outputImage = OutputImageType::New();
+        outputImage->CopyInformation(inputImage);
+        outputImage->SetRegions(inputImage->GetBufferedRegion());
+        outputImage->Allocate();
+        const InputPixelType* inputBuffer = inputImage->GetBufferPointer();
+        const float* smoothBuffer = smoothLesions->GetOutput()->GetBufferPointer();
+        OutputPixelType* outputBuffer = outputImage->GetBufferPointer();
+        const size_t numberOfPixels = inputImage->GetBufferedRegion().GetNumberOfPixels();
+        for (size_t i = 0; i < numberOfPixels; i++)
+            outputBuffer[i] = static_cast<OutputPixelType>(smoothBuffer[i] * static_cast<float>(inputBuffer[i]));
+        smoothLesions = nullptr;
+
+        outputTimePoint<<"vol"<<imageModality<<"_TimePoint_"<<t<<outputExtension;
+        LesionIO::WriteImage<OutputImageType>(outputImage, outputTimePoint.str(), compressionLevel, compressionThreads);
+        logs[t]<<"Time point "<<t<<" saved in "<<outputTimePoint.str()<<endl;
+    };
+
+    //Progress from 0.3 to 1 is advanced as each time point is written. When the CLI is
+    //cancelled, the time points that were not started are left out.
+    auto worker = [&]() {
+        while (true) {
+            int t;
+            {
+                std::lock_guard<std::mutex> lock(jobMutex);
+                if (nextTimePoint > numberFollowUp)
+                    return;
+                t = nextTimePoint++;
+                if (progress.IsAborted()) {
+                    logs[t] << "Time point " << t << ": cancelled" << std::endl;
+                    status[t] = EXIT_FAILURE;
+                    continue;
+                }
+            }
+            try
+            {
+                simulateTimePoint(t);
+            }
+            catch( std::exception & excep )
+            {
+                logs[t] << "Time point " << t << ": exception caught !" << std::endl;
+                logs[t] << excep.what() << std::endl;
+                status[t] = EXIT_FAILURE;
+            }
+            std::lock_guard<std::mutex> lock(jobMutex);
+            finishedTimePoints++;
+            std::ostringstream message;
+            message<<"Time point "<<t<<" simulated";
+            progress.SetProgress(0.3 + 0.7*finishedTimePoints/numberFollowUp, message.str());
+        }
+    };
+
+    std::vector<std::thread> workers;
+    for (int w = 0; w < numberOfWorkers; w++)
+        workers.push_back(std::thread(worker));
+    for (size_t w = 0; w < workers.size(); w++)
+        workers[w].join();
+
+    int result = EXIT_SUCCESS;
+    for (int t = 1; t <= numberFollowUp; ++t) {
+        cout<<logs[t].str();
+        if (status[t] != EXIT_SUCCESS)
+            result = EXIT_FAILURE;
     }
 
-    return EXIT_SUCCESS;
+    LesionReport::ReturnParameters returnParameters(returnParameterFile);
+    returnParameters.Set("numberOfLesions", nLesion);
+    returnParameters.Set("peakMemoryUsage", LesionReport::PeakMemoryUsage());
+    return result;
 }
 
 } // end of anonymous namespace